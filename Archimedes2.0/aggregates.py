@@ -0,0 +1,219 @@
+"""
+Per-company and fleet aggregates of system_data, maintained with deltas.
+
+Every base pool row of system_data (pool without "/") contributes a fixed set of additive values
+(capacity, usage sums, health class and telemetry counters) and the keys it is counted under
+(type, pool). The last contribution of every document is kept in a local state file, so a cycle
+only subtracts the old contribution and adds the new one for the rows that changed:
+    - sums are updated with one groupby over the signed old/new contributions
+    - counts per type and per pool name are reference counts
+    - the documents deleted from system_data (see remove()) have their contribution subtracted
+The aggregates are then written as one document per company plus one for the fleet, with the
+fields of the Dashboard AggregatedStats (src/pages/Dashboard/types.ts): like the dashboard, every
+pool row is one system and the averages are taken over all of them.
+"""
+import logging
+from datetime import datetime
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+import health
+import utils
+
+AGGREGATES_COLLECTION = "aggregates"
+FLEET_DOC_ID = "fleet"
+
+SUM_COLUMNS = [
+    "pools", "total_capacity", "used_capacity", "used_snapshots", "perc_used", "perc_snap",
+    "avg_speed", "avg_time", "health_score", "healthy", "warning", "critical",
+    "telemetry_active",
+]
+# distinct values counted per aggregate: contribution column -> state field
+COUNTED_COLUMNS = {"type": "types", "pool": "pool_names"}
+
+
+def _numeric(df: pd.DataFrame, column: str) -> np.ndarray:
+    if column not in df.columns:
+        return np.zeros(len(df))
+    return pd.to_numeric(df[column], errors="coerce").to_numpy(dtype="float64")
+
+
+def contributions_table(df_systems: pd.DataFrame, snapshots: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+    """
+    Contribution of every base pool row of df_systems, indexed by the system_data document id.
+
+    Args:
+        df_systems (pd.DataFrame): system_data rows of the cycle.
+        snapshots (pd.DataFrame, optional): perc_snap / used_snap summed over the datasets, indexed by
+            (hostid, base pool), as written to system_data for the base pools.
+    """
+    df = df_systems[df_systems["pool"].notna() & ~df_systems["pool"].astype(str).str.contains("/")].copy()
+    if snapshots is not None:
+        index = pd.MultiIndex.from_arrays([df["hostid"], df["pool"]])
+        for column in ("perc_snap", "used_snap"):
+            df[column] = snapshots[column].reindex(index).fillna(0.0).to_numpy()
+    if "health_score" not in df.columns:
+        df = pd.concat([df, health.health_table(df)], axis=1)
+
+    used = np.nan_to_num(_numeric(df, "used"))
+    score = np.nan_to_num(_numeric(df, "health_score"))
+    sending = df["sending_telemetry"].astype(str).str.lower().eq("true").to_numpy() \
+        if "sending_telemetry" in df.columns else np.zeros(len(df), dtype=bool)
+
+    table = pd.DataFrame({
+        "company": df["company"].fillna("").astype(str).to_numpy() if "company" in df.columns else "",
+        "type": df["type"].fillna("").astype(str).to_numpy() if "type" in df.columns else "",
+        "pool": df["pool"].astype(str).to_numpy(),
+        "pools": 1.0,
+        "total_capacity": used + np.nan_to_num(_numeric(df, "avail")),
+        "used_capacity": used,
+        "used_snapshots": np.nan_to_num(_numeric(df, "used_snap")),
+        "perc_used": np.nan_to_num(_numeric(df, "perc_used")),
+        "perc_snap": np.nan_to_num(_numeric(df, "perc_snap")),
+        "avg_speed": np.nan_to_num(_numeric(df, "avg_speed")),
+        "avg_time": np.nan_to_num(_numeric(df, "avg_time")),
+        "health_score": score,
+        "healthy": (score >= health.HEALTHY_MIN_SCORE).astype(float),
+        "warning": ((score >= health.WARNING_MIN_SCORE) & (score < health.HEALTHY_MIN_SCORE)).astype(float),
+        "critical": (score < health.WARNING_MIN_SCORE).astype(float),
+        "telemetry_active": sending.astype(float),
+    }, index=[f"{h}_{str(p).replace('/', '-')}" for h, p in zip(df["hostid"], df["pool"])])
+    return table[~table.index.duplicated(keep="last")]
+
+
+def _empty_aggregate() -> dict:
+    return {"sums": dict.fromkeys(SUM_COLUMNS, 0.0), **{field: {} for field in COUNTED_COLUMNS.values()}}
+
+
+class AggregateMaintainer:
+    """Company and fleet aggregates plus the contribution of every pool, persisted as a JSON state file."""
+
+    def __init__(self, contributions: Optional[dict] = None, companies: Optional[dict] = None,
+                 fleet: Optional[dict] = None):
+        # system_data doc id -> contribution (a row of contributions_table)
+        self.contributions = contributions or {}
+        # company -> {"sums": {...}, "types": {type: n}, "pool_names": {pool: n}}
+        self.companies = companies or {}
+        self.fleet = fleet or _empty_aggregate()
+
+    def update(self, df_systems: pd.DataFrame, snapshots: Optional[pd.DataFrame] = None) -> set:
+        """Applies the rows of the cycle. Returns the companies whose aggregate changed."""
+        new = contributions_table(df_systems, snapshots)
+        if new.empty:
+            return set()
+        known = [doc_id for doc_id in new.index if doc_id in self.contributions]
+        old = pd.DataFrame.from_dict({doc_id: self.contributions[doc_id] for doc_id in known},
+                                     orient="index", columns=new.columns)
+        if not old.empty:
+            unchanged = (new.loc[old.index] == old.astype(new.dtypes.to_dict())).all(axis=1)
+            unchanged = unchanged[unchanged].index
+            new, old = new.drop(unchanged), old.drop(unchanged)
+        if new.empty:
+            return set()
+        changed = self._apply(old, new)
+        self.contributions.update(new.to_dict("index"))
+        return changed
+
+    def remove(self, doc_ids) -> set:
+        """
+        Subtracts the contribution of the system_data documents `doc_ids` (deleted from the
+        collection). Returns the companies whose aggregate changed.
+        """
+        removed = [doc_id for doc_id in dict.fromkeys(doc_ids) if doc_id in self.contributions]
+        if not removed:
+            return set()
+        old = pd.DataFrame.from_dict({doc_id: self.contributions.pop(doc_id) for doc_id in removed},
+                                     orient="index")
+        logging.info(f"Aggregates: {len(removed)} removed pools subtracted")
+        return self._apply(old, old.iloc[0:0])
+
+    def _apply(self, old: pd.DataFrame, new: pd.DataFrame) -> set:
+        """Subtracts the `old` contributions and adds the `new` ones; returns the changed companies."""
+        signed = pd.concat([old.assign(sign=-1.0), new.assign(sign=1.0)])
+        signed[SUM_COLUMNS] = signed[SUM_COLUMNS].astype(float).mul(signed["sign"], axis=0)
+        company_deltas = signed.groupby("company")[SUM_COLUMNS].sum()
+        fleet_delta = signed[SUM_COLUMNS].sum()
+
+        for company, delta in company_deltas.iterrows():
+            sums = self.companies.setdefault(company, _empty_aggregate())["sums"]
+            for column, value in delta.items():
+                sums[column] += float(value)
+        for column, value in fleet_delta.items():
+            self.fleet["sums"][column] += float(value)
+
+        for column, field in COUNTED_COLUMNS.items():
+            for (company, value), delta in signed.groupby(["company", column])["sign"].sum().items():
+                self._count(self.companies[company][field], value, int(delta))
+            for value, delta in signed.groupby(column)["sign"].sum().items():
+                self._count(self.fleet[field], value, int(delta))
+
+        changed = set(company_deltas.index)
+        for company in changed:
+            if self.companies[company]["sums"]["pools"] <= 0:
+                del self.companies[company]
+        return changed
+
+    @staticmethod
+    def _count(counts: dict, value: str, delta: int):
+        counts[value] = counts.get(value, 0) + delta
+        if counts[value] <= 0:
+            del counts[value]
+
+    @staticmethod
+    def _document(aggregate: dict) -> dict:
+        """Aggregate with the fields of the Dashboard AggregatedStats (plus avgHealth)."""
+        sums = aggregate["sums"]
+        pools = max(sums["pools"], 1.0)
+        return {
+            "totalSystems": int(round(sums["pools"])),
+            "totalCapacity": round(sums["total_capacity"], 2),
+            "usedCapacity": round(sums["used_capacity"], 2),
+            "usedSnapshots": round(sums["used_snapshots"], 2),
+            "avgUsage": round(sums["perc_used"] / pools, 2),
+            "avgSnapUsage": round(sums["perc_snap"] / pools, 2),
+            "avgSpeed": round(sums["avg_speed"] / pools, 2),
+            "avgResponseTime": round(sums["avg_time"] / pools, 2),
+            "telemetryActive": int(round(sums["telemetry_active"])),
+            "systemsByType": dict(aggregate["types"]),
+            "systemsByPool": dict(aggregate["pool_names"]),
+            "healthySystems": int(round(sums["healthy"])),
+            "warningSystems": int(round(sums["warning"])),
+            "criticalSystems": int(round(sums["critical"])),
+            "avgHealth": round(sums["health_score"] / pools, 2),
+        }
+
+    def documents(self, companies: Optional[set] = None) -> list:
+        """
+        (doc_id, document) pairs: "company_<name>" for `companies` (all when None) and FLEET_DOC_ID.
+        Companies left without pools get an empty document, so readers never see stale values.
+        """
+        updated = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        names = sorted(self.companies) if companies is None else sorted(companies)
+        documents = []
+        for name in names:
+            document = self._document(self.companies.get(name, _empty_aggregate()))
+            document["systemsByCompany"] = {name: document["totalSystems"]} if document["totalSystems"] else {}
+            documents.append((
+                f"company_{name.replace('/', '-')}",
+                {"scope": "company", "name": name, **document, "updated": updated},
+            ))
+        fleet = self._document(self.fleet)
+        fleet["systemsByCompany"] = {
+            name: int(round(aggregate["sums"]["pools"])) for name, aggregate in sorted(self.companies.items())
+        }
+        documents.append((FLEET_DOC_ID, {"scope": "fleet", "name": FLEET_DOC_ID, **fleet, "updated": updated}))
+        logging.info(f"Aggregates: {len(names)} companies updated")
+        return documents
+
+    def save(self, file_path: str):
+        utils.write_state(
+            {"contributions": self.contributions, "companies": self.companies, "fleet": self.fleet},
+            file_path,
+        )
+
+    @classmethod
+    def load(cls, file_path: str) -> "AggregateMaintainer":
+        state = utils.read_state(file_path)
+        return cls(state.get("contributions"), state.get("companies"), state.get("fleet"))
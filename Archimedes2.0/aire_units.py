@@ -1,22 +1,36 @@
 import datetime
-import logfire as lf
 import pandas as pd
 #import fireducks.pandas as pd
 from pydantic import BaseModel, Field
 from typing import List, Dict
 
 from pool import *
+from columnar import TelemetryTable
 
 
 class Hostid(BaseModel):
     name: str = Field(..., description="Name of the host")
     pools: List[Pool] = Field(..., description="List of pools associated with the host")
 
+    @classmethod
+    def from_table(cls, table: TelemetryTable, unitid: str, name: str) -> "Hostid":
+        """Host of a unit with its pools, as views over the shared table."""
+        pools = [Pool.from_table(table, name, pool) for pool in table.hosts(unitid).get(name, {}) if (name, pool) in table]
+        return cls(name=name, pools=pools)
+
 
 class AireUnit(BaseModel):
     unitid: str = Field(..., description="Unique identifier for the Aire unit")
     hostids: List[Hostid] = Field(..., description="List of host IDs associated with the Aire unit")
     pools: List[Pool] = Field(..., description="List of pools associated with the Aire unit")
-    
+
+    @classmethod
+    def from_table(cls, table: TelemetryTable, unitid: str) -> "AireUnit":
+        """Unit of the table hierarchy (unit -> hostid -> pool -> datasets); the data is not copied."""
+        hostids = [Hostid.from_table(table, unitid, name) for name in table.hosts(unitid)]
+        return cls(unitid=unitid, hostids=hostids, pools=[pool for host in hostids for pool in host.pools])
 
 
+def build_units(table: TelemetryTable) -> Dict[str, AireUnit]:
+    """All the units of the fleet by unitid."""
+    return {unitid: AireUnit.from_table(table, unitid) for unitid in table.units()}
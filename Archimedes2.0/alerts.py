@@ -0,0 +1,301 @@
+"""
+Streaming alert detection over the telemetry batches of each cycle.
+
+The detector keeps O(1) state per (hostid, pool):
+    - EWMA mean and second moment of the perc_used increments (variance = q - m^2)
+    - last perc_used, last timestamp and threshold level (80/90/100) seen; samples not newer than
+      the last timestamp are skipped, so a batch read again does not advance the EWMA twice
+    - the level of the inactivity and forecast alerts already emitted
+    - unit_id and company, for the alerts emitted on cycles without a batch
+Each batch is evaluated in one vectorized pass against the state at the start of the batch, then the
+EWMA state is advanced in closed form (sum of a * (1 - a)^j * x over the batch), so the cost is
+O(new rows) and the alert latency is one cycle.
+
+Alerts use the schema of the Alerts History page (type, importance, message, date, unit_id, pool,
+company) and a deterministic document id, so re-emitting an alert (e.g. an inactivity escalating
+from blue to red) overwrites it instead of duplicating it.
+"""
+import logging
+from datetime import datetime
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+import utils
+
+ALERTS_COLLECTION = "alerts"
+EWMA_ALPHA = 0.1
+# increments are checked against the EWMA only once this many have been seen
+WARMUP_INCREMENTS = 12
+Z_THRESHOLD = 4.0
+# minimum |increment| of perc_used for a sudden change alert, and the "red" one (as the dashboard)
+SUDDEN_MIN_CHANGE = 5.0
+SUDDEN_RED_CHANGE = 10.0
+INACTIVITY_HOURS = 24
+INACTIVITY_RED_HOURS = 48
+USAGE_THRESHOLDS = [80.0, 90.0, 100.0]
+FORECAST_HORIZON_DAYS = 30
+HIGH_GROWTH = 3.0
+HIGH_GROWTH_RED = 5.0
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def _iso(ts) -> str:
+    return pd.Timestamp(ts).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _id_date(ts) -> str:
+    return pd.Timestamp(ts).strftime(DATE_FORMAT).replace(" ", "_").replace(":", "-")
+
+
+def _level(perc: np.ndarray) -> np.ndarray:
+    """Highest usage threshold reached (0 if none)."""
+    thresholds = np.asarray(USAGE_THRESHOLDS)
+    index = np.searchsorted(thresholds, perc, side="right")
+    return np.where(index > 0, thresholds[np.maximum(index - 1, 0)], 0.0)
+
+
+class AlertDetector:
+    """Per-pool alert state, persisted between cycles as a JSON state file."""
+
+    def __init__(self, pools: Optional[dict] = None, hosts: Optional[dict] = None):
+        # utils.pool_key -> {"m", "q", "n", "last_perc", "last_ts", "level", "inactive", "forecast",
+        #                    "unit_id", "company"}
+        self.pools = pools or {}
+        # hostid -> True while a telemetryInactive alert is open
+        self.hosts = hosts or {}
+
+    def _alert(self, alerts: list, hostid: str, pool: Optional[str], alert_type: str, suffix: str,
+               importance: str, message: str, date, value: Optional[float] = None):
+        """Appends an alert with id "<hostid>[_<pool>]_<type>_<suffix>" (one document per event)."""
+        doc_id = "_".join(str(part) for part in (hostid, pool, alert_type, suffix) if part is not None)
+        alerts.append({
+            "doc_id": doc_id.replace("/", "-"),
+            "hostid": hostid,
+            "pool": pool,
+            "type": alert_type,
+            "importance": importance,
+            "message": message,
+            "date": _iso(date),
+            "day": pd.Timestamp(date).strftime("%Y-%m-%d"),
+            "value": None if value is None or pd.isna(value) else round(float(value), 2),
+        })
+
+    def _evaluate_batch(self, samples: pd.DataFrame, alerts: list):
+        df = samples[["hostid", "pool", "timestamp", "perc_used"]].dropna()
+        # samples not newer than the last one of the pool were already evaluated (a batch read again)
+        seconds = df["timestamp"].to_numpy(dtype="datetime64[s]").astype(np.int64).astype("float64")
+        last_ts = np.array([self.pools.get(utils.pool_key(h, p), {}).get("last_ts", np.nan)
+                            for h, p in zip(df["hostid"], df["pool"])], dtype="float64")
+        df = df[~(seconds <= last_ts)]
+        if df.empty:
+            return
+        df = df.sort_values(["hostid", "pool", "timestamp"], kind="stable").reset_index(drop=True)
+        keys = [utils.pool_key(h, p) for h, p in zip(df["hostid"], df["pool"])]
+        groups = df.groupby(["hostid", "pool"], sort=False)
+        first = (groups.cumcount() == 0).to_numpy()
+
+        # state at the start of the batch, broadcast to every row of the pool
+        def from_state(field, default):
+            return np.array([self.pools.get(k, {}).get(field, default) for k in keys], dtype="float64")
+        m0, q0, n0 = from_state("m", 0.0), from_state("q", 0.0), from_state("n", 0.0)
+        state_perc, state_ts, state_level = from_state("last_perc", np.nan), from_state("last_ts", np.nan), from_state("level", 0.0)
+
+        perc = df["perc_used"].to_numpy(dtype="float64")
+        seconds = df["timestamp"].to_numpy(dtype="datetime64[s]").astype(np.int64).astype("float64")
+        prev_perc = np.where(first, state_perc, np.r_[np.nan, perc[:-1]])
+        prev_seconds = np.where(first, state_ts, np.r_[np.nan, seconds[:-1]])
+        level = _level(perc)
+        prev_level = np.where(first, state_level, np.r_[0.0, level[:-1]])
+
+        increment = perc - prev_perc
+        gap_hours = (seconds - prev_seconds) / 3600
+        sd = np.sqrt(np.maximum(q0 - m0 * m0, 0.0))
+        with np.errstate(invalid="ignore"):
+            sudden = (np.abs(increment) >= SUDDEN_MIN_CHANGE) & (
+                (n0 < WARMUP_INCREMENTS) | (np.abs(increment - m0) > Z_THRESHOLD * sd)
+            )
+            gap = gap_hours >= INACTIVITY_HOURS
+        crossing = level > prev_level
+
+        dates = df["timestamp"].to_numpy()
+        for i in np.flatnonzero(sudden):
+            d = increment[i]
+            self._alert(
+                alerts, df.at[i, "hostid"], df.at[i, "pool"],
+                "suddenIncrease" if d > 0 else "suddenDecrease", _id_date(dates[i]),
+                "red" if abs(d) >= SUDDEN_RED_CHANGE else "blue",
+                f"Sudden ↑ in used %: +{d:.1f} %" if d > 0 else f"Sudden ↓ in used %: −{abs(d):.1f} %",
+                dates[i], d,
+            )
+        for i in np.flatnonzero(gap):
+            prev_date = pd.to_datetime(prev_seconds[i], unit="s")
+            self._alert(
+                alerts, df.at[i, "hostid"], df.at[i, "pool"], "inactivity", _id_date(prev_date),
+                "red" if gap_hours[i] >= INACTIVITY_RED_HOURS else "blue",
+                f"No data for {int(gap_hours[i])} h.", prev_date, gap_hours[i],
+            )
+        for i in np.flatnonzero(crossing):
+            self._alert(
+                alerts, df.at[i, "hostid"], df.at[i, "pool"], "forecast", f"above{level[i]:g}_{_id_date(dates[i])}",
+                "red" if level[i] >= 90 else "blue",
+                f"Already above {level[i]:g} % ({perc[i]:.1f} %).", dates[i], perc[i],
+            )
+
+        # advance the EWMA state in closed form: the j-th increment from the end weighs a * (1 - a)^j
+        valid = ~np.isnan(increment)
+        inc = pd.DataFrame({"key": keys, "x": increment})[valid]
+        from_end = inc.groupby("key", sort=False).cumcount(ascending=False).to_numpy()
+        weights = EWMA_ALPHA * (1 - EWMA_ALPHA) ** from_end
+        sums = pd.DataFrame({
+            "key": inc["key"].to_numpy(),
+            "wx": weights * inc["x"].to_numpy(),
+            "wxx": weights * inc["x"].to_numpy() ** 2,
+            "k": 1,
+        }).groupby("key", sort=False).sum()
+
+        last_rows = np.r_[np.flatnonzero(first)[1:], len(df)] - 1
+        for row in last_rows:
+            key = keys[row]
+            state = self.pools.setdefault(key, {"m": 0.0, "q": 0.0, "n": 0, "level": 0.0})
+            if key in sums.index:
+                k, wx, wxx = sums.at[key, "k"], sums.at[key, "wx"], sums.at[key, "wxx"]
+                decay = (1 - EWMA_ALPHA) ** k
+                state["m"] = decay * state["m"] + float(wx)
+                state["q"] = decay * state["q"] + float(wxx)
+                state["n"] = int(state["n"] + k)
+            state["last_perc"] = float(perc[row])
+            state["last_ts"] = float(seconds[row])
+            state["level"] = float(level[row])
+            state.pop("inactive", None)
+
+    def _evaluate_inactivity(self, now: datetime, alerts: list):
+        now_seconds = pd.Timestamp(now).timestamp()
+        for key, state in self.pools.items():
+            if "last_ts" not in state:
+                continue
+            hours = (now_seconds - state["last_ts"]) / 3600
+            if hours < INACTIVITY_HOURS:
+                continue
+            importance = "red" if hours >= INACTIVITY_RED_HOURS else "blue"
+            if state.get("inactive") == importance:
+                continue
+            state["inactive"] = importance
+            hostid, pool = key.split("|", 1)
+            last_date = pd.to_datetime(state["last_ts"], unit="s")
+            self._alert(alerts, hostid, pool, "inactivity", _id_date(last_date), importance,
+                        f"No data for {int(hours)} h.", last_date, hours)
+
+    def _evaluate_forecast(self, forecasts: pd.DataFrame, now: datetime, alerts: list):
+        day = pd.Timestamp(now).strftime("%Y-%m-%d")
+        valid = forecasts[forecasts["growth_rate"].notna() & (forecasts["growth_rate"] > 0)]
+        for row in valid.to_dict("records"):
+            key = utils.pool_key(row["hostid"], row["pool"])
+            state = self.pools.setdefault(key, {"m": 0.0, "q": 0.0, "n": 0, "level": 0.0})
+            emitted = state.setdefault("forecast", {})
+            for threshold in USAGE_THRESHOLDS:
+                days = (threshold - row["fitted_perc_used"]) / row["growth_rate"]
+                name = f"{threshold:g}"
+                if not 0 < days <= FORECAST_HORIZON_DAYS or emitted.get(name) == day:
+                    continue
+                emitted[name] = day
+                importance = {80.0: "white", 90.0: "blue"}.get(threshold, "red")
+                self._alert(alerts, row["hostid"], row["pool"], "forecast", f"reach{name}_{day}", importance,
+                            f"Will reach {name} % in {int(np.ceil(days))} d.", now, days)
+            if row["growth_rate"] > HIGH_GROWTH and emitted.get("highGrowth") != day:
+                emitted["highGrowth"] = day
+                self._alert(alerts, row["hostid"], row["pool"], "highGrowth", day,
+                            "red" if row["growth_rate"] > HIGH_GROWTH_RED else "blue",
+                            f"High growth: +{row['growth_rate']:.2f} %/day.", now, row["growth_rate"])
+
+    def _evaluate_telemetry(self, df_systems: pd.DataFrame, now: datetime, alerts: list):
+        sending = df_systems.groupby("hostid")["sending_telemetry"].agg(
+            lambda s: s.astype(str).str.lower().eq("true").any()
+        )
+        for hostid, is_sending in sending.items():
+            if is_sending:
+                self.hosts.pop(hostid, None)
+            elif not self.hosts.get(hostid):
+                self.hosts[hostid] = True
+                self._alert(alerts, hostid, None, "telemetryInactive", pd.Timestamp(now).strftime("%Y-%m-%d"),
+                            "red", "Telemetry inactive.", now)
+
+    def evaluate(
+        self,
+        samples: pd.DataFrame,
+        df_systems: Optional[pd.DataFrame] = None,
+        forecasts: Optional[pd.DataFrame] = None,
+        now: Optional[datetime] = None,
+    ) -> List[dict]:
+        """
+        Evaluates a telemetry batch ("hostid", "pool", "timestamp", "perc_used"), the inactivity of
+        every known pool, the forecast crossings (forecast.forecast_pools) and the hosts that stopped
+        sending telemetry. Returns the new alerts, with unit_id and company from df_systems.
+        """
+        now = now or datetime.now()
+        alerts = []
+        self._evaluate_batch(samples, alerts)
+        self._evaluate_inactivity(now, alerts)
+        if forecasts is not None and not forecasts.empty:
+            self._evaluate_forecast(forecasts, now, alerts)
+        if df_systems is not None and not df_systems.empty:
+            self._evaluate_telemetry(df_systems, now, alerts)
+            systems = df_systems.drop_duplicates(["hostid", "pool"]).set_index(["hostid", "pool"])
+            hosts = df_systems.drop_duplicates("hostid").set_index("hostid")
+            for alert in alerts:
+                key = (alert["hostid"], alert["pool"])
+                source = systems.loc[key] if key in systems.index else hosts.loc[alert["hostid"]] if alert["hostid"] in hosts.index else None
+                alert["unit_id"] = None if source is None else source.get("unit_id")
+                alert["company"] = None if source is None else source.get("company")
+            self._remember_systems(systems)
+        else:
+            self._describe(alerts)
+        if alerts:
+            logging.info(f"Alerts: {len(alerts)} emitted")
+        return alerts
+
+    def evaluate_inactivity(self, now: Optional[datetime] = None) -> List[dict]:
+        """
+        Inactivity alerts of every known pool, without a batch. Main.run calls it on every cycle,
+        also the idle ones: a pool, or the whole fleet, that stops sending telemetry produces no
+        batch, so evaluate() alone would never report it.
+        """
+        alerts = []
+        self._evaluate_inactivity(now or datetime.now(), alerts)
+        self._describe(alerts)
+        if alerts:
+            logging.info(f"Alerts: {len(alerts)} inactivity alerts emitted")
+        return alerts
+
+    def _remember_systems(self, systems: pd.DataFrame):
+        """Keeps unit_id and company of the pools of the batch (systems indexed by hostid, pool)."""
+        columns = systems.reindex(columns=["unit_id", "company"])
+        for (hostid, pool), unit_id, company in zip(columns.index, columns["unit_id"], columns["company"]):
+            state = self.pools.get(utils.pool_key(hostid, pool))
+            if state is not None:
+                state.update(utils.numpy_to_python({
+                    "unit_id": None if pd.isna(unit_id) else unit_id,
+                    "company": None if pd.isna(company) else company,
+                }))
+
+    def _describe(self, alerts: list):
+        """unit_id and company of the alerts from the pool state (cycles without df_systems)."""
+        for alert in alerts:
+            state = self.pools.get(utils.pool_key(alert["hostid"], alert["pool"]), {})
+            alert["unit_id"] = state.get("unit_id")
+            alert["company"] = state.get("company")
+
+    def save(self, file_path: str):
+        utils.write_state({"pools": self.pools, "hosts": self.hosts}, file_path)
+
+    @classmethod
+    def load(cls, file_path: str) -> "AlertDetector":
+        state = utils.read_state(file_path)
+        return cls(state.get("pools"), state.get("hosts"))
+
+
+def alert_documents(alerts: List[dict]) -> list:
+    """(doc_id, document) pairs for the alerts collection."""
+    return [(alert["doc_id"], {k: v for k, v in alert.items() if k != "doc_id"}) for alert in alerts]
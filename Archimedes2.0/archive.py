@@ -0,0 +1,139 @@
+"""
+Local cold-history archive for capacity_trends documents.
+
+Documents are written before they are deleted from Firestore to an append-only Parquet dataset
+partitioned by hostid and month (hive layout: <root>/hostid=<id>/month=<YYYY-MM>/part-*.parquet),
+compressed with ZSTD. Every call writes new files, existing ones are never rewritten, so a
+re-archived document may appear twice: read_archive keeps the most recent copy per doc_id.
+"""
+import os
+import uuid
+import logging
+from datetime import datetime
+from typing import List, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+ARCHIVE_DIR = os.path.join("archive", "capacity_trends")
+COMPRESSION = "zstd"
+COMPRESSION_LEVEL = 9
+# ~128k rows per row group: large enough for efficient scans, small enough to prune by filter
+MAX_ROWS_PER_GROUP = 128 * 1024
+MIN_ROWS_PER_GROUP = 16 * 1024
+
+STRING_FIELDS = ["doc_id", "date", "day", "hostid", "pool", "unit_id"]
+FLOAT_FIELDS = ["perc_snap", "perc_used", "snap", "total_space", "used", "used_snap"]
+ARCHIVE_FIELDS = [f for f in STRING_FIELDS + FLOAT_FIELDS if f != "doc_id"]
+
+ARCHIVE_SCHEMA = pa.schema(
+    [(name, pa.string()) for name in STRING_FIELDS]
+    + [(name, pa.float64()) for name in FLOAT_FIELDS]
+    + [("archived_at", pa.string()), ("month", pa.string())]
+)
+PARTITIONING = ds.partitioning(
+    pa.schema([("hostid", pa.string()), ("month", pa.string())]), flavor="hive"
+)
+
+
+def _to_archive_table(df: pd.DataFrame) -> pa.Table:
+    """Normalizes a capacity_trends DataFrame to the fixed archive schema."""
+    out = pd.DataFrame(index=df.index)
+    for name in STRING_FIELDS:
+        col = df[name] if name in df.columns else pd.Series(None, index=df.index, dtype=object)
+        out[name] = col.astype(object).where(col.notna(), None).map(lambda v: v if v is None else str(v))
+    for name in FLOAT_FIELDS:
+        col = df[name] if name in df.columns else pd.Series(float("nan"), index=df.index)
+        out[name] = pd.to_numeric(col, errors="coerce").astype("float64")
+    out["archived_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    out["month"] = out["date"].str.slice(0, 7)
+    return pa.Table.from_pandas(out, schema=ARCHIVE_SCHEMA, preserve_index=False)
+
+
+def archive_documents(df: pd.DataFrame, root: str = ARCHIVE_DIR) -> int:
+    """
+    Appends full capacity_trends payloads to the local archive. `df` must contain "doc_id"
+    and "date"; missing optional fields are stored as null. Returns the number of archived rows.
+    """
+    if df.empty:
+        return 0
+    table = _to_archive_table(df)
+    os.makedirs(root, exist_ok=True)
+    ds.write_dataset(
+        table,
+        root,
+        format="parquet",
+        partitioning=PARTITIONING,
+        basename_template=f"part-{datetime.now():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+        file_options=ds.ParquetFileFormat().make_write_options(
+            compression=COMPRESSION, compression_level=COMPRESSION_LEVEL
+        ),
+        max_rows_per_group=MAX_ROWS_PER_GROUP,
+        min_rows_per_group=min(MIN_ROWS_PER_GROUP, table.num_rows),
+    )
+    logging.info(f"Archived {table.num_rows} documents to {root}")
+    return table.num_rows
+
+
+def read_archive(
+    root: str = ARCHIVE_DIR,
+    hostid: Optional[str] = None,
+    pool: Optional[str] = None,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    columns: Optional[List[str]] = None,
+) -> pd.DataFrame:
+    """
+    Reads archived documents, pruning partitions by hostid and month.
+    `start`/`end` are inclusive "YYYY-MM-DD[ HH:MM:SS]" bounds on "date".
+    """
+    if not os.path.isdir(root):
+        return pd.DataFrame(columns=columns or ARCHIVE_SCHEMA.names)
+    dataset = ds.dataset(root, format="parquet", schema=ARCHIVE_SCHEMA, partitioning=PARTITIONING)
+
+    expr = None
+    def _and(condition):
+        nonlocal expr
+        expr = condition if expr is None else expr & condition
+    if hostid is not None:
+        _and(ds.field("hostid") == hostid)
+    if pool is not None:
+        _and(ds.field("pool") == pool)
+    if start is not None:
+        _and(ds.field("month") >= start[:7])
+        _and(ds.field("date") >= start)
+    if end is not None:
+        _and(ds.field("month") <= end[:7])
+        # "end" inclusive also when given as a bare day
+        _and(ds.field("date") <= (end if len(end) > 10 else f"{end} 23:59:59"))
+
+    read_columns = None
+    if columns is not None:
+        read_columns = list(dict.fromkeys([*columns, "doc_id", "archived_at"]))
+    table = dataset.to_table(columns=read_columns, filter=expr)
+    if table.num_rows == 0:
+        return table.to_pandas().reindex(columns=columns or table.column_names)
+
+    # append-only: a document archived twice keeps its latest copy
+    table = table.take(pc.sort_indices(table, [("doc_id", "ascending"), ("archived_at", "descending")]))
+    df = table.to_pandas()
+    df = df.drop_duplicates(subset="doc_id", keep="first")
+    df = df.sort_values(["hostid", "pool", "date"]).reset_index(drop=True)
+    return df[columns] if columns is not None else df
+
+
+def to_state_vector_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Maps archived capacity_trends rows (GB) to the columns expected by StateVector:
+    "timestamp" (datetime), "used_tb" and "total" (TB).
+    """
+    return pd.DataFrame({
+        "hostid": df["hostid"].to_numpy(),
+        "pool": df["pool"].to_numpy(),
+        "timestamp": pd.to_datetime(df["date"], format="%Y-%m-%d %H:%M:%S", errors="coerce"),
+        "used_tb": df["used"].to_numpy(dtype="float64") / 1000,
+        "total": df["total_space"].to_numpy(dtype="float64") / 1000,
+    }).dropna(subset=["timestamp"])
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Memory benchmark of the Pool models on a synthetic fleet.
+
+Compares one DataFrame copy per pool (the previous Pool.pool_dataframe layout) with the shared
+TelemetryTable, where every Pool is a view over a row range. Memory is measured with tracemalloc
+(numpy and pandas buffers included). Both layouts hold the sample values once, so the check is on
+the overhead above the raw column bytes (per-frame blocks, indexes, models): fails (exit code 1)
+when the columnar overhead is more than --max-ratio of the per-pool copies overhead.
+
+Usage (from the Archimedes2.0 folder):
+    python benchmarks/columnar_memory.py [--pools 10000] [--samples 288] [--max-ratio 0.5]
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from columnar import TelemetryTable  # noqa: E402
+from pool import Pool  # noqa: E402
+
+
+def synthetic_telemetry(pools: int, samples: int, pools_per_host: int = 4, seed: int = 0) -> pd.DataFrame:
+    """Raw telemetry shaped like MerlinDB's: one row per (pool, sample), 5 minutes apart."""
+    rng = np.random.default_rng(seed)
+    n = pools * samples
+    pool_index = np.repeat(np.arange(pools), samples)
+    used = 4e11 + np.cumsum(rng.choice([0, 0, 1e9, -5e8], n))
+    df = pd.DataFrame({
+        "hostid": (pool_index // pools_per_host).astype(str),
+        "pool": np.char.add("sp", (pool_index % pools_per_host).astype(str)),
+        "editdate": np.tile(pd.date_range("2026-01-01", periods=samples, freq="5min").to_numpy(), pools),
+        "ref_time": 0,
+        "avail": 1e12 - used,
+        "used": used,
+        "snap": rng.uniform(0, 1e10, n),
+        "ratio": 1.0,
+    })
+    # arrival order, as read from the database
+    return df.sample(frac=1.0, random_state=seed).reset_index(drop=True)
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current, peak, elapsed
+
+
+def per_pool_copies(df: pd.DataFrame) -> dict:
+    return {key: group.drop(columns=["hostid", "pool"]).sort_values("editdate") for key, group in df.groupby(["hostid", "pool"])}
+
+
+def columnar_pools(df: pd.DataFrame) -> list:
+    table = TelemetryTable(df)
+    return [Pool.from_table(table, hostid, pool) for hostid, pool in table.offsets]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Pool model memory benchmark")
+    parser.add_argument("--pools", type=int, default=10_000)
+    parser.add_argument("--samples", type=int, default=288, help="samples per pool (288 = one day every 5 minutes)")
+    parser.add_argument("--max-ratio", type=float, default=0.5, help="max columnar/copies overhead")
+    args = parser.parse_args()
+
+    df = synthetic_telemetry(args.pools, args.samples)
+    print(f"telemetry: {args.pools} pools x {args.samples} samples = {len(df)} rows, "
+          f"{df.memory_usage(deep=True).sum() / 2**20:.1f} MiB")
+
+    # bytes of the sample values, held once by both layouts
+    values = sum(df[name].to_numpy().nbytes for name in df.columns if name not in ("hostid", "pool"))
+    overheads = {}
+    for name, build in (("per-pool copies", per_pool_copies), ("columnar", columnar_pools)):
+        result, current, peak, elapsed = measure(lambda: build(df))
+        overheads[name] = current - values
+        print(f"{name:<16} retained {current / 2**20:8.1f} MiB  overhead {overheads[name] / 2**20:8.1f} MiB "
+              f"({overheads[name] / args.pools / 1024:.1f} KiB/pool)  peak {peak / 2**20:8.1f} MiB  build {elapsed:6.2f} s")
+        del result
+
+    ratio = overheads["columnar"] / overheads["per-pool copies"]
+    status = "OK" if ratio <= args.max_ratio else "FAIL"
+    print(f"columnar/copies overhead {ratio:.2f} (max {args.max_ratio}) {status}")
+    return 0 if status == "OK" else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark of forecast.forecast_pools on a synthetic fleet.
+
+Default: 10k pools x 90 days of hourly samples (the 1h candles kept by candles.CandleStore),
+21.6M samples in arrival order with 1% spikes. Reports samples/s and the slope error of the OLS
+and Huber trends; fails (exit code 1) when the fit takes longer than --budget seconds.
+
+Usage (from the Archimedes2.0 folder):
+    python benchmarks/forecast_throughput.py [--pools 10000] [--days 90] [--per-day 24] [--budget 60]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+import forecast  # noqa: E402
+
+
+def synthetic_samples(pools: int, days: int, per_day: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    per_pool = days * per_day
+    n = pools * per_pool
+    slopes = rng.uniform(-0.1, 0.5, pools)
+    pool_index = np.repeat(np.arange(pools, dtype=np.int32), per_pool)
+    elapsed_days = np.tile(np.arange(per_pool) / per_day, pools)
+    perc_used = 30 + slopes[pool_index] * elapsed_days + rng.normal(0, 0.3, n)
+    spikes = rng.random(n) < 0.01
+    perc_used[spikes] += 15
+    timestamps = np.datetime64("2026-01-01T00:00:00") + (elapsed_days * 86400).astype("timedelta64[s]")
+    order = rng.permutation(n)
+    samples = pd.DataFrame({
+        "hostid": pd.Categorical.from_codes(pool_index[order] // 4, [f"h{i}" for i in range(pools // 4 + 1)]),
+        "pool": pd.Categorical.from_codes(pool_index[order] % 4, ["sp0", "sp1", "sp2", "sp3"]),
+        "timestamp": timestamps[order],
+        "perc_used": perc_used[order],
+    })
+    truth = pd.DataFrame({
+        "hostid": [f"h{i // 4}" for i in range(pools)],
+        "pool": [f"sp{i % 4}" for i in range(pools)],
+        "slope": slopes,
+    })
+    return samples, truth
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Forecast throughput benchmark")
+    parser.add_argument("--pools", type=int, default=10_000)
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--per-day", type=int, default=24, help="samples per pool per day")
+    parser.add_argument("--budget", type=float, default=60.0, help="max seconds for forecast_pools")
+    args = parser.parse_args()
+
+    samples, truth = synthetic_samples(args.pools, args.days, args.per_day)
+    print(f"samples: {args.pools} pools x {args.days} days x {args.per_day}/day = {len(samples)}")
+
+    start = time.perf_counter()
+    forecasts = forecast.forecast_pools(samples, lookback_days=args.days)
+    elapsed = time.perf_counter() - start
+
+    merged = forecasts.astype({"hostid": str, "pool": str}).merge(truth, on=["hostid", "pool"])
+    ols_error = (merged["growth_rate_ols"] - merged["slope"]).abs().mean()
+    huber_error = (merged["growth_rate"] - merged["slope"]).abs().mean()
+    status = "OK" if elapsed <= args.budget else "FAIL"
+    print(f"forecast_pools {elapsed:6.2f} s ({len(samples) / elapsed / 1e6:.2f} M samples/s, "
+          f"{len(forecasts)} pools) budget {args.budget:.0f} s {status}")
+    print(f"mean slope error (%/day): OLS {ols_error:.5f}  Huber {huber_error:.5f}")
+    return 0 if status == "OK" else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
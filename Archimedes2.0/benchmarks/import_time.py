@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Import-time benchmark for the analyzer entry points.
+
+Runs `python -X importtime -c "import <module>"` in a fresh interpreter for each entry point,
+reports the cumulative import time and the heaviest imports, and fails (exit code 1) when a
+module exceeds its budget or loads one of the plotting/reporting packages that must stay lazy.
+
+Usage (from the Archimedes2.0 folder):
+    python benchmarks/import_time.py [--repeat 5] [--scale 1.0]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Budget in milliseconds (best of --repeat runs, warm bytecode cache)
+IMPORT_BUDGET_MS = {
+    "main": 1000,
+    "check": 1000,
+    "firestore_deletion": 1000,
+}
+
+# Packages that the entry points must not import at startup
+LAZY_PACKAGES = ["matplotlib", "seaborn", "scipy", "mplfinance", "logfire", "icecream", "xlsxwriter"]
+
+
+def measure(module: str) -> tuple[float, list[tuple[float, str]], list[str]]:
+    """Returns (cumulative ms, [(cumulative ms, name)] of all imports, lazy packages loaded)."""
+    code = (
+        f"import sys; import {module}; "
+        f"print(','.join(p for p in {LAZY_PACKAGES!r} if p in sys.modules))"
+    )
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=BASE_DIR, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{proc.stderr[-2000:]}")
+
+    imports = []
+    total_ms = None
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        ms = int(cumulative) / 1000
+        imports.append((ms, name.strip()))
+        if name.strip() == module:
+            total_ms = ms
+    loaded_lazy = [p for p in proc.stdout.strip().split(",") if p]
+    return total_ms or 0.0, imports, loaded_lazy
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Import-time regression check")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per module, best one is kept")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplier applied to every budget")
+    parser.add_argument("--top", type=int, default=10, help="heaviest imports to print per module")
+    args = parser.parse_args()
+
+    failed = False
+    for module, budget in IMPORT_BUDGET_MS.items():
+        runs = [measure(module) for _ in range(args.repeat)]
+        total_ms, imports, loaded_lazy = min(runs, key=lambda r: r[0])
+        limit = budget * args.scale
+        status = "OK" if total_ms <= limit and not loaded_lazy else "FAIL"
+        failed |= status == "FAIL"
+        print(f"{module:<20} {total_ms:8.1f} ms (budget {limit:.0f} ms) {status}")
+        if loaded_lazy:
+            print(f"  eagerly imported: {', '.join(loaded_lazy)}")
+        for ms, name in sorted(imports, reverse=True)[1:args.top + 1]:
+            print(f"  {ms:8.1f} ms  {name}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
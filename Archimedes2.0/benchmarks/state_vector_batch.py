@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Benchmark of StateVector.from_fleet (one batch_state_vectors pass) against the per-pool analysis.
+
+Default: 1000 pools x 30 days of samples every 15 minutes, shuffled. The per-pool path builds
+StateVector(df, hostid, pool) for each pool (one mask over the whole frame per pool) and runs
+find_timestamps + get_sv_values + state_vector_analysis; it is timed on --sample pools and
+extrapolated to the fleet. Checks that both paths give the same results and fails (exit code 1)
+when the speedup is below --min-speedup.
+
+Usage (from the Archimedes2.0 folder):
+    python benchmarks/state_vector_batch.py [--pools 1000] [--days 30] [--per-day 96] [--sample 50] [--min-speedup 10]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from state_vector import StateVector  # noqa: E402
+
+
+def synthetic_telemetry(pools: int, days: int, per_day: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    per_pool = days * per_day
+    n = pools * per_pool
+    pool_index = np.repeat(np.arange(pools), per_pool)
+    # per sample: mostly unchanged, some writes, some deletions
+    steps = rng.choice([0.0, 0.0, 0.01, -0.005], n)
+    used_tb = 50 + np.cumsum(steps.reshape(pools, per_pool), axis=1).ravel()
+    timestamps = np.datetime64("2026-01-01T00:00:00") + (
+        np.tile(np.arange(per_pool), pools) * (86400 // per_day)).astype("timedelta64[s]")
+    order = rng.permutation(n)
+    return pd.DataFrame({
+        "hostid": np.array([f"h{i // 4}" for i in range(pools)])[pool_index[order]],
+        "pool": np.array([f"sp{i % 4}" for i in range(pools)])[pool_index[order]],
+        "timestamp": timestamps[order],
+        "used_tb": used_tb[order],
+        "total": 100.0,
+    })
+
+
+def per_pool_results(df: pd.DataFrame, hostid: str, pool: str) -> dict:
+    sv = StateVector(df, hostid, pool)
+    sv.find_timestamps()
+    sv.get_sv_values()
+    sv.get_sv_data()
+    sv.state_vector_analysis()
+    return sv.results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="State vector batch benchmark")
+    parser.add_argument("--pools", type=int, default=1000)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--per-day", type=int, default=96, help="samples per pool per day")
+    parser.add_argument("--sample", type=int, default=50, help="pools timed on the per-pool path")
+    parser.add_argument("--min-speedup", type=float, default=10.0)
+    args = parser.parse_args()
+
+    df = synthetic_telemetry(args.pools, args.days, args.per_day)
+    print(f"samples: {args.pools} pools x {args.days} days x {args.per_day}/day = {len(df)}")
+
+    start = time.perf_counter()
+    fleet = StateVector.from_fleet(df)
+    batch_elapsed = time.perf_counter() - start
+
+    keys = list(fleet)[:args.sample]
+    start = time.perf_counter()
+    per_pool = {key: per_pool_results(df, *key) for key in keys}
+    per_pool_elapsed = (time.perf_counter() - start) * len(fleet) / len(keys)
+
+    mismatches = 0
+    for key, results in per_pool.items():
+        for name, value in results.items():
+            other = fleet[key].results[name]
+            if not (value == other or (isinstance(value, float) and np.isclose(value, other))):
+                mismatches += 1
+    speedup = per_pool_elapsed / batch_elapsed
+    status = "OK" if mismatches == 0 and speedup >= args.min_speedup else "FAIL"
+    print(f"per pool   {per_pool_elapsed:8.2f} s (extrapolated from {len(keys)} pools)")
+    print(f"from_fleet {batch_elapsed:8.2f} s ({len(fleet)} pools)")
+    print(f"speedup {speedup:.1f}x (min {args.min_speedup:.0f}x), {mismatches} mismatching results {status}")
+    return 0 if status == "OK" else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,474 @@
+"""
+Materialized OHLC candles of pool usage for the state vector candlestick view.
+
+For every (hostid, pool) the store keeps candles of `used` (GB) at 1h, 1d and 1w granularity,
+with the sum of the increments between consecutive samples as volume and the last total space
+of the bucket. Each telemetry batch is aggregated once per granularity and merged into the
+existing candles: open stays fixed, high/low are merged, close is replaced, volume is summed.
+
+Only the newest candle of every (hostid, pool, granularity) is still open; it is kept in memory
+and persisted in candles/open.parquet. A candle closes when a later bucket of the same pool
+starts, and is then written once to a partition of the closed candles,
+candles/<granularity>/<period>.parquet (a day of 1h candles, a month of 1d, a year of 1w). A
+cycle therefore merges its batch with the open candles of the pools it touches and rewrites only
+the partitions of the candles it closed, whatever the history length.
+
+Every sample is merged once. A sample not newer than the newest one of its pool is late: it is
+dropped when the stored 1h candle of its bucket already reaches it (a batch read again after a
+failed cycle), otherwise it is merged into the candle that holds it, in its partition if that
+candle is closed. The increments around a late sample are taken from the stored samples next to
+it, so the volumes are the same as if the samples had arrived in order.
+
+Partitions entirely older than RETENTION_DAYS (from the newest open candle of the granularity)
+are deleted. Charts and the forecast read the partitions they need (see frame()).
+"""
+import os
+import logging
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+import utils
+
+CANDLES_DIR = "candles"
+OPEN_FILE = "open.parquet"
+# single-file store of the previous versions, split into partitions by load()
+LEGACY_CANDLES_FILE = "candles.parquet"
+GRANULARITIES = ["1h", "1d", "1w"]
+# candles older than this many days (from the newest candle of the granularity) are pruned; None = keep
+RETENTION_DAYS = {"1h": 90, "1d": 730, "1w": None}
+# period of the closed candle partitions: strftime format and length of a period
+PARTITIONS = {"1h": ("%Y-%m-%d", pd.DateOffset(days=1)), "1d": ("%Y-%m", pd.DateOffset(months=1)),
+              "1w": ("%Y", pd.DateOffset(years=1))}
+
+SERIES_COLUMNS = ["hostid", "pool", "granularity"]
+KEY_COLUMNS = SERIES_COLUMNS + ["bucket"]
+VALUE_COLUMNS = ["open", "high", "low", "close", "volume", "total", "first_ts", "last_ts", "samples"]
+
+
+def bucket_start(timestamps: pd.Series, granularity: str) -> pd.Series:
+    """Start of the candle containing each timestamp (weeks start on Monday)."""
+    match granularity:
+        case "1h":
+            return timestamps.dt.floor("h")
+        case "1d":
+            return timestamps.dt.floor("D")
+        case "1w":
+            return timestamps.dt.floor("D") - pd.to_timedelta(timestamps.dt.dayofweek, unit="D")
+        case _:
+            raise ValueError(f"Unsupported candle granularity: {granularity}")
+
+
+def _empty() -> pd.DataFrame:
+    return pd.DataFrame(columns=KEY_COLUMNS + VALUE_COLUMNS).set_index(KEY_COLUMNS)
+
+
+def _split_open(candles: pd.DataFrame):
+    """(open, closed) candles: the open one is the newest bucket of every (hostid, pool, granularity)."""
+    df = candles.reset_index()
+    newest = df.groupby(SERIES_COLUMNS, sort=False)["bucket"].transform("max")
+    is_open = (df["bucket"] == newest).to_numpy()
+    return df[is_open].set_index(KEY_COLUMNS), df[~is_open]
+
+
+def _periods(df: pd.DataFrame) -> pd.Series:
+    """Partition period of every candle (columns granularity and bucket)."""
+    periods = pd.Series("", index=df.index, dtype=object)
+    for granularity, (fmt, _) in PARTITIONS.items():
+        rows = df["granularity"] == granularity
+        if rows.any():
+            periods[rows] = pd.to_datetime(df.loc[rows, "bucket"]).dt.strftime(fmt)
+    return periods
+
+
+def _unique_partitions(keys: pd.DataFrame):
+    """(granularities, periods) of the distinct partitions of the candle keys."""
+    partitions = pd.DataFrame({"granularity": keys["granularity"], "period": _periods(keys)}).drop_duplicates()
+    return partitions["granularity"].tolist(), partitions["period"].tolist()
+
+
+class CandleStore:
+    """OHLC candles of every pool, updated incrementally from telemetry batches."""
+
+    def __init__(self, open_candles: Optional[pd.DataFrame] = None, last_used: Optional[dict] = None,
+                 directory: Optional[str] = None):
+        # newest candle of every (hostid, pool, granularity), indexed by KEY_COLUMNS
+        self.open = open_candles if open_candles is not None else _empty()
+        # `used` of the newest sample per utils.pool_key, to compute the increment of the next batch's first sample
+        self.last_used = last_used or {}
+        # folder of the closed candle partitions (None: nothing saved yet)
+        self.directory = directory
+        # closed candles not written yet, per (granularity, period)
+        self.closed: Dict[tuple, pd.DataFrame] = {}
+        self._frame = None
+
+    def _newest(self) -> dict:
+        """Timestamp of the newest sample merged per utils.pool_key (the last_ts of its open candles)."""
+        if self.open.empty:
+            return {}
+        newest = self.open.groupby(level=["hostid", "pool"], sort=False)["last_ts"].max()
+        return {utils.pool_key(h, p): ts for (h, p), ts in newest.items()}
+
+    def _batch_candles(self, samples: pd.DataFrame):
+        """
+        Candles of the batch (indexed by KEY_COLUMNS) and the volume corrections of the stored
+        candles following its late samples (see _late_increments; None when there are none).
+        """
+        df = samples[["hostid", "pool", "timestamp", "used", "total"]].sort_values("timestamp", kind="stable")
+        keys = np.array([utils.pool_key(h, p) for h, p in zip(df["hostid"], df["pool"])], dtype=object)
+        newest = self._newest()
+        high_water = pd.to_datetime(pd.Series([newest.get(k) for k in keys], index=df.index, dtype=object))
+        late = (df["timestamp"] <= high_water).to_numpy()
+
+        # samples newer than the pool's newest one: the first increment is taken from last_used
+        new = df[~late]
+        grouped = new.groupby(["hostid", "pool"], sort=False)["used"]
+        previous = grouped.shift(1).astype("float64")
+        first_of_pool = (grouped.cumcount() == 0).to_numpy()
+        previous[first_of_pool] = [self.last_used.get(k, float("nan")) for k in keys[~late][first_of_pool]]
+        new = new.assign(increment=(new["used"] - previous).fillna(0.0))
+        last_rows = new.assign(_key=keys[~late]).drop_duplicates("_key", keep="last")
+        self.last_used.update(zip(last_rows["_key"], last_rows["used"].astype(float)))
+
+        adjustments = None
+        if late.any():
+            late_rows, adjustments = self._late_increments(df[late])
+            df = pd.concat([new, late_rows]).sort_values("timestamp", kind="stable")
+        else:
+            df = new
+        if df.empty:
+            return _empty(), adjustments
+
+        frames = []
+        for granularity in GRANULARITIES:
+            frames.append(
+                df.assign(granularity=granularity, bucket=bucket_start(df["timestamp"], granularity))
+                .groupby(KEY_COLUMNS, sort=False)
+                .agg(
+                    open=("used", "first"),
+                    high=("used", "max"),
+                    low=("used", "min"),
+                    close=("used", "last"),
+                    volume=("increment", "sum"),
+                    total=("total", "last"),
+                    first_ts=("timestamp", "min"),
+                    last_ts=("timestamp", "max"),
+                    samples=("used", "size"),
+                )
+            )
+        return pd.concat(frames), adjustments
+
+    def _stored_candles(self, samples: pd.DataFrame) -> pd.DataFrame:
+        """
+        Stored candles (open and closed) of the pools of `samples` that can hold the samples
+        around them: the 1h candles of their days, the 1d candles of their months and every 1w candle.
+        """
+        frames = [self.open.reset_index()]
+        for granularity in GRANULARITIES:
+            fmt, _ = PARTITIONS[granularity]
+            if granularity == "1w":
+                periods = set(self._stored_periods(granularity)) if self.directory is not None else set()
+                periods |= {period for (g, period) in self.closed if g == granularity}
+            else:
+                periods = set(samples["timestamp"].dt.strftime(fmt))
+            frames.extend(self._read_partition(granularity, period) for period in sorted(periods))
+        stored = pd.concat([f for f in frames if not f.empty]).drop_duplicates(KEY_COLUMNS)
+        pools = pd.MultiIndex.from_frame(samples[["hostid", "pool"]].drop_duplicates())
+        return stored[pd.MultiIndex.from_frame(stored[["hostid", "pool"]]).isin(pools)]
+
+    def _late_increments(self, samples: pd.DataFrame):
+        """
+        Increments of the samples not newer than the newest sample of their pool.
+
+        A sample at or before the last_ts of the stored 1h candle of its bucket was already merged
+        (a batch read again) and is dropped, as are the samples older than the 1h retention. The
+        others fill a gap between two stored samples: the first and last sample of every stored
+        candle is a real sample, so the neighbours of a gap are the nearest candle endpoints. The
+        first sample of a gap takes its increment from the previous stored sample, and the stored
+        sample after the gap gets its increment from the last one of the gap instead: the difference
+        is returned as volume corrections (indexed by KEY_COLUMNS) of the candles that contain it.
+        """
+        stored = self._stored_candles(samples)
+        hourly = stored[stored["granularity"] == "1h"].set_index(["hostid", "pool", "bucket"])["last_ts"]
+        bucket_last = hourly.reindex(pd.MultiIndex.from_arrays(
+            [samples["hostid"], samples["pool"], bucket_start(samples["timestamp"], "1h")]
+        )).to_numpy()
+        newest = self._newest()
+        horizon = pd.to_datetime(pd.Series(
+            [newest[utils.pool_key(h, p)] for h, p in zip(samples["hostid"], samples["pool"])],
+            index=samples.index,
+        )) - pd.Timedelta(days=RETENTION_DAYS["1h"])
+        merged = (samples["timestamp"].to_numpy() <= bucket_last) | (samples["timestamp"] < horizon).to_numpy()
+        if merged.any():
+            logging.info(f"Candles: skipped {int(merged.sum())} samples already merged")
+        samples = samples[~merged]
+        if samples.empty:
+            return samples.assign(increment=0.0), None
+
+        points = pd.concat([
+            stored[["hostid", "pool", "first_ts", "open"]].set_axis(["hostid", "pool", "ts", "used"], axis=1),
+            stored[["hostid", "pool", "last_ts", "close"]].set_axis(["hostid", "pool", "ts", "used"], axis=1),
+        ])
+        points["ts"] = points["ts"].to_numpy(dtype="datetime64[ns]")
+        points = points.drop_duplicates(["hostid", "pool", "ts"]).sort_values("ts", kind="stable")
+        points = {key: (rows["ts"].to_numpy(), rows["used"].to_numpy(dtype="float64"))
+                  for key, rows in points.groupby(["hostid", "pool"], sort=False)}
+
+        timestamps = samples["timestamp"].to_numpy(dtype="datetime64[ns]")
+        used = samples["used"].to_numpy(dtype="float64")
+        increments = np.zeros(len(samples))
+        corrections = []
+        for (hostid, pool), rows in samples.groupby(["hostid", "pool"], sort=False).indices.items():
+            point_ts, point_used = points.get((hostid, pool), (timestamps[:0], used[:0]))
+            ts, values = timestamps[rows], used[rows]
+            # samples with the same number of stored points before them are in the same gap
+            position = np.searchsorted(point_ts, ts, side="left")
+            prev_used = np.where(position > 0, point_used[np.maximum(position - 1, 0)], np.nan)
+            first_of_gap = np.r_[True, position[1:] != position[:-1]]
+            previous = np.where(first_of_gap, prev_used, np.r_[np.nan, values[:-1]])
+            increments[rows] = np.nan_to_num(values - previous)
+            last_of_gap = np.r_[position[1:] != position[:-1], True]
+            for i in np.flatnonzero(last_of_gap & (position < len(point_ts))):
+                next_ts, next_used = point_ts[position[i]], point_used[position[i]]
+                stored_increment = next_used - prev_used[i] if position[i] > 0 else 0.0
+                corrections.append((hostid, pool, next_ts, (next_used - values[i]) - stored_increment))
+        samples = samples.assign(increment=increments)
+        if not corrections:
+            return samples, None
+
+        corrections = pd.DataFrame(corrections, columns=["hostid", "pool", "timestamp", "volume"])
+        adjustments = pd.concat([
+            corrections.assign(granularity=granularity, bucket=bucket_start(corrections["timestamp"], granularity))
+            for granularity in GRANULARITIES
+        ])
+        return samples, adjustments.groupby(KEY_COLUMNS, sort=False)["volume"].sum()
+
+    def _adjust_volume(self, merged: pd.DataFrame, adjustments: pd.Series) -> pd.DataFrame:
+        """Adds the volume corrections of _late_increments to the merged candles or the stored ones."""
+        in_merged = adjustments.index.isin(merged.index)
+        merged.loc[adjustments.index[in_merged], "volume"] += adjustments[in_merged].to_numpy()
+        others = adjustments[~in_merged]
+        if others.empty:
+            return merged
+        stored = self.open.reindex(others.index)
+        missing = stored["open"].isna().to_numpy()
+        if missing.any():
+            stored = pd.concat([stored[~missing], self._closed_candles(others.index[missing])]).reindex(others.index)
+        stored = stored[stored["open"].notna()].copy()
+        stored["volume"] = stored["volume"].astype("float64") + others.reindex(stored.index).to_numpy()
+        return pd.concat([merged, stored[VALUE_COLUMNS]])
+
+    def _partition_path(self, granularity: str, period: str) -> str:
+        return os.path.join(self.directory, granularity, f"{period}.parquet")
+
+    def _read_partition(self, granularity: str, period: str) -> pd.DataFrame:
+        """Closed candles of a partition, including the ones not written yet."""
+        frames = []
+        if self.directory is not None:
+            path = self._partition_path(granularity, period)
+            if os.path.exists(path):
+                frames.append(pd.read_parquet(path))
+        if (granularity, period) in self.closed:
+            frames.append(self.closed[(granularity, period)])
+        if not frames:
+            return _empty().reset_index()
+        return pd.concat(frames).drop_duplicates(KEY_COLUMNS, keep="last")
+
+    def _closed_candles(self, index: pd.MultiIndex) -> pd.DataFrame:
+        """Stored closed candles of the keys in `index` (late samples), indexed by KEY_COLUMNS."""
+        keys = index.to_frame(index=False)
+        frames = [
+            self._read_partition(granularity, period)
+            for granularity, period in zip(*_unique_partitions(keys))
+        ]
+        return pd.concat(frames).set_index(KEY_COLUMNS).reindex(index)
+
+    def update(self, samples: pd.DataFrame) -> pd.DataFrame:
+        """Merge a telemetry batch ("hostid", "pool", "timestamp", "used", "total") into the store.
+
+        Returns the candles created or modified by the batch.
+        """
+        if samples.empty:
+            return self.open.iloc[0:0].reset_index()
+        batch, adjustments = self._batch_candles(samples)
+        if batch.empty:
+            return self.open.iloc[0:0].reset_index()
+        old = self.open.reindex(batch.index)
+        # samples of a bucket older than the open candle of the pool belong to a closed candle
+        open_buckets = self.open.reset_index("bucket")["bucket"]
+        current = pd.to_datetime(open_buckets.reindex(batch.index.droplevel("bucket")).to_numpy())
+        late = np.asarray(batch.index.get_level_values("bucket") < current)
+        if late.any():
+            old = pd.concat([old[~late], self._closed_candles(batch.index[late])]).reindex(batch.index)
+        has_old = old["open"].notna()
+
+        merged = batch.copy()
+        # open stays fixed unless the batch brings an earlier sample for the bucket
+        keep_open = has_old & (old["first_ts"] <= batch["first_ts"])
+        merged["open"] = batch["open"].where(~keep_open, old["open"])
+        merged["first_ts"] = batch["first_ts"].where(~keep_open, old["first_ts"])
+        merged["high"] = batch["high"].where(~has_old, pd.concat([batch["high"], old["high"]], axis=1).max(axis=1))
+        merged["low"] = batch["low"].where(~has_old, pd.concat([batch["low"], old["low"]], axis=1).min(axis=1))
+        # close is replaced unless the batch only contains samples older than the stored close
+        keep_close = has_old & (old["last_ts"] > batch["last_ts"])
+        merged["close"] = batch["close"].where(~keep_close, old["close"])
+        merged["total"] = batch["total"].where(~keep_close, old["total"])
+        merged["last_ts"] = batch["last_ts"].where(~keep_close, old["last_ts"])
+        merged["volume"] = batch["volume"] + old["volume"].fillna(0.0)
+        merged["samples"] = batch["samples"] + old["samples"].fillna(0).astype("int64")
+        if adjustments is not None:
+            merged = self._adjust_volume(merged, adjustments)
+
+        # only the series of the batch can open or close a candle
+        touched = self.open.index.droplevel("bucket").isin(merged.index.droplevel("bucket"))
+        candidates = pd.concat([self.open[touched & ~self.open.index.isin(merged.index)], merged[VALUE_COLUMNS]])
+        new_open, closed = _split_open(candidates)
+        self.open = pd.concat([self.open[~touched], new_open])
+        if not closed.empty:
+            for (granularity, period), rows in closed.groupby([closed["granularity"], _periods(closed)], sort=False):
+                pending = self.closed.get((granularity, period))
+                rows = rows if pending is None else pd.concat([pending, rows]).drop_duplicates(KEY_COLUMNS, keep="last")
+                self.closed[(granularity, period)] = rows
+        self._frame = None
+        return merged.reset_index()
+
+    def _prune(self):
+        """Deletes the partitions whose whole period is older than the retention of their granularity."""
+        if self.open.empty:
+            return
+        newest = self.open.reset_index().groupby("granularity")["bucket"].max()
+        for granularity, days in RETENTION_DAYS.items():
+            if days is None or granularity not in newest.index:
+                continue
+            cutoff = pd.Timestamp(newest[granularity]) - pd.Timedelta(days=days)
+            fmt, length = PARTITIONS[granularity]
+            for period in self._stored_periods(granularity):
+                if pd.Timestamp(pd.to_datetime(period, format=fmt)) + length <= cutoff:
+                    os.remove(self._partition_path(granularity, period))
+
+    def _stored_periods(self, granularity: str) -> list:
+        folder = os.path.join(self.directory, granularity)
+        if not os.path.isdir(folder):
+            return []
+        return sorted(name[:-len(".parquet")] for name in os.listdir(folder) if name.endswith(".parquet"))
+
+    def frame(self, granularity: Optional[str] = None) -> pd.DataFrame:
+        """
+        Open and closed candles, indexed by KEY_COLUMNS; reads every stored partition of
+        `granularity` (all granularities when None).
+        """
+        granularities = GRANULARITIES if granularity is None else [granularity]
+        frames = []
+        for g in granularities:
+            periods = set(self._stored_periods(g)) if self.directory is not None else set()
+            periods |= {period for (pending_g, period) in self.closed if pending_g == g}
+            frames.extend(self._read_partition(g, period) for period in sorted(periods))
+        open_rows = self.open[self.open.index.get_level_values("granularity").isin(granularities)]
+        frames.append(open_rows.reset_index())
+        frames = [f for f in frames if not f.empty]
+        if not frames:
+            return _empty()
+        return pd.concat(frames).drop_duplicates(KEY_COLUMNS, keep="last").set_index(KEY_COLUMNS).sort_index()
+
+    @property
+    def candles(self) -> pd.DataFrame:
+        """All the candles (see frame()), kept until the next update."""
+        if self._frame is None:
+            self._frame = self.frame()
+        return self._frame
+
+    def get(
+        self,
+        hostid: str,
+        pool: str,
+        granularity: str = "1d",
+        start: Optional[str] = None,
+        end: Optional[str] = None,
+    ) -> pd.DataFrame:
+        """Candles of one pool as an mplfinance-ready frame (Open/High/Low/Close/Volume, DatetimeIndex)."""
+        key = (hostid, pool, granularity)
+        if self.candles.empty or key not in self.candles.index.droplevel("bucket"):
+            return pd.DataFrame(columns=["Open", "High", "Low", "Close", "Volume"])
+        candles = self.candles.loc[key]
+        if start is not None:
+            candles = candles[candles.index >= pd.Timestamp(start)]
+        if end is not None:
+            candles = candles[candles.index <= pd.Timestamp(end)]
+        ohlc = candles[["open", "high", "low", "close", "volume"]].astype("float64")
+        ohlc.columns = ["Open", "High", "Low", "Close", "Volume"]
+        ohlc.index.name = "timestamp"
+        return ohlc
+
+    def save(self, state_dir: str):
+        """Writes the partitions of the candles closed since the last save, then the open candles."""
+        self.directory = os.path.join(state_dir, CANDLES_DIR)
+        for (granularity, period) in list(self.closed):
+            rows = self._read_partition(granularity, period)
+            path = self._partition_path(granularity, period)
+            utils.create_dir(os.path.dirname(path))
+            tmp_path = f"{path}.tmp"
+            rows.sort_values(KEY_COLUMNS).to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, path)
+            del self.closed[(granularity, period)]
+        utils.create_dir(self.directory)
+        path = os.path.join(self.directory, OPEN_FILE)
+        tmp_path = f"{path}.tmp"
+        self.open.reset_index().to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+        utils.write_state(self.last_used, os.path.join(state_dir, "candles_last_used.json"))
+        self._prune()
+
+    @classmethod
+    def load(cls, state_dir: str) -> "CandleStore":
+        directory = os.path.join(state_dir, CANDLES_DIR)
+        last_used = utils.read_state(os.path.join(state_dir, "candles_last_used.json"))
+        path = os.path.join(directory, OPEN_FILE)
+        open_candles = None
+        if os.path.exists(path):
+            try:
+                open_candles = pd.read_parquet(path).set_index(KEY_COLUMNS)
+            except Exception as e:
+                logging.error(f"Error reading candles from {path}: {e}")
+        store = cls(open_candles, last_used, directory)
+        legacy_path = os.path.join(state_dir, LEGACY_CANDLES_FILE)
+        if open_candles is None and os.path.exists(legacy_path):
+            store._migrate(legacy_path, state_dir)
+        return store
+
+    def _migrate(self, legacy_path: str, state_dir: str):
+        """Splits the single Parquet file of the previous versions into open candles and partitions."""
+        try:
+            candles = pd.read_parquet(legacy_path).set_index(KEY_COLUMNS)
+        except Exception as e:
+            logging.error(f"Error reading candles from {legacy_path}: {e}")
+            return
+        self.open, closed = _split_open(candles)
+        for key, rows in closed.groupby([closed["granularity"], _periods(closed)], sort=False):
+            self.closed[key] = rows
+        self.save(state_dir)
+        os.remove(legacy_path)
+        logging.info(f"Candles: {legacy_path} split into {self.directory}")
+
+
+def candle_documents(candles: pd.DataFrame) -> list:
+    """Converts candles (as returned by CandleStore.update) to (doc_id, document) pairs for Firestore."""
+    documents = []
+    for row in candles.to_dict("records"):
+        bucket = row["bucket"].strftime("%Y-%m-%d %H:%M:%S")
+        doc_id = f"{row['hostid']}_{row['pool']}_{row['granularity']}_{bucket.replace(' ', '_').replace(':', '-')}"
+        documents.append((doc_id, utils.numpy_to_python({
+            "hostid": row["hostid"],
+            "pool": row["pool"],
+            "granularity": row["granularity"],
+            "bucket": bucket,
+            "open": row["open"],
+            "high": row["high"],
+            "low": row["low"],
+            "close": row["close"],
+            "volume": row["volume"],
+            "total_space": row["total"],
+            "samples": row["samples"],
+            "last_date": row["last_ts"].strftime("%Y-%m-%d %H:%M:%S"),
+        })))
+    return documents
@@ -0,0 +1,369 @@
+"""
+Headless chart rendering for reports.
+
+Charts are drawn on a bare matplotlib Figure with the Agg canvas (pyplot is never imported, so
+there is no GUI backend and no global figure state) and returned as PNG/SVG bytes. Per-point
+artists are avoided: the increment fill is one PolyCollection per color and the candlestick
+bodies/wicks are a PolyCollection and a LineCollection.
+
+ChartRenderer renders many charts concurrently on a process pool and keeps a file cache keyed on
+the chart kind, format and a hash of the data, so unchanged pools are not redrawn. Running this
+module builds the scheduled PDF report of all hosts from the local state (candles and state
+vectors written by main.py).
+"""
+import os
+import io
+import hashlib
+import logging
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Literal, Optional
+
+import numpy as np
+import pandas as pd
+
+import utils
+
+ChartFormat = Literal["png", "svg"]
+
+CACHE_DIR = os.path.join("state", "chart_cache")
+REPORT_FILE = "capacity_report.pdf"
+FIGSIZE = (12, 6)
+DPI = 100
+# fill colors of the increment plot: growth, decrease, stable
+FILL_COLORS = {"Growth": "green", "Decrease": "red", "Stable": "blue"}
+
+
+def _new_figure(figsize=FIGSIZE):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=figsize, dpi=DPI)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def _to_bytes(fig, fmt: ChartFormat) -> bytes:
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def fill_increments(ax, timestamps, increments, alpha: float = 0.3):
+    """
+    Fills the area under each segment of the increment line, green when the segment grows,
+    red when it decreases and blue when it is stable: one PolyCollection per color.
+    """
+    from matplotlib import dates as mdates
+    from matplotlib.collections import PolyCollection
+
+    x = mdates.date2num(pd.to_datetime(pd.Series(timestamps)).to_numpy())
+    y = np.asarray(increments, dtype="float64")
+    if len(x) < 2:
+        return
+    x0, x1, y0, y1 = x[:-1], x[1:], y[:-1], y[1:]
+    zeros = np.zeros_like(x0)
+    # segment i -> quad (x0, 0), (x0, y0), (x1, y1), (x1, 0)
+    quads = np.stack(
+        [np.column_stack([x0, zeros]), np.column_stack([x0, y0]),
+         np.column_stack([x1, y1]), np.column_stack([x1, zeros])],
+        axis=1,
+    )
+    slope = np.sign(y1 - y0)
+    for label, mask in (("Growth", slope > 0), ("Decrease", slope < 0), ("Stable", slope == 0)):
+        if mask.any():
+            ax.add_collection(PolyCollection(
+                quads[mask], facecolors=FILL_COLORS[label], edgecolors="none", alpha=alpha, label=label
+            ))
+    ax.autoscale_view()
+
+
+def render_lineplot(timestamps, increments, fmt: ChartFormat = "png", title: str = "State Vector Increments Over Time") -> bytes:
+    """Line plot of the increments with colored areas (StateVector.state_vector_lineplot)."""
+    fig = _new_figure()
+    ax = fig.add_subplot()
+    fill_increments(ax, timestamps, increments)
+    ax.plot(pd.to_datetime(pd.Series(timestamps)).to_numpy(), np.asarray(increments, dtype="float64"),
+            label="Increment", color="black", linewidth=1)
+    ax.set_xlabel("Timestamp")
+    ax.set_ylabel("Increment (Normalized Change)")
+    ax.set_title(title)
+    ax.legend(loc="upper left")
+    ax.grid(True, linestyle="--", alpha=0.7)
+    fig.tight_layout()
+    return _to_bytes(fig, fmt)
+
+
+def render_usage_donut(results: dict, fmt: ChartFormat = "png", title: Optional[str] = None,
+                       colors=None, labels=None) -> bytes:
+    """Donut of the state vector percentages (StateVector.plot_usage_analysis)."""
+    colors = colors or ["green", "red", "yellow"]
+    labels = labels or ["Writed", "Deleted", "Readed"]
+    sizes = [results.get("Percentage Written", 0), results.get("Percentage Deleted", 0), results.get("Percentage Read", 0)]
+    fig = _new_figure(figsize=(6, 6))
+    ax = fig.add_subplot()
+    if sum(sizes) > 0:
+        ax.pie(sizes, labels=labels, colors=colors, wedgeprops=dict(width=0.3))
+        ax.legend(loc="upper right")
+    ax.set_aspect("equal")
+    ax.set_title(title or "Usage Distribution")
+    fig.tight_layout()
+    return _to_bytes(fig, fmt)
+
+
+def render_candlestick(ohlc: pd.DataFrame, fmt: ChartFormat = "png", title: str = "State Vector Candlestick Chart",
+                       ylabel: str = "Space (TB)") -> bytes:
+    """
+    Candlestick chart of an Open/High/Low/Close(/Volume) frame with a DatetimeIndex,
+    e.g. candles.CandleStore.get. Bodies and wicks are drawn as two collections.
+    """
+    from matplotlib import dates as mdates
+    from matplotlib.collections import LineCollection, PolyCollection
+
+    fig = _new_figure()
+    has_volume = "Volume" in ohlc.columns
+    if has_volume:
+        ax, ax_volume = fig.subplots(2, 1, sharex=True, gridspec_kw={"height_ratios": [3, 1]})
+    else:
+        ax, ax_volume = fig.add_subplot(), None
+
+    if not ohlc.empty:
+        x = mdates.date2num(pd.DatetimeIndex(ohlc.index).to_numpy())
+        width = 0.6 * (np.min(np.diff(x)) if len(x) > 1 else 1.0)
+        o, h, l, c = (ohlc[col].to_numpy(dtype="float64") for col in ("Open", "High", "Low", "Close"))
+        colors = np.where(c >= o, "green", "red")
+        ax.add_collection(LineCollection(np.stack([np.column_stack([x, l]), np.column_stack([x, h])], axis=1),
+                                         colors=colors, linewidths=1))
+        bottom, top = np.minimum(o, c), np.maximum(o, c)
+        left, right = x - width / 2, x + width / 2
+        bodies = np.stack([np.column_stack([left, bottom]), np.column_stack([left, top]),
+                           np.column_stack([right, top]), np.column_stack([right, bottom])], axis=1)
+        ax.add_collection(PolyCollection(bodies, facecolors=colors, edgecolors=colors))
+        ax.autoscale_view()
+        if ax_volume is not None:
+            ax_volume.bar(x, ohlc["Volume"].to_numpy(dtype="float64"), width=width, color=colors)
+            ax_volume.set_ylabel("Volume")
+        (ax_volume or ax).xaxis_date()
+
+    ax.set_title(title)
+    ax.set_ylabel(ylabel)
+    ax.grid(True, linestyle="--", alpha=0.7)
+    fig.autofmt_xdate()
+    fig.tight_layout()
+    return _to_bytes(fig, fmt)
+
+
+RENDERERS = {
+    "lineplot": lambda data, fmt, options: render_lineplot(data["timestamp"], data["increment"], fmt, **options),
+    "donut": lambda data, fmt, options: render_usage_donut(data, fmt, **options),
+    "candlestick": lambda data, fmt, options: render_candlestick(data, fmt, **options),
+}
+
+
+def render_chart(kind: str, data, fmt: ChartFormat = "png", **options) -> bytes:
+    """Renders a chart of the given kind ("lineplot", "donut", "candlestick") to bytes."""
+    if kind not in RENDERERS:
+        raise ValueError(f"Unsupported chart kind: {kind}")
+    return RENDERERS[kind](data, fmt, options)
+
+
+def data_version(data) -> str:
+    """Content hash of the chart data, used as the cache version."""
+    digest = hashlib.sha1()
+    if isinstance(data, pd.DataFrame):
+        digest.update(",".join(map(str, data.columns)).encode())
+        digest.update(pd.util.hash_pandas_object(data, index=True).to_numpy().tobytes())
+    else:
+        digest.update(repr(sorted(data.items()) if isinstance(data, dict) else data).encode())
+    return digest.hexdigest()
+
+
+@dataclass
+class ChartJob:
+    key: str
+    kind: str
+    data: object
+    fmt: ChartFormat = "png"
+    options: dict = field(default_factory=dict)
+
+    def cache_name(self) -> str:
+        version = data_version(self.data)
+        options = hashlib.sha1(repr(sorted(self.options.items())).encode()).hexdigest()[:8]
+        return f"{self.kind}-{version}-{options}.{self.fmt}"
+
+
+def _render_job(kind: str, data, fmt: ChartFormat, options: dict) -> bytes:
+    return render_chart(kind, data, fmt, **options)
+
+
+class ChartRenderer:
+    """Renders chart jobs on a process pool, reusing cached bytes for unchanged data."""
+
+    def __init__(self, cache_dir: Optional[str] = CACHE_DIR, max_workers: Optional[int] = None):
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers or os.cpu_count() or 1
+        if cache_dir:
+            utils.create_dir(cache_dir)
+
+    def _cache_path(self, job: ChartJob) -> Optional[str]:
+        return os.path.join(self.cache_dir, job.cache_name()) if self.cache_dir else None
+
+    def render_all(self, jobs: List[ChartJob]) -> Dict[str, bytes]:
+        """Returns the rendered bytes of every job by job.key."""
+        rendered, pending = {}, []
+        for job in jobs:
+            path = self._cache_path(job)
+            if path and os.path.exists(path):
+                with open(path, "rb") as f:
+                    rendered[job.key] = f.read()
+            else:
+                pending.append((job, path))
+        logging.info(f"Charts: {len(rendered)} cached, {len(pending)} to render")
+        if not pending:
+            return rendered
+
+        # spawn: workers do not inherit the parent's threads (e.g. Firestore clients)
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=min(self.max_workers, len(pending)), mp_context=context) as executor:
+            futures = [
+                (job, path, executor.submit(_render_job, job.kind, job.data, job.fmt, job.options))
+                for job, path in pending
+            ]
+            for job, path, future in futures:
+                try:
+                    content = future.result()
+                except Exception as e:
+                    logging.error(f"Error rendering chart {job.key}: {e}")
+                    continue
+                rendered[job.key] = content
+                if path:
+                    tmp_path = f"{path}.tmp"
+                    with open(tmp_path, "wb") as f:
+                        f.write(content)
+                    os.replace(tmp_path, path)
+        return rendered
+
+
+def report_jobs(store, df_sv: pd.DataFrame, granularity: str = "1d") -> List[ChartJob]:
+    """
+    Chart jobs of the capacity report: for every pool the candlestick of `granularity` candles
+    (candles.CandleStore, GB converted to TB), the increments of the hourly candles and the
+    donut of its longest state vector timeframe.
+    """
+    jobs = []
+    if not store.candles.empty:
+        pools = store.candles.index.droplevel(["granularity", "bucket"]).unique()
+        for hostid, pool in pools:
+            ohlc = store.get(hostid, pool, granularity) / 1000
+            if not ohlc.empty:
+                jobs.append(ChartJob(f"{hostid}|{pool}|candlestick", "candlestick", ohlc,
+                                     options={"title": f"{hostid} {pool} ({granularity})"}))
+            try:
+                hourly = store.candles.loc[(hostid, pool, "1h")]
+            except KeyError:
+                continue
+            if len(hourly) > 1:
+                increments = pd.DataFrame({
+                    "timestamp": hourly.index,
+                    "increment": (hourly["volume"] / hourly["total"]).to_numpy(dtype="float64"),
+                })
+                jobs.append(ChartJob(f"{hostid}|{pool}|lineplot", "lineplot", increments,
+                                     options={"title": f"{hostid} {pool} hourly increments"}))
+    if not df_sv.empty:
+        longest = df_sv[df_sv["Timeframe Days"] == df_sv["Timeframe Days"].max()]
+        for row in longest.to_dict("records"):
+            results = {k: row[k] for k in ("Percentage Written", "Percentage Deleted", "Percentage Read")}
+            jobs.append(ChartJob(
+                f"{row['Host ID']}|{row['Pool']}|donut", "donut", results,
+                options={"title": f"{row['Host ID']} {row['Pool']} last {int(row['Timeframe Days'] * 24)} hours"},
+            ))
+    return jobs
+
+
+def write_pdf_report(charts: Dict[str, bytes], output_path: str, title: str = "Capacity report") -> int:
+    """
+    Writes PNG charts to a PDF, one page per host with its charts stacked in key order.
+    Keys are "<hostid>|<pool>|<kind>". Returns the number of pages.
+    """
+    from matplotlib import image as mimage
+    from matplotlib.backends.backend_pdf import PdfPages
+
+    by_host: Dict[str, List[str]] = {}
+    for key in sorted(charts):
+        by_host.setdefault(key.split("|", 1)[0], []).append(key)
+    if not by_host:
+        logging.warning(f"No charts to write to {output_path}")
+        return 0
+
+    tmp_path = f"{output_path}.tmp"
+    with PdfPages(tmp_path) as pdf:
+        for hostid, keys in by_host.items():
+            fig = _new_figure(figsize=(8.27, max(2.5 * len(keys), 3)))
+            fig.suptitle(f"{title} – {hostid}")
+            for i, key in enumerate(keys):
+                ax = fig.add_subplot(len(keys), 1, i + 1)
+                ax.imshow(mimage.imread(io.BytesIO(charts[key]), format="png"))
+                ax.set_axis_off()
+            pdf.savefig(fig)
+    os.replace(tmp_path, output_path)
+    return len(by_host)
+
+
+def report_state_dirs(state_dir: str, shards: Optional[int] = None) -> List[str]:
+    """
+    State folders holding the candles and state vectors: the shard folders of main.py with
+    SHARDS > 1 (state/shards_<N>/<i>), otherwise `state_dir`. Without `shards` the most recently
+    written shards_<N> is used, if any.
+    """
+    import sharding
+
+    if shards is None:
+        candidates = [
+            os.path.join(state_dir, name) for name in os.listdir(state_dir)
+            if name.startswith("shards_") and name[len("shards_"):].isdigit()
+        ] if os.path.isdir(state_dir) else []
+        if not candidates:
+            return [state_dir]
+        shards = int(os.path.basename(max(candidates, key=os.path.getmtime))[len("shards_"):])
+    if shards <= 1:
+        return [state_dir]
+    return [path for path in (sharding.shard_state_dir(state_dir, shards, shard) for shard in range(shards))
+            if os.path.isdir(path)]
+
+
+def generate_report(state_dir: str, output_path: str, max_workers: Optional[int] = None,
+                    cache_dir: Optional[str] = None, shards: Optional[int] = None) -> int:
+    """
+    Builds the PDF report of all hosts from the candles and state vectors in `state_dir`, or in
+    its shard folders (see report_state_dirs).
+    """
+    from candles import CandleStore
+    from state_vector import StateVectorMaintainer
+
+    jobs = []
+    for directory in report_state_dirs(state_dir, shards):
+        store = CandleStore.load(directory)
+        df_sv = StateVectorMaintainer.load(os.path.join(directory, "state_vectors")).results()
+        # a pool always lands in the same shard, so the job keys do not collide
+        jobs.extend(report_jobs(store, df_sv))
+    renderer = ChartRenderer(cache_dir or os.path.join(state_dir, "chart_cache"), max_workers)
+    charts = renderer.render_all(jobs)
+    pages = write_pdf_report(charts, output_path)
+    logging.info(f"Report {output_path} written ({len(charts)} charts, {pages} hosts)")
+    return pages
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render the capacity report of all hosts")
+    parser.add_argument("--state-dir", default=os.path.join(os.getcwd(), "state"))
+    parser.add_argument("--output", default=REPORT_FILE)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--cache-dir", default=None)
+    parser.add_argument("--shards", type=int, default=None,
+                        help="SHARDS of main.py (default: the most recently written shard folders)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    generate_report(args.state_dir, args.output, args.workers, args.cache_dir, args.shards)
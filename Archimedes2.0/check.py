@@ -2,10 +2,13 @@
 """
 print_latest_date_by_group.py
 
-Questo script si connette a Firestore, carica i documenti dalla collection "capacity_trends"
-e, per ogni combinazione di hostid e pool, recupera l'ultimo documento (basato sul campo "date_dt")
-e aggiorna, nella collection "system_data", il campo "last_date" del documento corrispondente
-salvandolo come stringa nel formato "YYYY-MM-DD HH:MM:SS".
+Questo script si connette a Firestore e, per ogni combinazione di hostid e pool, recupera l'ultima
+data di "capacity_trends" e aggiorna, nella collection "system_data", il campo "last_date" del
+documento corrispondente salvandolo come stringa nel formato "YYYY-MM-DD HH:MM:SS".
+
+L'ultima data è letta dall'indice per pool "capacity_trends_latest". Se l'indice è vuoto si usa
+una scansione proiettata della collection; le pool mancanti da un indice parziale sono lette una
+per una.
 
 Utilizzo:
     python print_latest_date_by_group.py
@@ -16,8 +19,9 @@ import logging
 from datetime import datetime
 
 import pandas as pd
-from firebase_admin import credentials, firestore, initialize_app
-import firebase_admin
+
+import clients
+import fs
 
 # Configura il logger
 logging.basicConfig(
@@ -25,80 +29,41 @@ logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
+# Campi letti da capacity_trends (proiezione lato server)
+LOAD_FIELDS = ["hostid", "pool", "date"]
+# Indice per pool con l'ultima data scritta in capacity_trends (mantenuto da main.py)
+LATEST_INDEX_COLLECTION = "capacity_trends_latest"
+UPDATE_WORKERS = 8
+# oltre questo numero di pool assenti dall'indice, una scansione proiettata costa meno delle query per pool
+MAX_PER_POOL_QUERIES = 200
+
 def connect_firestore():
     """
-    Stabilisce la connessione a Firestore cercando le credenziali nella variabile d'ambiente
-    FIRESTORE_CREDENTIALS_PATH oppure nel file "credentials.json" (o nella cartella "secrets").
-    
+    Stabilisce la connessione a Firestore tramite la factory condivisa clients.get_firestore_client,
+    che cerca le credenziali nella variabile d'ambiente FIRESTORE_CREDENTIALS_PATH oppure
+    nel file "credentials.json" (nella directory corrente o nella cartella "secrets").
+
     Ritorna:
         db: il client Firestore
     """
-    cred_path = os.environ.get("FIRESTORE_CREDENTIALS_PATH")
-    if cred_path and os.path.exists(cred_path):
-        logging.info("Using FIRESTORE_CREDENTIALS_PATH from environment: %s", cred_path)
-    else:
-        base_dir = os.getcwd()
-        cred_path = os.path.join(base_dir, "credentials.json")
-        if not os.path.exists(cred_path):
-            cred_path = os.path.join(base_dir, "secrets", "credentials.json")
-    if not os.path.exists(cred_path):
-        raise FileNotFoundError(
-            "File delle credenziali non trovato. Verifica FIRESTORE_CREDENTIALS_PATH o la presenza di 'credentials.json' in directory o in 'secrets'."
-        )
-    
-    try:
-        cred = credentials.Certificate(cred_path)
-    except Exception as e:
-        logging.error("Errore nel caricamento delle credenziali: %s", e)
-        raise e
-
-    if not firebase_admin._apps:
-        initialize_app(cred)
-        logging.info("Firebase Admin inizializzato")
-    else:
-        logging.info("Firebase Admin già inizializzato")
-
-    db = firestore.client()
+    db = clients.get_firestore_client(os.getcwd())
+    # budget di letture / scritture / cancellazioni (FIRESTORE_MAX_*, vedi firestore_usage.py)
+    clients.firestore_usage.configure(os.environ)
     logging.info("Connessione a Firestore stabilita")
     return db
 
 def load_capacity_trends(db, collection_name="capacity_trends"):
     """
-    Scarica tutti i documenti dalla collezione specificata e li trasforma in un DataFrame.
-    
-    Si assume che ogni documento contenga almeno i seguenti campi:
-        - "date"    : stringa, es. "2025-04-10 19:46:44"
-        - "hostid"  : stringa, es. "3caf01f0"
-        - "pool"    : stringa, es. "sp0"
-        - "date_dt" : stringa oppure oggetto datetime (se non è datetime, viene convertito)
-    
+    Scarica dalla collezione specificata solo i campi necessari e li trasforma in un DataFrame.
+
+    La lettura usa il loader condiviso fs.load_collection: proiezione lato server con select()
+    sui campi "hostid", "pool" e "date", paginazione con cursori start_after e conversione
+    vettoriale di "date" (formato "YYYY-MM-DD HH:MM:SS") nella colonna "date_dt".
+    I documenti con data non convertibile vengono scartati.
+
     Viene aggiunto il campo "doc_id" per poter tenere traccia dell'ID del documento.
     """
-    docs = list(db.collection(collection_name).stream())
-    records = []
-    for doc in docs:
-        data = doc.to_dict()
-        data["doc_id"] = doc.id
-        # Converti "date_dt" se necessario; se non esiste, usa "date"
-        if "date_dt" in data:
-            try:
-                if not isinstance(data["date_dt"], datetime):
-                    data["date_dt"] = datetime.strptime(data["date_dt"], "%Y-%m-%d %H:%M:%S")
-            except Exception:
-                try:
-                    data["date_dt"] = datetime.strptime(data["date"], "%Y-%m-%d %H:%M:%S")
-                except Exception as e:
-                    logging.error("Errore di conversione data per il documento %s: %s", doc.id, e)
-                    continue
-        else:
-            try:
-                data["date_dt"] = datetime.strptime(data["date"], "%Y-%m-%d %H:%M:%S")
-            except Exception as e:
-                logging.error("Errore di conversione data per il documento %s: %s", doc.id, e)
-                continue
-        records.append(data)
-    
-    df = pd.DataFrame(records)
+    df = fs.load_collection(db, collection_name, fields=LOAD_FIELDS)
     logging.info("Scaricati %d documenti dalla collezione '%s'.", len(df), collection_name)
     return df
 
@@ -119,11 +84,71 @@ def format_date_as_string(date_value):
         # Se la conversione fallisce, restituisci comunque il valore originale
         return date_value
 
-def update_system_data_from_capacity_trends(db, df: pd.DataFrame):
+def load_latest_date_of_pool(db, hostid, pool) -> pd.DataFrame:
+    """
+    Ultimo documento di capacity_trends di una pool (query hostid + pool ordinata per data
+    decrescente, indice composito in firestore.indexes.json): una sola lettura.
+    """
+    query = (
+        db.collection("capacity_trends")
+        .where("hostid", "==", hostid)
+        .where("pool", "==", pool)
+        .order_by("date", direction="DESCENDING")
+        .limit(1)
+    )
+    records = [snap.to_dict() or {} for snap in query.stream()]
+    df = pd.DataFrame({col: [record.get(col) for record in records] for col in LOAD_FIELDS})
+    df["date_dt"] = pd.to_datetime(df["date"], format=fs.DATE_FORMAT, errors="coerce")
+    return df[df["date_dt"].notna()]
+
+def load_latest_dates(db, pools=None):
+    """
+    Restituisce un DataFrame con l'ultima data per ogni (hostid, pool), colonne "hostid", "pool",
+    "date" e "date_dt".
+
+    La fonte principale è l'indice per pool LATEST_INDEX_COLLECTION, mantenuto da main.py
+    (un documento per pool). Se l'indice è vuoto, ad esempio prima del primo ciclo di main.py
+    che lo popola, si ricade sulla scansione proiettata di "capacity_trends".
+    Le pool di `pools` (coppie (hostid, pool), ad esempio quelle di system_data) assenti da un
+    indice parziale vengono lette una per una con load_latest_date_of_pool, oppure con la
+    scansione se sono più di MAX_PER_POOL_QUERIES.
+    """
+    df = fs.load_collection(db, LATEST_INDEX_COLLECTION, fields=["hostid", "pool", "last_date"], date_column="last_date")
+    if df.empty:
+        logging.info("Indice '%s' vuoto: uso la scansione di capacity_trends.", LATEST_INDEX_COLLECTION)
+        return load_capacity_trends(db, collection_name="capacity_trends")
+    logging.info("Letto l'indice '%s': %d pool.", LATEST_INDEX_COLLECTION, len(df))
+    df = df.rename(columns={"last_date": "date"})
+
+    missing = sorted(set(pools or ()) - set(zip(df["hostid"], df["pool"])))
+    if not missing:
+        return df
+    logging.warning(
+        "%d pool di system_data assenti dall'indice '%s': ultima data letta da capacity_trends.",
+        len(missing), LATEST_INDEX_COLLECTION,
+    )
+    if len(missing) > MAX_PER_POOL_QUERIES:
+        scanned = load_capacity_trends(db, collection_name="capacity_trends")
+        missing_keys = pd.MultiIndex.from_tuples(missing)
+        fallback = [scanned[pd.MultiIndex.from_arrays([scanned["hostid"], scanned["pool"]]).isin(missing_keys)]]
+    else:
+        fallback = [load_latest_date_of_pool(db, hostid, pool) for hostid, pool in missing]
+    return pd.concat([df, *fallback], ignore_index=True)
+
+def load_system_data(db) -> pd.DataFrame:
+    """Scansione proiettata di "system_data" (hostid, pool, last_date e doc_id)."""
+    return fs.load_collection(db, "system_data", fields=["hostid", "pool", "last_date"], date_column=None)
+
+def update_system_data_from_capacity_trends(db, df: pd.DataFrame, workers: int = UPDATE_WORKERS,
+                                            system_df: pd.DataFrame = None):
     """
     Raggruppa il DataFrame per hostid e pool, identifica per ciascun gruppo l'ultimo documento (basato su date_dt)
     e aggiorna nella collection "system_data" il campo "last_date" dei documenti che corrispondono alla stessa combinazione.
     Assicura che il valore salvato sia una stringa nel formato corretto.
+
+    I documenti di "system_data" (`system_df`, altrimenti letti con un'unica scansione proiettata)
+    vengono abbinati in memoria; si aggiornano solo quelli con last_date diverso, con WriteBatch
+    eseguiti in parallelo.
     """
     if df.empty:
         logging.info("Nessun documento da elaborare in capacity_trends.")
@@ -131,33 +156,41 @@ def update_system_data_from_capacity_trends(db, df: pd.DataFrame):
 
     # Raggruppa per hostid e pool e trova l'indice del documento con il massimo date_dt per ciascun gruppo.
     latest_docs = df.loc[df.groupby(["hostid", "pool"])["date_dt"].idxmax()]
-
-    for idx, row in latest_docs.iterrows():
-        hostid = row.get("hostid")
-        pool = row.get("pool")
-        new_last_date = row.get("date")
-        # Assicura che la data sia una stringa formattata correttamente
-        formatted_date = format_date_as_string(new_last_date)
-        logging.info("Ultimo documento per Hostid: %s, Pool: %s -> last_date = %s", hostid, pool, formatted_date)
-
-        # Cerca nella collection "system_data" i documenti con lo stesso hostid e pool
-        system_docs = db.collection("system_data") \
-                        .where("hostid", "==", hostid) \
-                        .where("pool", "==", pool) \
-                        .stream()
-
-        updated_any = False
-        for doc in system_docs:
-            try:
-                db.collection("system_data").document(doc.id).update({"last_date": formatted_date})
-                logging.info("Aggiornato documento [%s] in system_data per Hostid: %s, Pool: %s con last_date: %s",
-                             doc.id, hostid, pool, formatted_date)
-                updated_any = True
-            except Exception as e:
-                logging.error("Errore aggiornando il documento system_data %s: %s", doc.id, e)
-
-        if not updated_any:
-            logging.info("Nessun documento in system_data trovato per Hostid: %s, Pool: %s", hostid, pool)
+    latest_by_pool = {
+        (hostid, pool): format_date_as_string(date)
+        for hostid, pool, date in zip(latest_docs["hostid"], latest_docs["pool"], latest_docs["date"])
+    }
+
+    if system_df is None:
+        system_df = load_system_data(db)
+    updates = []
+    matched_pools = set()
+    matched_docs = 0
+    for doc_id, hostid, pool, last_date in zip(
+        system_df["doc_id"], system_df["hostid"], system_df["pool"], system_df["last_date"]
+    ):
+        formatted_date = latest_by_pool.get((hostid, pool))
+        if formatted_date is None:
+            continue
+        matched_docs += 1
+        matched_pools.add((hostid, pool))
+        if last_date != formatted_date:
+            updates.append((doc_id, formatted_date))
+
+    for hostid, pool in latest_by_pool.keys() - matched_pools:
+        logging.info("Nessun documento in system_data trovato per Hostid: %s, Pool: %s", hostid, pool)
+
+    system_ref = db.collection("system_data")
+    updated = fs.commit_in_batches(
+        db,
+        updates,
+        lambda batch, item: batch.update(system_ref.document(item[0]), {"last_date": item[1]}),
+        max_workers=workers,
+    )
+    logging.info(
+        "Aggiornati %d documenti in system_data (%d già allineati, %d senza date in capacity_trends).",
+        updated, matched_docs - len(updates), len(system_df) - matched_docs,
+    )
 
 def main():
     try:
@@ -166,8 +199,17 @@ def main():
         logging.error("Errore nella connessione a Firestore: %s", e)
         return
 
-    df = load_capacity_trends(db, collection_name="capacity_trends")
-    update_system_data_from_capacity_trends(db, df)
+    system_df = load_system_data(db)
+    # solo le pool senza "/" hanno documenti in capacity_trends (i dataset sono in capacity_trends_dataset)
+    pools = {
+        (hostid, pool) for hostid, pool in zip(system_df.get("hostid", []), system_df.get("pool", []))
+        if isinstance(pool, str) and "/" not in pool
+    }
+    df = load_latest_dates(db, pools)
+    update_system_data_from_capacity_trends(db, df, system_df=system_df)
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    finally:
+        clients.firestore_usage.log_summary()
@@ -0,0 +1,100 @@
+import os
+import logging
+import threading
+from typing import Optional
+
+from firestore_usage import CountingClient, FirestoreUsage
+
+# firebase_admin is imported on first use so that importing this module stays cheap
+
+_firestore_lock = threading.Lock()
+_firestore_client = None
+_emulator_client = None
+# operations made through the Firestore client of this process (see firestore_usage.py)
+firestore_usage = FirestoreUsage()
+
+
+def get_credentials_path(main_dir: str) -> str:
+    """
+    Determines the credentials file path by checking:
+      1. If the environment variable FIRESTORE_CREDENTIALS_PATH is set and exists.
+      2. If the "credentials.json" file exists in the main directory.
+      3. If the "credentials.json" file exists in the 'secrets' subfolder.
+    Raises an exception if the file is not found.
+    """
+    # 1. Check environment variable
+    cred_env = os.environ.get("FIRESTORE_CREDENTIALS_PATH")
+    if cred_env and os.path.exists(cred_env):
+        return cred_env
+
+    # 2. Check if file exists in the main directory
+    local_path = os.path.join(main_dir, "credentials.json")
+    if os.path.exists(local_path):
+        return local_path
+
+    # 3. Check if file exists in the 'secrets' folder
+    secrets_path = os.path.join(main_dir, "secrets", "credentials.json")
+    if os.path.exists(secrets_path):
+        return secrets_path
+
+    raise FileNotFoundError(
+        "credentials.json file not found. Check if FIRESTORE_CREDENTIALS_PATH is set or if the file exists in the main directory or in 'secrets/credentials.json'."
+    )
+
+
+def get_firestore_client(main_dir: Optional[str] = None, cred_path: Optional[str] = None):
+    """
+    Returns the process-wide Firestore client, initializing firebase_admin on the first call.
+    The credentials are `cred_path` if given, otherwise they are looked up with get_credentials_path.
+    Every operation made through the client is counted in `firestore_usage`.
+    """
+    global _firestore_client
+    with _firestore_lock:
+        if _firestore_client is not None:
+            return _firestore_client
+
+        import firebase_admin
+        from firebase_admin import credentials, firestore
+
+        if not firebase_admin._apps:
+            cred_path = cred_path or get_credentials_path(main_dir or os.getcwd())
+            firebase_admin.initialize_app(credentials.Certificate(cred_path))
+            logging.info(f"Firebase Admin initialized with {cred_path}")
+        _firestore_client = CountingClient(firestore.client(), firestore_usage)
+        return _firestore_client
+
+
+def get_firestore_emulator_client(host: str, project: str):
+    """
+    Returns a Firestore client connected to the emulator at `host` ("localhost:8080"), without
+    credentials. Its operations are counted in `firestore_usage` like the production client.
+    """
+    global _emulator_client
+    with _firestore_lock:
+        if _emulator_client is None:
+            from google.cloud import firestore
+
+            os.environ["FIRESTORE_EMULATOR_HOST"] = host
+            _emulator_client = CountingClient(firestore.Client(project=project), firestore_usage)
+            logging.info(f"Firestore emulator client for project {project} at {host}")
+        return _emulator_client
+
+
+def get_merlin_connection(config: dict):
+    """
+    Opens a connection to the Merlin database configured in `config` (DATABASE_TYPE, ENVIRONMENT
+    and the driver specific keys). Returns the MerlinDB model and the DB-API connection.
+    """
+    from db import MerlinDB
+
+    db_type = config.get("DATABASE_TYPE").lower()
+    environment = config.get("ENVIRONMENT").lower()
+    match db_type:
+        case "oci" | "alloydb" | "mysql":
+            merlin_db = MerlinDB(environment=environment, db_type=db_type)
+            db_conn = merlin_db.setup_connection(config)
+            merlin_db._set_environment_options()
+            return merlin_db, db_conn
+        case _:
+            logging.error("Database type not supported")
+            raise ValueError("Fatal error: Database connection not defined")
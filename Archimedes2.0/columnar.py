@@ -0,0 +1,117 @@
+"""
+Shared columnar telemetry store behind the Pool, Dataset and AireUnit models.
+
+The telemetry is sorted once by (hostid, pool, time) and kept as one contiguous numpy array per
+column. Every pool and dataset is a (start, stop) range of rows, so a Pool is a zero-copy slice of
+the shared arrays instead of its own DataFrame. hostid and pool are stored once per range, not
+per row. A nested dict indexes the fleet as unit -> hostid -> pool -> datasets.
+"""
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+KEY_COLUMNS = ["hostid", "pool"]
+
+
+def base_pool(pool: str) -> str:
+    """"sp0/ds" -> "sp0"."""
+    return pool.split("/", 1)[0]
+
+
+def default_unit_id(hostid: str, pool: str) -> str:
+    """unit_id assigned by results.systems_data_table to a pool and its datasets."""
+    return f"{hostid}-{base_pool(pool)}"
+
+
+class TelemetryTable:
+    """Telemetry of the whole fleet, sorted by (hostid, pool, time), with row ranges per pool."""
+
+    def __init__(self, df: pd.DataFrame, time_column: str = "editdate", unit_ids: Optional[Dict[Tuple[str, str], str]] = None):
+        """
+        Args:
+            df (pd.DataFrame): Raw telemetry with "hostid", "pool" and `time_column`.
+            time_column (str): Column used to order the samples of each pool (parsed as datetime).
+            unit_ids (dict, optional): (hostid, pool) -> unit_id, e.g. from the systems_data table.
+                Pools not in the mapping get default_unit_id.
+        """
+        valid = df["hostid"].notna() & df["pool"].notna()
+        if not valid.all():
+            logging.warning(f"TelemetryTable: dropped {int((~valid).sum())} rows without hostid/pool")
+            df = df[valid]
+
+        host_codes, hosts = pd.factorize(df["hostid"].astype(str))
+        pool_codes, pools = pd.factorize(df["pool"].astype(str))
+        times = pd.to_datetime(df[time_column], errors="coerce").to_numpy()
+        order = np.lexsort((times, pool_codes, host_codes))
+
+        self.time_column = time_column
+        self.columns: Dict[str, np.ndarray] = {time_column: np.ascontiguousarray(times[order])}
+        for name in df.columns:
+            if name not in KEY_COLUMNS and name != time_column:
+                self.columns[name] = np.ascontiguousarray(df[name].to_numpy()[order])
+
+        host_codes, pool_codes = host_codes[order], pool_codes[order]
+        n = len(order)
+        starts = np.flatnonzero(
+            np.r_[True, (host_codes[1:] != host_codes[:-1]) | (pool_codes[1:] != pool_codes[:-1])]
+        ) if n else np.array([], dtype=np.int64)
+        stops = np.r_[starts[1:], n].astype(np.int64)
+
+        self.offsets: Dict[Tuple[str, str], Tuple[int, int]] = {}
+        self.hierarchy: Dict[str, Dict[str, Dict[str, List[str]]]] = {}
+        # (hostid, base pool) -> unit_id, for O(1) lookups from a pool back into the hierarchy
+        self.unit_of: Dict[Tuple[str, str], str] = {}
+        unit_ids = unit_ids or {}
+        for start, stop in zip(starts.tolist(), stops.tolist()):
+            hostid, pool = hosts[host_codes[start]], pools[pool_codes[start]]
+            self.offsets[(hostid, pool)] = (start, stop)
+            base = base_pool(pool)
+            unit = self.unit_of.get((hostid, base))
+            if unit is None:
+                unit = self.unit_of[(hostid, base)] = unit_ids.get((hostid, base), default_unit_id(hostid, pool))
+            datasets = self.hierarchy.setdefault(unit, {}).setdefault(hostid, {}).setdefault(base, [])
+            if pool != base:
+                datasets.append(pool)
+
+    def __len__(self) -> int:
+        return len(self.columns[self.time_column])
+
+    def __contains__(self, key: Tuple[str, str]) -> bool:
+        return key in self.offsets
+
+    def rows(self, hostid: str, pool: str) -> Tuple[int, int]:
+        """(start, stop) row range of a pool or dataset; KeyError if it has no telemetry."""
+        return self.offsets[(hostid, pool)]
+
+    def column(self, name: str, start: int, stop: int) -> np.ndarray:
+        """View (no copy) of a column over a row range."""
+        return self.columns[name][start:stop]
+
+    def view(self, start: int, stop: int, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """DataFrame over a row range whose columns share memory with the table."""
+        names = columns or list(self.columns)
+        return pd.DataFrame({name: self.columns[name][start:stop] for name in names}, copy=False)
+
+    def pool_keys(self) -> pd.DataFrame:
+        """All (hostid, pool) pairs of the table, datasets included."""
+        return pd.DataFrame(list(self.offsets), columns=KEY_COLUMNS)
+
+    def units(self) -> List[str]:
+        return list(self.hierarchy)
+
+    def hosts(self, unit_id: str) -> Dict[str, Dict[str, List[str]]]:
+        """hostid -> base pool -> datasets of a unit."""
+        return self.hierarchy.get(unit_id, {})
+
+    def datasets(self, hostid: str, pool: str) -> List[str]:
+        """Datasets ("pool/...") of a base pool."""
+        unit = self.unit_of.get((hostid, base_pool(pool)))
+        if unit is None:
+            return []
+        return self.hierarchy[unit][hostid][base_pool(pool)]
+
+    def nbytes(self) -> int:
+        """Memory of the column arrays (object columns count their pointers only)."""
+        return sum(values.nbytes for values in self.columns.values())
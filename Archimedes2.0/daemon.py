@@ -0,0 +1,111 @@
+"""
+Long-running mode of main.py (--daemon).
+
+The Merlin connection, the Firestore client and the per-stage state objects stay in memory between
+iterations. Each iteration only polls MAX(id) of the telemetry table and runs the pipeline when new
+rows arrived. The poll interval follows the arrival rate: it is the time needed for about
+TARGET_ROWS new rows at the observed (EWMA) rate, it doubles while nothing arrives and it is
+always kept between the configured minimum and maximum. SIGTERM / SIGINT stop the loop after the
+running iteration has completed, so the state files and LAST_ID are always consistent.
+"""
+import logging
+import signal
+import threading
+import time
+from typing import Optional
+
+import utils
+
+MIN_INTERVAL_SECONDS = 5.0
+MAX_INTERVAL_SECONDS = 300.0
+TARGET_ROWS = 5000
+IDLE_BACKOFF = 2.0
+RATE_ALPHA = 0.3
+
+
+class AdaptivePoller:
+    """Poll interval from the observed telemetry arrival rate (rows per second)."""
+
+    def __init__(self, min_interval: float = MIN_INTERVAL_SECONDS, max_interval: float = MAX_INTERVAL_SECONDS,
+                 target_rows: int = TARGET_ROWS):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_rows = target_rows
+        self.interval = min_interval
+        self.rate: Optional[float] = None
+        self.last_poll: Optional[float] = None
+
+    @classmethod
+    def from_config(cls, config: dict) -> "AdaptivePoller":
+        return cls(
+            float(config.get("DAEMON_MIN_INTERVAL", MIN_INTERVAL_SECONDS)),
+            float(config.get("DAEMON_MAX_INTERVAL", MAX_INTERVAL_SECONDS)),
+            int(config.get("DAEMON_TARGET_ROWS", TARGET_ROWS)),
+        )
+
+    def next_interval(self, new_rows: int, now: Optional[float] = None) -> float:
+        """Seconds until the next poll, given the rows that arrived since the previous one."""
+        now = time.monotonic() if now is None else now
+        elapsed = None if self.last_poll is None else max(now - self.last_poll, 1e-3)
+        self.last_poll = now
+        if new_rows <= 0:
+            self.interval = min(self.interval * IDLE_BACKOFF, self.max_interval)
+            return self.interval
+        if elapsed is not None:
+            rate = new_rows / elapsed
+            self.rate = rate if self.rate is None else RATE_ALPHA * rate + (1 - RATE_ALPHA) * self.rate
+        if self.rate:
+            self.interval = self.target_rows / self.rate
+        self.interval = min(max(self.interval, self.min_interval), self.max_interval)
+        return self.interval
+
+
+def run_daemon(runner, session, poller: AdaptivePoller):
+    """
+    Runs `runner.run()` whenever MAX(id) moved past LAST_ID, and `runner.check_inactivity()` on the
+    other polls, until SIGTERM / SIGINT. The poller gets the growth of MAX(id) between polls, so a
+    backlog left by a failed cycle does not count as new arrivals again.
+
+    Args:
+        runner (main.Main): Pipeline, with `session` set so the connection is reused.
+        session (db.MerlinSession): Connection used for the MAX(id) poll.
+        poller (AdaptivePoller): Interval policy.
+    """
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        logging.info(f"Signal {signum} received, stopping after the current iteration")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    iteration = 0
+    previous_max_id = None
+    while not stop.is_set():
+        max_id = session.max_id()
+        # backlog: rows not processed yet; arrived: rows added since the previous poll (the rate)
+        backlog = arrived = 0
+        if max_id is not None:
+            backlog = max(max_id - int(utils.read_last_id(runner.last_id_path) or 0), 0)
+            arrived = backlog if previous_max_id is None else max(max_id - previous_max_id, 0)
+            previous_max_id = max_id
+        if backlog > 0:
+            iteration += 1
+            try:
+                runner.run()
+            except Exception as e:
+                logging.error(f"Error during iteration {iteration}: {e}")
+                # the state kept warm may hold the half-applied batch: the next cycle reloads it from disk
+                runner.drop_warm_state()
+        else:
+            # without new rows run() is not called: the inactivity alerts are still checked
+            try:
+                runner.check_inactivity()
+            except Exception as e:
+                logging.error(f"Error checking pool inactivity: {e}")
+        interval = poller.next_interval(arrived)
+        logging.info(f"Daemon: {arrived} new rows, {backlog} to process, next poll in {interval:.1f} s")
+        stop.wait(interval)
+    session.reset()
+    logging.info(f"Daemon stopped after {iteration} iterations")
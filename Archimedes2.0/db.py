@@ -1,13 +1,15 @@
-import oracledb as oci
 import os
 import pandas as pd
 from pydantic import BaseModel, Field
-import psycopg2
 from dotenv import dotenv_values
 import logging
-import pymysql
+from typing import Optional
 
 import utils
+import clients
+
+# Database drivers (oracledb, pymysql, psycopg2) are imported by the connection method that
+# needs them, so a run only loads the driver of the configured DATABASE_TYPE
 
 class MerlinDB(BaseModel):
     environment: str = Field(..., description="Configuration values from the .env file")
@@ -46,6 +48,8 @@ class MerlinDB(BaseModel):
     
     def connect_MySQL(self):
         """Connect to MySQL database using PyMySQL."""
+        import pymysql
+
         try:
             db_conn = pymysql.connect(
                 host=self.db_host,
@@ -61,6 +65,8 @@ class MerlinDB(BaseModel):
 
     def connect_to_OCI(self):
         """Connect to Oracle database using oracledb."""
+        import oracledb as oci
+
         try:
             dsn = oci.makedsn(
                 host=self.db_host,
@@ -110,22 +116,45 @@ class MerlinDB(BaseModel):
             logging.error(f"Error retrieving companies data: {e}")
             return None
         
+    def get_max_id(self, db_conn) -> Optional[int]:
+        """Highest telemetry id (index lookup only, cheap enough to poll)."""
+        cursor = db_conn.cursor()
+        try:
+            cursor.execute("SELECT MAX(id) FROM telemetry.stats_metrics")
+            max_id_result = cursor.fetchone()
+            return int(max_id_result[0]) if max_id_result and max_id_result[0] is not None else None
+        finally:
+            cursor.close()
+
+    def get_telemetry_range(self, db_conn, start_id: int, end_id: int) -> pd.DataFrame:
+        """Telemetry rows with start_id < id <= end_id (a primary key range scan), ordered by id."""
+        cursor = db_conn.cursor()
+        try:
+            cursor.execute(
+                f"SELECT hostid, name AS pool, editdate, ref_time, avail, used, usedsnap AS snap, ratio "
+                f"FROM telemetry.stats_metrics "
+                f"WHERE id > {int(start_id)} AND id <= {int(end_id)} ORDER BY id;"
+            )
+            rows = cursor.fetchall()
+            columns = [desc[0] for desc in cursor.description]
+            return pd.DataFrame(rows, columns=columns)
+        finally:
+            cursor.close()
+
     def update_telemetry(self, db_conn, last_id: str):
         """
         Retrieve telemetry data using a dynamic LIMIT calculated based on the difference
         between the maximum id in the table and the provided last_id.
         Returns a tuple: (DataFrame, new_last_id)
         """
-        cursor = db_conn.cursor()
-        
-        cursor.execute("SELECT MAX(id) FROM telemetry.stats_metrics")
-        max_id_result = cursor.fetchone()
-        new_last_id = max_id_result[0] if max_id_result and max_id_result[0] is not None else int(last_id)
+        max_id = self.get_max_id(db_conn)
+        new_last_id = max_id if max_id is not None else int(last_id)
         
         limit_value = new_last_id - int(last_id)
         if limit_value <= 0:
             return pd.DataFrame(), new_last_id
 
+        cursor = db_conn.cursor()
         query = (
             f"SELECT hostid, name AS pool, editdate, ref_time, avail, used, usedsnap AS snap, ratio "
             f"FROM telemetry.stats_metrics "
@@ -158,43 +187,88 @@ class MerlinDB(BaseModel):
                 self.debug_active = True
 
 
+class MerlinSession:
+    """
+    Merlin connection kept open across the iterations of the daemon mode.
+    The connection is opened on first use and reopened after a failed query.
+    """
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.merlin_db: Optional[MerlinDB] = None
+        self.db_conn = None
+
+    def connection(self):
+        if self.db_conn is None:
+            self.merlin_db, self.db_conn = clients.get_merlin_connection(self.config)
+            if self.db_conn is None:
+                raise ConnectionError("Merlin database connection failed")
+        return self.merlin_db, self.db_conn
+
+    def max_id(self) -> Optional[int]:
+        """MAX(id) of the telemetry table, None if the database is unreachable."""
+        try:
+            merlin_db, db_conn = self.connection()
+            return merlin_db.get_max_id(db_conn)
+        except Exception as e:
+            logging.error(f"Error polling MAX(id): {e}")
+            self.reset()
+            return None
+
+    def reset(self):
+        if self.db_conn is not None:
+            try:
+                self.db_conn.close()
+            except Exception:
+                pass
+        self.merlin_db, self.db_conn = None, None
+
+
 def create_connection(config: dict, last_id_path: str):
     """
     Define the connection to the Merlin database by reading LAST_ID from the specified file.
     """
-    db_type = config.get("DATABASE_TYPE").lower()
-    environment = config.get("ENVIRONMENT").lower()
     # Read the LAST_ID value from the file
     last_id = utils.read_last_id(last_id_path)
-    match db_type:
-        case "oci" | "alloydb" | "mysql":
-            merlin_db = MerlinDB(environment=environment, db_type=db_type)
-            db_conn = merlin_db.setup_connection(config)
-            merlin_db._set_environment_options()
-            return merlin_db, db_conn, last_id
-        case _:
-            logging.error("Database type not supported")
-            raise ValueError("Fatal error: Database connection not defined")
-
-
-def connect_merlindb(config: dict, last_id_path: str = "last_id.txt"):
+    merlin_db, db_conn = clients.get_merlin_connection(config)
+    return merlin_db, db_conn, last_id
+
+
+def connect_merlindb(config: dict, last_id_path: str = "last_id.txt", session: Optional[MerlinSession] = None):
+    """
+    Reads companies and the new telemetry rows. With a `session` its connection is reused and
+    left open, otherwise a connection is opened and closed for this call.
+    LAST_ID is not written here: the caller advances it to the returned id once the batch has been
+    processed, so a batch whose processing fails is read again by the next cycle.
+    Returns (companies, telemetry, new_last_id); new_last_id is None when the read failed.
+    """
     db_conn = None
-    companies_df, telemetry_df = None, None
+    companies_df, telemetry_df, new_last_id = None, None, None
     try: 
-        merlin_db, db_conn, last_id = create_connection(config, last_id_path)
-        companies_df = merlin_db.get_companies_data(db_conn)
-        telemetry_df, new_last_id = merlin_db.update_telemetry(db_conn, last_id)
-        utils.update_last_id(new_last_id, last_id_path)
+        if session is not None:
+            merlin_db, conn = session.connection()
+            last_id = utils.read_last_id(last_id_path)
+        else:
+            merlin_db, db_conn, last_id = create_connection(config, last_id_path)
+            conn = db_conn
+        telemetry_df, new_last_id = merlin_db.update_telemetry(conn, last_id)
+        # without new telemetry the cycle is a no-op: the companies query is not needed
+        if telemetry_df is not None and not telemetry_df.empty:
+            companies_df = merlin_db.get_companies_data(conn)
     except Exception as e:
         logging.error(f"Error connecting to Merlin database: {e}")
+        if session is not None:
+            session.reset()
     finally:
         if db_conn:
             db_conn.close()
-        return companies_df, telemetry_df
+        return companies_df, telemetry_df, new_last_id
 
 
 # FUNCTION FOR TESTS
-def debug_oci_connection(conn: oci.Connection):
+def debug_oci_connection(conn: "oracledb.Connection"):
+    import oracledb as oci
+
     try:
         if conn:
             return conn.cursor()
@@ -202,7 +276,9 @@ def debug_oci_connection(conn: oci.Connection):
         logging.error(f"Connection failed: {e}")
     return False
 
-def debug_alloydb_connection(conn: psycopg2.extensions.connection):
+def debug_alloydb_connection(conn: "psycopg2.extensions.connection"):
+    import psycopg2
+
     try:
         if conn and conn.status == psycopg2.extensions.STATUS_READY:
             return conn.cursor()
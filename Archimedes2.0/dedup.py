@@ -0,0 +1,113 @@
+"""
+Cross-cycle deduplication of the capacity_trends samples.
+
+results.capacity_trends_table drops the samples with the same (day, hostid, perc_snap, pool, snap)
+within a batch. DedupIndex drops, across cycles, the samples already written with the same values:
+the key also holds perc_used, used and total_space, so a pool that grows (or is resized) later in
+the same day is still written, while a sample re-fetched after a LAST_ID rollback, or reported
+again unchanged, is not. The index keeps, for every day, the sorted 64-bit hashes
+(pd.util.hash_pandas_object) of the keys already written. A batch is hashed once and each row is
+looked up with a vectorized binary search in the array of its day, before stage 5 uploads it.
+
+Only the last DEDUP_DAYS days (counted from the newest day seen) are kept, and at most
+DEDUP_MAX_KEYS hashes in total (the oldest days are dropped first). This bounds the index to
+8 bytes per key. The index is persisted as .npz in the state folder.
+"""
+import logging
+import os
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+import utils
+
+KEY_COLUMNS = ["day", "hostid", "perc_snap", "pool", "snap", "perc_used", "used", "total_space"]
+DEDUP_DAYS = 7
+DEDUP_MAX_KEYS = 5_000_000
+
+_EMPTY = np.empty(0, dtype=np.uint64)
+
+
+def key_hashes(df: pd.DataFrame) -> np.ndarray:
+    """uint64 hash of the dedup key of every row."""
+    if df.empty:
+        return _EMPTY
+    return pd.util.hash_pandas_object(df[KEY_COLUMNS], index=False).to_numpy(dtype=np.uint64)
+
+
+class DedupIndex:
+    """Sorted key hashes per day ("YYYY-mm-dd")."""
+
+    def __init__(self, days: Optional[Dict[str, np.ndarray]] = None, retention_days: int = DEDUP_DAYS,
+                 max_keys: int = DEDUP_MAX_KEYS):
+        self.days = days or {}
+        self.retention_days = retention_days
+        self.max_keys = max_keys
+
+    def seen(self, df: pd.DataFrame, hashes: Optional[np.ndarray] = None) -> np.ndarray:
+        """Boolean mask of the rows of `df` whose key is already in the index."""
+        hashes = key_hashes(df) if hashes is None else hashes
+        mask = np.zeros(len(df), dtype=bool)
+        if not self.days or df.empty:
+            return mask
+        days = df["day"].to_numpy()
+        for day in pd.unique(days):
+            known = self.days.get(day)
+            if known is None or not len(known):
+                continue
+            rows = np.flatnonzero(days == day)
+            positions = np.searchsorted(known, hashes[rows]).clip(max=len(known) - 1)
+            mask[rows] = known[positions] == hashes[rows]
+        return mask
+
+    def filter(self, df: pd.DataFrame) -> pd.DataFrame:
+        """The rows of `df` not written in a previous cycle."""
+        mask = self.seen(df)
+        if mask.any():
+            logging.info(f"Dedup: skipped {int(mask.sum())} samples already written in previous cycles")
+        return df[~mask]
+
+    def add(self, df: pd.DataFrame):
+        """Records the keys of the written rows, then drops the days out of retention."""
+        if df.empty:
+            return
+        hashes = key_hashes(df)
+        days = df["day"].to_numpy()
+        for day in pd.unique(days):
+            new = hashes[days == day]
+            known = self.days.get(day)
+            self.days[day] = np.unique(new) if known is None else np.union1d(known, new)
+        self.rotate()
+
+    def rotate(self):
+        if not self.days:
+            return
+        ordered = sorted(self.days)
+        first_kept = (pd.Timestamp(ordered[-1]) - pd.Timedelta(days=self.retention_days - 1)).strftime("%Y-%m-%d")
+        kept = [day for day in ordered if day >= first_kept]
+        total = sum(len(self.days[day]) for day in kept)
+        while len(kept) > 1 and total > self.max_keys:
+            total -= len(self.days[kept[0]])
+            kept.pop(0)
+        self.days = {day: self.days[day] for day in kept}
+
+    def save(self, file_path: str):
+        utils.create_dir(os.path.dirname(file_path) or ".")
+        tmp_path = f"{file_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **self.days)
+        os.replace(tmp_path, file_path)
+
+    @classmethod
+    def load(cls, file_path: str, retention_days: int = DEDUP_DAYS, max_keys: int = DEDUP_MAX_KEYS) -> "DedupIndex":
+        days = {}
+        if os.path.exists(file_path):
+            try:
+                with np.load(file_path) as data:
+                    days = {day: data[day].astype(np.uint64) for day in data.files}
+            except Exception as e:
+                logging.error(f"Error reading the dedup index from {file_path}: {e}")
+        index = cls(days, retention_days, max_keys)
+        index.rotate()
+        return index
@@ -7,10 +7,14 @@ Questo script si connette a Firestore e applica la logica di "clean capacity tre
   il record il cui "perc_used" è il più vicino alla media giornaliera.
 - Per i dati della settimana precedente (>= one_week_ago): per ogni combinazione hostid e pool,
   ordina i record per data e mantiene solo i record in cui "perc_used" varia di almeno 0.01
-  rispetto al record precedente mantenuto.
+  rispetto al record precedente mantenuto. La stessa regola è applicata in scrittura da main.py
+  (results.compact_capacity_trends), quindi qui resta solo per i documenti scritti senza compattazione.
 
-Vengono eliminati da Firestore i documenti che non risultano nella versione pulita.
-Le informazioni sui documenti eliminati vengono salvate in un file Parquet in modo incrementale.
+Vengono eliminati da Firestore i documenti che non risultano nella versione pulita, con WriteBatch
+da 500 operazioni eseguiti in parallelo. Le informazioni sui documenti eliminati vengono salvate come
+checkpoint Parquet incrementali: se il run si interrompe, il successivo riprende il piano rimasto.
+I documenti con il campo expireAt (scritti da main.py con FIRESTORE_TTL=True) vengono ignorati:
+la loro scadenza è gestita dalla TTL policy di Firestore (vedi retention.py).
 
 Utilizzo:
     python firestore_capacity_trends_cleanup.py
@@ -18,99 +22,80 @@ Utilizzo:
 
 
 import os
+import time
 import logging
 import argparse
 from datetime import datetime, timedelta
 
 import pandas as pd
-from firebase_admin import credentials, firestore, initialize_app
-import firebase_admin
 import pyarrow as pa
 import pyarrow.parquet as pq
 
+import clients
+import fs
+import archive
+from results import PERC_USED_MIN_CHANGE
+
 # Configura il logger
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
-# Definisco il path del file Parquet per salvare i documenti eliminati
+# Directory Parquet (un file per checkpoint) con i documenti eliminati
 PARQUET_FILE = "deleted_docs.parquet"
+# Piano di cancellazione del run in corso: se presente all'avvio, il run precedente è stato interrotto
+PENDING_FILE = "deleted_docs.pending.parquet"
+AUDIT_SCHEMA = pa.schema([
+    ("doc_id", pa.string()),
+    ("deleted_at", pa.string()),
+    ("run_id", pa.string()),
+])
+# Campi letti da capacity_trends (proiezione lato server)
+LOAD_FIELDS = ["date", "day", "hostid", "pool", "perc_used", "expireAt"]
+CHECKPOINT_ROWS = 5000
+DELETE_WORKERS = 8
 
 def connect_firestore():
     """
-    Stabilisce la connessione a Firestore.
-    Cerca le credenziali nella variabile d'ambiente FIRESTORE_CREDENTIALS_PATH oppure
+    Stabilisce la connessione a Firestore tramite la factory condivisa clients.get_firestore_client,
+    che cerca le credenziali nella variabile d'ambiente FIRESTORE_CREDENTIALS_PATH oppure
     nel file "credentials.json" (nella directory corrente o nella cartella "secrets").
-    
+
     Ritorna:
         db: il client Firestore
     """
-    cred_path = os.environ.get("FIRESTORE_CREDENTIALS_PATH")
-    if cred_path and os.path.exists(cred_path):
-        logging.info("Using FIRESTORE_CREDENTIALS_PATH from environment: %s", cred_path)
-    else:
-        base_dir = os.getcwd()
-        cred_path = os.path.join(base_dir, "credentials.json")
-        if not os.path.exists(cred_path):
-            cred_path = os.path.join(base_dir, "secrets", "credentials.json")
-    if not os.path.exists(cred_path):
-        raise FileNotFoundError(
-            "Credentials file not found. Controlla FIRESTORE_CREDENTIALS_PATH o la presenza di 'credentials.json' in directory o in 'secrets'."
-        )
-    
-    try:
-        cred = credentials.Certificate(cred_path)
-    except Exception as e:
-        logging.error("Errore nel caricamento delle credenziali: %s", e)
-        raise e
-
-    if not firebase_admin._apps:
-        initialize_app(cred)
-        logging.info("Firebase Admin inizializzato")
-    else:
-        logging.info("Firebase Admin già inizializzato")
-    
-    db = firestore.client()
+    db = clients.get_firestore_client(os.getcwd())
+    # budget di letture / scritture / cancellazioni (FIRESTORE_MAX_*, vedi firestore_usage.py)
+    clients.firestore_usage.configure(os.environ)
     logging.info("Connessione a Firestore stabilita")
     return db
 
-
-def load_capacity_trends(db, collection_name="capacity_trends"):
+def load_capacity_trends(db, collection_name="capacity_trends", fields=None):
     """
-    Scarica tutti i documenti dalla collezione e li trasforma in un DataFrame.
+    Scarica dalla collezione solo i campi usati dalla logica di pulizia e li trasforma in un DataFrame.
+
+    La lettura usa il loader condiviso fs.load_collection (select() sui campi di LOAD_FIELDS,
+    paginazione con cursori start_after, memoria limitata alla dimensione della pagina).
+    Con `fields` si può estendere la proiezione, ad es. ai campi da archiviare prima della cancellazione.
     
     Si assume che ogni documento contenga i seguenti campi:
         - "date"       : stringa, ad es. "2025-04-10 19:46:44"
         - "hostid"     : stringa, ad es. "3caf01f0"
         - "pool"       : stringa, ad es. "sp0"
-        - "perc_snap"  : numero (float)
         - "perc_used"  : numero (float)
-        - "snap"       : numero (float)
-        - "total_space": numero (float)
-        - "unit_id"    : stringa, ad es. "3caf01f0-sp0"
-        - "used"       : numero (float)
         - "day"        : stringa, ad es. "2025-04-10"
     
     Vengono aggiunte anche colonne derivate:
-        - "date_dt"    : datetime ottenuto da "date"
+        - "doc_id"     : ID del documento
+        - "date_dt"    : datetime ottenuto da "date" (conversione vettoriale)
     """
-    docs = list(db.collection(collection_name).stream())
-    records = []
-    for doc in docs:
-        data = doc.to_dict()
-        data["doc_id"] = doc.id  # conserva l'ID per riferimento
-        try:
-            dt = datetime.strptime(data["date"], "%Y-%m-%d %H:%M:%S")
-        except Exception as e:
-            logging.error("Errore nella conversione della data per il documento %s: %s", doc.id, e)
-            continue
-        data["date_dt"] = dt
+    fields = list(dict.fromkeys(LOAD_FIELDS + list(fields or [])))
+    df = fs.load_collection(db, collection_name, fields=fields)
+    if not df.empty:
         # Se il campo "day" non esiste, lo creiamo dalla data
-        if "day" not in data or not data["day"]:
-            data["day"] = dt.strftime("%Y-%m-%d")
-        records.append(data)
-    df = pd.DataFrame(records)
+        missing_day = df["day"].isna() | (df["day"] == "")
+        df.loc[missing_day, "day"] = df.loc[missing_day, "date_dt"].dt.strftime("%Y-%m-%d")
     logging.info("Scaricati %d documenti dalla collezione '%s'.", len(df), collection_name)
     return df
 
@@ -159,8 +144,8 @@ def clean_capacity_trends(df: pd.DataFrame) -> pd.DataFrame:
                 kept.append(row)
                 last_kept_value = row["perc_used"]
             else:
-                # Mantieni il record solo se la variazione è >= 0.01
-                if abs(row["perc_used"] - last_kept_value) >= 0.01:
+                # Mantieni il record solo se la variazione è >= PERC_USED_MIN_CHANGE
+                if abs(row["perc_used"] - last_kept_value) >= PERC_USED_MIN_CHANGE:
                     kept.append(row)
                     last_kept_value = row["perc_used"]
         return pd.DataFrame(kept)
@@ -180,60 +165,170 @@ def clean_capacity_trends(df: pd.DataFrame) -> pd.DataFrame:
     return df_clean
 
 
-def delete_unwanted_docs(db, df_original: pd.DataFrame, df_clean: pd.DataFrame, collection_name="capacity_trends"):
+def _migrate_legacy_audit_file(audit_path: str = PARQUET_FILE):
+    """
+    Le versioni precedenti scrivevano un unico file Parquet (troncato a ogni run).
+    Se lo troviamo, lo spostiamo dentro la nuova directory di checkpoint.
     """
-    Confronta l'elenco degli ID dei documenti originali con quelli del DataFrame pulito.
-    Elimina da Firestore i documenti il cui ID non è presente in df_clean.
+    if os.path.isfile(audit_path):
+        legacy_tmp = f"{audit_path}.legacy"
+        os.replace(audit_path, legacy_tmp)
+        os.makedirs(audit_path, exist_ok=True)
+        os.replace(legacy_tmp, os.path.join(audit_path, "part-legacy.parquet"))
+    os.makedirs(audit_path, exist_ok=True)
 
-    Durante la cancellazione, le informazioni dei documenti eliminati vengono
-    scritte in modo incrementale in un file Parquet per evitare l'accumulo in memoria.
-    
-    Ogni 500 eliminazioni viene stampato un messaggio in log.
+
+def _write_parquet_atomic(table: pa.Table, path: str):
+    """Scrive il file con un nome temporaneo nascosto e lo rinomina: un crash non lascia file corrotti."""
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_deleted_ids(run_id: str, audit_path: str = PARQUET_FILE) -> set:
     """
-    kept_ids = set(df_clean["doc_id"].tolist())
-    all_ids = set(df_original["doc_id"].tolist())
-    ids_to_delete = list(all_ids - kept_ids)
+    Restituisce gli ID già eliminati dal run `run_id`, letti solo dai suoi checkpoint
+    (part-<run_id>-*.parquet): l'audit dei run precedenti non viene riletto.
+    """
+    if not os.path.isdir(audit_path):
+        return set()
+    prefix = f"part-{run_id}-"
+    deleted = set()
+    for name in sorted(os.listdir(audit_path)):
+        if name.startswith(prefix) and name.endswith(".parquet"):
+            table = pq.read_table(os.path.join(audit_path, name), columns=["doc_id"])
+            deleted.update(table.column("doc_id").to_pylist())
+    return deleted
+
+
+def load_pending_plan(pending_path: str = PENDING_FILE) -> tuple:
+    """
+    Restituisce (run_id, ID) del piano di cancellazione lasciato da un run interrotto,
+    (None, []) se assente. I piani scritti dalle versioni precedenti non hanno run_id.
+    """
+    if not os.path.exists(pending_path):
+        return None, []
+    table = pq.read_table(pending_path)
+    run_ids = table.column("run_id").to_pylist() if "run_id" in table.column_names else []
+    return (run_ids[0] if run_ids else None), table.column("doc_id").to_pylist()
+
+
+def delete_doc_ids(
+    db,
+    ids_to_delete: list,
+    collection_name="capacity_trends",
+    batch_size=fs.MAX_BATCH_WRITES,
+    workers=DELETE_WORKERS,
+    audit_path=PARQUET_FILE,
+    pending_path=PENDING_FILE,
+    resume_run_id=None,
+):
+    """
+    Elimina gli ID indicati con WriteBatch da 500 operazioni eseguiti su un pool di thread.
+
+    Prima di iniziare, il piano di cancellazione viene salvato in `pending_path` insieme al suo
+    run_id. Con `resume_run_id` (ripresa del piano di un run interrotto) vengono saltati solo gli
+    ID già presenti nei checkpoint di quel run, così un documento ricreato in seguito con lo stesso
+    ID viene eliminato di nuovo. Ogni CHECKPOINT_ROWS eliminazioni confermate viene scritto un nuovo
+    file Parquet (doc_id, deleted_at, run_id) nella directory di audit. Le delete in Firestore
+    sono idempotenti, quindi rieseguire gli ultimi batch non ancora registrati è innocuo.
+    """
+    _migrate_legacy_audit_file(audit_path)
+    remaining = list(ids_to_delete)
+    if resume_run_id:
+        already_deleted = load_deleted_ids(resume_run_id, audit_path)
+        remaining = [doc_id for doc_id in ids_to_delete if doc_id not in already_deleted]
+        skipped = len(ids_to_delete) - len(remaining)
+        if skipped:
+            logging.info("Ripresa: %d documenti risultano già eliminati nei checkpoint del run %s.", skipped, resume_run_id)
+    if not remaining:
+        if os.path.exists(pending_path):
+            os.remove(pending_path)
+        logging.info("Nessun documento da eliminare nella collezione '%s'.", collection_name)
+        return 0
+
+    # il run ripreso continua con lo stesso run_id, così un'ulteriore interruzione riparte da qui
+    run_id = resume_run_id or datetime.now().strftime("%Y%m%d%H%M%S")
+    _write_parquet_atomic(
+        pa.table({
+            "doc_id": pa.array(remaining, pa.string()),
+            "run_id": pa.array([run_id] * len(remaining), pa.string()),
+        }),
+        pending_path,
+    )
+    collection_ref = db.collection(collection_name)
+    buffer = []
+    # in ripresa i nuovi checkpoint seguono quelli già scritti dal run
+    part_counter = sum(1 for name in os.listdir(audit_path) if name.startswith(f"part-{run_id}-"))
     deleted_count = 0
+    started = time.perf_counter()
+
+    def flush():
+        nonlocal buffer, part_counter
+        if not buffer:
+            return
+        table = pa.Table.from_pylist(buffer, schema=AUDIT_SCHEMA)
+        part_path = os.path.join(audit_path, f"part-{run_id}-{part_counter:05d}.parquet")
+        _write_parquet_atomic(table, part_path)
+        part_counter += 1
+        buffer = []
+        elapsed = time.perf_counter() - started
+        logging.info(
+            "Checkpoint: %d/%d documenti eliminati (%.1f delete/s)",
+            deleted_count, len(remaining), deleted_count / elapsed if elapsed > 0 else 0.0,
+        )
 
-    # Definisco lo schema per il file Parquet
-    schema = pa.schema([
-        ("doc_id", pa.string()),
-        ("deleted_at", pa.string())
-    ])
-
-    # Creo il writer per il file Parquet
-    writer = pq.ParquetWriter(PARQUET_FILE, schema)
-    batch = []  # batch temporaneo per accumulare record
-    batch_size = 500  # definisco la dimensione del batch
-
-    for doc_id in ids_to_delete:
-        try:
-            db.collection(collection_name).document(doc_id).delete()
-            deletion_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            batch.append({"doc_id": doc_id, "deleted_at": deletion_timestamp})
-            deleted_count += 1
-
-            if deleted_count % 500 == 0:
-                logging.info("HO ELIMINATO 500 DOCUMENTI")
-            
-            # Quando il batch raggiunge la dimensione definita, lo scrive sul file Parquet
-            if len(batch) >= batch_size:
-                df_batch = pd.DataFrame(batch)
-                table = pa.Table.from_pandas(df_batch, preserve_index=False)
-                writer.write_table(table)
-                batch = []  # svuota il batch
-                
-        except Exception as e:
-            logging.error("Errore nell'eliminazione del documento %s: %s", doc_id, e)
-    
-    # Se rimangono record nel batch, li scrivo
-    if batch:
-        df_batch = pd.DataFrame(batch)
-        table = pa.Table.from_pandas(df_batch, preserve_index=False)
-        writer.write_table(table)
-    writer.close()
+    def on_committed(chunk):
+        nonlocal deleted_count
+        deletion_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        buffer.extend({"doc_id": doc_id, "deleted_at": deletion_timestamp, "run_id": run_id} for doc_id in chunk)
+        deleted_count += len(chunk)
+        if len(buffer) >= CHECKPOINT_ROWS:
+            flush()
+
+    try:
+        fs.commit_in_batches(
+            db,
+            remaining,
+            lambda batch, doc_id: batch.delete(collection_ref.document(doc_id)),
+            batch_size=batch_size,
+            max_workers=workers,
+            on_committed=on_committed,
+        )
+    finally:
+        flush()
+
+    elapsed = time.perf_counter() - started
+    if deleted_count == len(remaining):
+        os.remove(pending_path)
+    else:
+        logging.warning(
+            "%d documenti non eliminati: il piano resta in '%s' per il prossimo run.",
+            len(remaining) - deleted_count, pending_path,
+        )
+    logging.info(
+        "Eliminazione completata: %d documenti eliminati dalla collezione '%s' in %.1fs (%.1f delete/s).",
+        deleted_count, collection_name, elapsed, deleted_count / elapsed if elapsed > 0 else 0.0,
+    )
+    return deleted_count
+
+
+def delete_unwanted_docs(db, df_original: pd.DataFrame, df_clean: pd.DataFrame, collection_name="capacity_trends",
+                         workers=DELETE_WORKERS, archive_root=archive.ARCHIVE_DIR):
+    """
+    Confronta l'elenco degli ID dei documenti originali con quelli del DataFrame pulito
+    ed elimina da Firestore, tramite delete_doc_ids, i documenti il cui ID non è presente in df_clean.
 
-    logging.info("Eliminazione completata: %d documenti eliminati dalla collezione '%s'.", deleted_count, collection_name)
+    Se `archive_root` è valorizzato, il contenuto completo dei documenti da eliminare viene prima
+    scritto nell'archivio Parquet locale (archive.archive_documents), partizionato per hostid e mese.
+    """
+    kept_ids = set(df_clean["doc_id"].tolist())
+    all_ids = set(df_original["doc_id"].tolist())
+    ids_to_delete = sorted(all_ids - kept_ids)
+    if archive_root and ids_to_delete:
+        df_to_archive = df_original[df_original["doc_id"].isin(ids_to_delete)]
+        archive.archive_documents(df_to_archive, archive_root)
+    return delete_doc_ids(db, ids_to_delete, collection_name, workers=workers)
 
 
 def main():
@@ -244,6 +339,22 @@ def main():
         "--collection", type=str, default="capacity_trends",
         help="Nome della collezione Firestore (default: capacity_trends)"
     )
+    parser.add_argument(
+        "--workers", type=int, default=DELETE_WORKERS,
+        help=f"Numero di batch eliminati in parallelo (default: {DELETE_WORKERS})"
+    )
+    parser.add_argument(
+        "--archive-dir", type=str, default=archive.ARCHIVE_DIR,
+        help=f"Archivio Parquet locale dei documenti eliminati (default: {archive.ARCHIVE_DIR})"
+    )
+    parser.add_argument(
+        "--no-archive", action="store_true",
+        help="Elimina i documenti senza archiviarli localmente"
+    )
+    parser.add_argument(
+        "--fresh", action="store_true",
+        help="Scarta il piano di un run interrotto invece di riprenderlo"
+    )
     args = parser.parse_args()
 
     try:
@@ -252,18 +363,41 @@ def main():
         logging.error("Errore nella connessione a Firestore: %s", e)
         return
 
-    # Carica i dati della collezione in un DataFrame
-    df_all = load_capacity_trends(db, args.collection)
+    # Riprende il piano di un run interrotto senza riscaricare la collezione
+    pending_run_id, pending_ids = load_pending_plan()
+    if pending_ids and args.fresh:
+        os.remove(PENDING_FILE)
+        pending_ids = []
+    if pending_ids:
+        logging.info("Trovato un run interrotto: riprendo %d cancellazioni pendenti.", len(pending_ids))
+        delete_doc_ids(db, pending_ids, args.collection, workers=args.workers, resume_run_id=pending_run_id)
+        return
+
+    archive_root = None if args.no_archive else args.archive_dir
+
+    # Carica i dati della collezione in un DataFrame (tutti i campi se vanno archiviati)
+    df_all = load_capacity_trends(db, args.collection, fields=archive.ARCHIVE_FIELDS if archive_root else None)
     if df_all.empty:
         logging.info("Nessun documento trovato nella collezione '%s'.", args.collection)
         return
 
+    # I documenti con expireAt (main.py con FIRESTORE_TTL=True) scadono via TTL lato server
+    ttl_managed = df_all["expireAt"].notna()
+    if ttl_managed.any():
+        logging.info("Ignorati %d documenti gestiti dalla TTL di Firestore.", int(ttl_managed.sum()))
+        df_all = df_all[~ttl_managed]
+        if df_all.empty:
+            return
+
     # Applica la logica di cleaning basata su hostid, pool e day
     df_clean = clean_capacity_trends(df_all)
 
     # Elimina da Firestore tutti i documenti che non compaiono nel DataFrame pulito
-    delete_unwanted_docs(db, df_all, df_clean, args.collection)
+    delete_unwanted_docs(db, df_all, df_clean, args.collection, workers=args.workers, archive_root=archive_root)
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    finally:
+        clients.firestore_usage.log_summary()
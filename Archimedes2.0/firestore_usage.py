@@ -0,0 +1,269 @@
+"""
+Firestore operation accounting and per-run budgets.
+
+clients.get_firestore_client returns the Firestore client wrapped by CountingClient, so every read,
+write and delete made by main.py, fs.py, check.py and firestore_deletion.py is counted per
+collection and per stage (the stage running in main.py, see metrics.StageMetrics):
+    reads     one per document returned by stream() / get(), and one for a query that returns none
+    writes    set / update / create, on a document or staged in a WriteBatch
+    deletes   delete, on a document or staged in a WriteBatch
+Writes staged in a WriteBatch are counted when the batch is committed.
+
+Budgets are per run and opt-in: FIRESTORE_MAX_READS, FIRESTORE_MAX_WRITES, FIRESTORE_MAX_DELETES.
+An operation that would exceed one of them either raises FirestoreBudgetExceeded before it reaches
+Firestore (FIRESTORE_BUDGET_ACTION=abort, the default) or is slowed down to
+FIRESTORE_THROTTLE_OPS operations per second (throttle). A summary is logged at the end of every run.
+"""
+import logging
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+READS, WRITES, DELETES = "reads", "writes", "deletes"
+OPERATIONS = (READS, WRITES, DELETES)
+BUDGET_KEYS = {
+    READS: "FIRESTORE_MAX_READS",
+    WRITES: "FIRESTORE_MAX_WRITES",
+    DELETES: "FIRESTORE_MAX_DELETES",
+}
+ABORT, THROTTLE = "abort", "throttle"
+THROTTLE_OPS = 20.0
+NO_STAGE = "-"
+
+# query methods returning a new query, wrapped so that its stream() is counted too
+_QUERY_METHODS = {
+    "select", "where", "order_by", "limit", "limit_to_last", "offset",
+    "start_at", "start_after", "end_at", "end_before",
+}
+
+
+class FirestoreBudgetExceeded(RuntimeError):
+    pass
+
+
+class FirestoreUsage:
+    """Operation counters of the process, keyed by (stage, collection, operation)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts: Dict[Tuple[str, str, str], int] = {}
+        self.totals = dict.fromkeys(OPERATIONS, 0)
+        self.budgets: Dict[str, int] = {}
+        self.action = ABORT
+        self.throttle_ops = THROTTLE_OPS
+        self.stage = NO_STAGE
+        self._warned = set()
+
+    def configure(self, config, share: float = 1.0):
+        """
+        Reads the budgets from `config` (.env values or os.environ). `share` is the fraction of the
+        budgets given to this process (a shard worker gets 1 / SHARDS of the run budget).
+        """
+        self.budgets = {}
+        for operation, key in BUDGET_KEYS.items():
+            value = config.get(key)
+            if value not in (None, ""):
+                self.budgets[operation] = max(int(int(value) * share), 0)
+        self.action = str(config.get("FIRESTORE_BUDGET_ACTION", ABORT)).lower()
+        if self.action not in (ABORT, THROTTLE):
+            logging.warning(f"Unknown FIRESTORE_BUDGET_ACTION '{self.action}', using '{ABORT}'")
+            self.action = ABORT
+        self.throttle_ops = float(config.get("FIRESTORE_THROTTLE_OPS", THROTTLE_OPS))
+
+    def reset(self):
+        with self._lock:
+            self.counts = {}
+            self.totals = dict.fromkeys(OPERATIONS, 0)
+            self._warned = set()
+
+    def set_stage(self, stage: Optional[str]):
+        self.stage = stage or NO_STAGE
+
+    def count(self, collection: str, operation: str, n: int = 1):
+        """Records `n` operations, enforcing the budget before they are sent."""
+        self.count_many([(collection, operation, n)])
+
+    def count_many(self, operations: List[Tuple[str, str, int]]):
+        """Records (collection, operation, n) items sent together (a WriteBatch): all or none."""
+        with self._lock:
+            totals = dict(self.totals)
+            for collection, operation, n in operations:
+                totals[operation] += n
+            exceeded = [
+                operation for operation, budget in self.budgets.items()
+                if totals[operation] > budget and totals[operation] > self.totals[operation]
+            ]
+            if exceeded and self.action == ABORT:
+                operation = exceeded[0]
+                raise FirestoreBudgetExceeded(
+                    f"Firestore {operation} budget exceeded: {totals[operation]} > {self.budgets[operation]} "
+                    f"(stage {self.stage}, collection '{operations[0][0]}')"
+                )
+            self.totals = totals
+            for collection, operation, n in operations:
+                key = (self.stage, collection, operation)
+                self.counts[key] = self.counts.get(key, 0) + n
+            throttled = sum(n for _, operation, n in operations if operation in exceeded)
+            warn = [operation for operation in exceeded if operation not in self._warned]
+            self._warned.update(warn)
+        for operation in warn:
+            logging.warning(
+                f"Firestore {operation} budget of {self.budgets[operation]} exceeded at stage {self.stage}: "
+                f"throttling to {self.throttle_ops:g} operations per second"
+            )
+        if throttled and self.throttle_ops > 0:
+            time.sleep(throttled / self.throttle_ops)
+
+    def records(self) -> List[dict]:
+        with self._lock:
+            return [
+                {"stage": stage, "collection": collection, "operation": operation, "count": n}
+                for (stage, collection, operation), n in self.counts.items()
+            ]
+
+    def merge(self, records: List[dict]):
+        """Adds the counters of another process (shard workers)."""
+        with self._lock:
+            for record in records:
+                key = (record["stage"], record["collection"], record["operation"])
+                self.counts[key] = self.counts.get(key, 0) + record["count"]
+                self.totals[record["operation"]] += record["count"]
+
+    def log_summary(self, top: int = 10):
+        budgets = ", ".join(
+            f"{operation}={self.totals[operation]}"
+            + (f"/{self.budgets[operation]}" if operation in self.budgets else "")
+            for operation in OPERATIONS
+        )
+        logging.info(f"Firestore usage: {budgets}")
+        heaviest = sorted(self.records(), key=lambda r: r["count"], reverse=True)[:top]
+        for r in heaviest:
+            logging.info(f"    {r['count']:>8} {r['operation']:<7} {r['collection']} (stage {r['stage']})")
+
+
+def _unwrap(value):
+    return getattr(value, "_wrapped", value)
+
+
+class _Proxy:
+    def __init__(self, wrapped, usage: FirestoreUsage):
+        self._wrapped = wrapped
+        self._usage = usage
+
+    def __getattr__(self, name):
+        return getattr(self._wrapped, name)
+
+
+class CountingClient(_Proxy):
+    """Firestore client whose collections, documents and batches count their operations."""
+
+    def collection(self, *path):
+        return CountingQuery(self._wrapped.collection(*path), self._usage, "/".join(path))
+
+    def batch(self):
+        return CountingBatch(self._wrapped.batch(), self._usage)
+
+
+class CountingQuery(_Proxy):
+    """Collection reference or query of `collection`."""
+
+    def __init__(self, wrapped, usage: FirestoreUsage, collection: str):
+        super().__init__(wrapped, usage)
+        self._collection = collection
+
+    def __getattr__(self, name):
+        attr = getattr(self._wrapped, name)
+        if name not in _QUERY_METHODS:
+            return attr
+
+        def query(*args, **kwargs):
+            args = [_unwrap(a) for a in args]
+            kwargs = {k: _unwrap(v) for k, v in kwargs.items()}
+            return CountingQuery(attr(*args, **kwargs), self._usage, self._collection)
+        return query
+
+    def document(self, *args, **kwargs):
+        return CountingDocument(self._wrapped.document(*args, **kwargs), self._usage, self._collection)
+
+    def stream(self, *args, **kwargs):
+        returned = 0
+        for snapshot in self._wrapped.stream(*args, **kwargs):
+            self._usage.count(self._collection, READS)
+            returned += 1
+            yield CountingSnapshot(snapshot, self._usage, self._collection)
+        if not returned:
+            # an empty result is billed as one read
+            self._usage.count(self._collection, READS)
+
+    def get(self, *args, **kwargs):
+        return list(self.stream(*args, **kwargs))
+
+
+class CountingDocument(_Proxy):
+    def __init__(self, wrapped, usage: FirestoreUsage, collection: str):
+        super().__init__(wrapped, usage)
+        self._collection = collection
+
+    def _write(self, operation: str, method: str, *args, **kwargs):
+        self._usage.count(self._collection, operation)
+        return getattr(self._wrapped, method)(*args, **kwargs)
+
+    def set(self, *args, **kwargs):
+        return self._write(WRITES, "set", *args, **kwargs)
+
+    def update(self, *args, **kwargs):
+        return self._write(WRITES, "update", *args, **kwargs)
+
+    def create(self, *args, **kwargs):
+        return self._write(WRITES, "create", *args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self._write(DELETES, "delete", *args, **kwargs)
+
+    def get(self, *args, **kwargs):
+        self._usage.count(self._collection, READS)
+        return CountingSnapshot(self._wrapped.get(*args, **kwargs), self._usage, self._collection)
+
+    def collection(self, *path):
+        return CountingQuery(self._wrapped.collection(*path), self._usage,
+                             "/".join((self._collection, *path)))
+
+
+class CountingSnapshot(_Proxy):
+    def __init__(self, wrapped, usage: FirestoreUsage, collection: str):
+        super().__init__(wrapped, usage)
+        self._collection = collection
+
+    @property
+    def reference(self):
+        return CountingDocument(self._wrapped.reference, self._usage, self._collection)
+
+
+class CountingBatch(_Proxy):
+    """WriteBatch whose staged operations are counted (and checked against the budget) on commit."""
+
+    def __init__(self, wrapped, usage: FirestoreUsage):
+        super().__init__(wrapped, usage)
+        self._staged: Dict[Tuple[str, str], int] = {}
+
+    def _stage(self, reference, operation: str):
+        key = (getattr(reference, "_collection", "?"), operation)
+        self._staged[key] = self._staged.get(key, 0) + 1
+        return _unwrap(reference)
+
+    def set(self, reference, *args, **kwargs):
+        return self._wrapped.set(self._stage(reference, WRITES), *args, **kwargs)
+
+    def update(self, reference, *args, **kwargs):
+        return self._wrapped.update(self._stage(reference, WRITES), *args, **kwargs)
+
+    def create(self, reference, *args, **kwargs):
+        return self._wrapped.create(self._stage(reference, WRITES), *args, **kwargs)
+
+    def delete(self, reference, *args, **kwargs):
+        return self._wrapped.delete(self._stage(reference, DELETES), *args, **kwargs)
+
+    def commit(self, *args, **kwargs):
+        self._usage.count_many([(collection, operation, n) for (collection, operation), n in self._staged.items()])
+        self._staged = {}
+        return self._wrapped.commit(*args, **kwargs)
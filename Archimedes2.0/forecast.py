@@ -0,0 +1,203 @@
+"""
+Batched capacity forecasting for all pools at once.
+
+Samples are sorted once by (hostid, pool, timestamp) so that every pool is a contiguous block of
+rows; every per-pool sum is then a single np.add.reduceat over the whole fleet. For each pool two
+linear trends of perc_used over time are fitted:
+    - OLS
+    - Huber (IRLS with the scale fixed to the MAD of the OLS residuals), robust to spikes
+The Huber trend is projected at FORECAST_HORIZONS_DAYS and used for days_to_full.
+
+As in the dashboard, samples before the last significant drop of perc_used (a pool cleanup or a
+resize) are ignored, since the trend restarts there.
+"""
+import logging
+from datetime import datetime
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+FORECAST_HORIZONS_DAYS = [7, 30, 90]
+LOOKBACK_DAYS = 90
+MIN_SAMPLES = 3
+MIN_SPAN_DAYS = 1.0
+# perc_used drop (percentage points between two samples) that restarts the trend
+DROP_THRESHOLD = 30.0
+HUBER_C = 1.345
+HUBER_ITERATIONS = 5
+FULL_PERC = 100.0
+
+SECONDS_PER_DAY = 86400.0
+
+
+def _group_sums(starts: np.ndarray, *arrays: np.ndarray) -> List[np.ndarray]:
+    return [np.add.reduceat(a, starts) for a in arrays]
+
+
+def _weighted_fit(starts, counts, x, y, w):
+    """Weighted least squares y = a + b x for every group; x is centered per group for stability."""
+    sw, swx, swy = _group_sums(starts, w, w * x, w * y)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x_mean, y_mean = swx / sw, swy / sw
+        dx = x - np.repeat(x_mean, counts)
+        dy = y - np.repeat(y_mean, counts)
+        sxx, sxy = _group_sums(starts, w * dx * dx, w * dx * dy)
+        slope = sxy / sxx
+    intercept = y_mean - slope * x_mean
+    return intercept, slope
+
+
+def _group_median(starts, counts, values):
+    """Median of non-negative values per contiguous group, with one flat sort for the whole fleet."""
+    group_ids = np.repeat(np.arange(len(starts)), counts)
+    scale = np.maximum.reduceat(values, starts)
+    scale = np.where(scale > 0, scale * (1 + 1e-9), 1.0)
+    # the integer group id dominates the key, so each group stays in its own block once sorted
+    keys = np.sort(group_ids + values / np.repeat(scale, counts))
+    lower = keys[starts + (counts - 1) // 2] - np.arange(len(starts))
+    upper = keys[starts + counts // 2] - np.arange(len(starts))
+    return (lower + upper) / 2 * scale
+
+
+def fit_trends(starts: np.ndarray, x: np.ndarray, y: np.ndarray, huber_iterations: int = HUBER_ITERATIONS):
+    """
+    Fits OLS and Huber trends for groups stored contiguously in x/y.
+
+    Args:
+        starts (np.ndarray): First row of every group (increasing, starts[0] == 0).
+        x (np.ndarray): Time in days.
+        y (np.ndarray): Values to fit.
+        huber_iterations (int): IRLS iterations of the Huber fit.
+
+    Returns:
+        (ols_intercept, ols_slope, huber_intercept, huber_slope), one value per group.
+    """
+    counts = np.diff(np.r_[starts, len(x)])
+    ones = np.ones_like(x)
+    ols_intercept, ols_slope = _weighted_fit(starts, counts, x, y, ones)
+
+    residuals = np.abs(y - np.repeat(ols_intercept, counts) - np.repeat(ols_slope, counts) * x)
+    mad = 1.4826 * _group_median(starts, counts, residuals)
+    threshold = np.repeat(HUBER_C * np.where(mad > 0, mad, np.inf), counts)
+
+    intercept, slope = ols_intercept, ols_slope
+    for _ in range(huber_iterations):
+        residuals = np.abs(y - np.repeat(intercept, counts) - np.repeat(slope, counts) * x)
+        with np.errstate(divide="ignore"):
+            weights = np.minimum(1.0, threshold / residuals)
+        intercept, slope = _weighted_fit(starts, counts, x, y, weights)
+    return ols_intercept, ols_slope, intercept, slope
+
+
+def forecast_pools(
+    samples: pd.DataFrame,
+    horizons_days: Optional[List[int]] = None,
+    lookback_days: float = LOOKBACK_DAYS,
+    drop_threshold: float = DROP_THRESHOLD,
+) -> pd.DataFrame:
+    """
+    Forecast of perc_used for every (hostid, pool) of `samples`.
+
+    Args:
+        samples (pd.DataFrame): "hostid", "pool", "timestamp" (datetime) and "perc_used" (0-100).
+        horizons_days (list, optional): Projection horizons in days. Defaults to FORECAST_HORIZONS_DAYS.
+        lookback_days (float): Only the last `lookback_days` of each pool are fitted.
+        drop_threshold (float): perc_used drop between two samples that restarts the trend.
+
+    Returns:
+        pd.DataFrame: one row per pool with "samples", "growth_rate" (Huber, % per day),
+        "growth_rate_ols", "fitted_perc_used" (trend value at the last sample),
+        "forecast_perc_used_<h>d" and "days_to_full". Pools with fewer than MIN_SAMPLES samples or
+        less than MIN_SPAN_DAYS of history get NaN.
+    """
+    horizons_days = horizons_days or FORECAST_HORIZONS_DAYS
+    columns = ["hostid", "pool", "samples", "last_date", "growth_rate", "growth_rate_ols", "fitted_perc_used"] + [
+        f"forecast_perc_used_{h}d" for h in horizons_days
+    ] + ["days_to_full"]
+    df = samples[["hostid", "pool", "timestamp", "perc_used"]].dropna()
+    if df.empty:
+        return pd.DataFrame(columns=columns)
+
+    host_codes, hosts = pd.factorize(df["hostid"])
+    pool_codes, pools = pd.factorize(df["pool"])
+    seconds = df["timestamp"].to_numpy(dtype="datetime64[s]").astype(np.int64)
+    # one int64 key (pool, seconds): a single argsort is much faster than lexsort on 3 keys
+    relative = seconds - seconds.min()
+    pair_codes = host_codes.astype(np.int64) * len(pools) + pool_codes
+    order = np.argsort(pair_codes * (int(relative.max()) + 1) + relative)
+    host_codes, pool_codes, seconds = host_codes[order], pool_codes[order], seconds[order]
+    y = df["perc_used"].to_numpy(dtype="float64")[order]
+
+    new_group = np.r_[True, (host_codes[1:] != host_codes[:-1]) | (pool_codes[1:] != pool_codes[:-1])]
+    starts = np.flatnonzero(new_group)
+    counts = np.diff(np.r_[starts, len(y)])
+    last_seconds = seconds[np.r_[starts[1:], len(y)] - 1]
+
+    # keep the lookback window and only what follows the last significant drop of each pool
+    drop = np.r_[False, np.diff(y) < -drop_threshold] & ~new_group
+    last_drop = np.maximum.reduceat(np.where(drop, np.arange(len(y)), -1), starts)
+    first_kept = np.maximum(starts, last_drop)
+    position = np.arange(len(y))
+    keep = (position >= np.repeat(first_kept, counts)) & (
+        seconds >= np.repeat(last_seconds, counts) - lookback_days * SECONDS_PER_DAY
+    )
+    host_codes, pool_codes, seconds, y = host_codes[keep], pool_codes[keep], seconds[keep], y[keep]
+    group_of_row = np.repeat(np.arange(len(starts)), counts)[keep]
+    starts = np.flatnonzero(np.r_[True, group_of_row[1:] != group_of_row[:-1]])
+    counts = np.diff(np.r_[starts, len(y)])
+    last_rows = np.r_[starts[1:], len(y)] - 1
+
+    # x in days relative to the last sample of the pool: the intercept is the trend "now"
+    x = (seconds - np.repeat(seconds[last_rows], counts)) / SECONDS_PER_DAY
+    ols_intercept, ols_slope, intercept, slope = fit_trends(starts, x, y)
+
+    span_days = -x[starts]
+    valid = (counts >= MIN_SAMPLES) & (span_days >= MIN_SPAN_DAYS) & np.isfinite(slope)
+    intercept = np.where(valid, intercept, np.nan)
+    slope = np.where(valid, slope, np.nan)
+
+    result = pd.DataFrame({
+        "hostid": hosts[host_codes[starts]],
+        "pool": pools[pool_codes[starts]],
+        "samples": counts,
+        "last_date": pd.to_datetime(seconds[last_rows], unit="s").strftime("%Y-%m-%d %H:%M:%S"),
+        "growth_rate": slope,
+        "growth_rate_ols": np.where(valid, ols_slope, np.nan),
+        "fitted_perc_used": intercept,
+    })
+    for h in horizons_days:
+        result[f"forecast_perc_used_{h}d"] = np.clip(intercept + slope * h, 0.0, FULL_PERC)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        days_to_full = np.where(slope > 0, (FULL_PERC - intercept) / slope, np.nan)
+    result["days_to_full"] = np.where(valid & (intercept >= FULL_PERC), 0.0, np.maximum(days_to_full, 0.0))
+    return result[columns]
+
+
+def samples_from_candles(candles: pd.DataFrame) -> pd.DataFrame:
+    """
+    Forecast input from candles.CandleStore candles of one granularity (reset index):
+    one sample per candle at its last timestamp, perc_used = close / total.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        perc_used = candles["close"].to_numpy(dtype="float64") / candles["total"].to_numpy(dtype="float64") * 100
+    return pd.DataFrame({
+        "hostid": candles["hostid"].to_numpy(),
+        "pool": candles["pool"].to_numpy(),
+        "timestamp": pd.to_datetime(candles["last_ts"]).to_numpy(),
+        "perc_used": np.where(np.isfinite(perc_used), perc_used, np.nan),
+    })
+
+
+def system_data_updates(forecasts: pd.DataFrame) -> list:
+    """(doc_id, fields) for the system_data documents of the pools (doc id "<hostid>_<pool>")."""
+    forecast_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    value_columns = [c for c in forecasts.columns if c not in ("hostid", "pool", "samples", "last_date")]
+    updates = []
+    for row in forecasts.to_dict("records"):
+        fields = {c: (None if pd.isna(row[c]) else round(float(row[c]), 4)) for c in value_columns}
+        fields["forecast_date"] = forecast_date
+        updates.append((f"{row['hostid']}_{str(row['pool']).replace('/', '-')}", fields))
+    valid = int(forecasts["growth_rate"].notna().sum()) if not forecasts.empty else 0
+    logging.info(f"Forecast: {valid}/{len(forecasts)} pools with enough history")
+    return updates
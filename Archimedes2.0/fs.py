@@ -1,60 +1,48 @@
 import os
 import pandas as pd
 from pydantic import BaseModel, Field
-from google.cloud import firestore
-from typing import Optional, Dict, Any
+from typing import TYPE_CHECKING, Optional, Dict, Any, Callable, Iterable, Iterator, List
 import logging
-import firebase_admin
-from firebase_admin import credentials, firestore
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
 
-def get_credentials_path(main_dir: str) -> str:
-    """
-    Determines the credentials file path by checking:
-      1. If the environment variable FIRESTORE_CREDENTIALS_PATH is set and exists.
-      2. If the "credentials.json" file exists in the main directory.
-      3. If the "credentials.json" file exists in the 'secrets' subfolder.
-    Raises an exception if the file is not found.
-    """
-    # 1. Check environment variable
-    cred_env = os.environ.get("FIRESTORE_CREDENTIALS_PATH")
-    if cred_env and os.path.exists(cred_env):
-        # Removed non-critical logging
-        return cred_env
-
-    # 2. Check if file exists in the main directory
-    local_path = os.path.join(main_dir, "credentials.json")
-    if os.path.exists(local_path):
-        # Removed non-critical logging
-        return local_path
-
-    # 3. Check if file exists in the 'secrets' folder
-    secrets_path = os.path.join(main_dir, "secrets", "credentials.json")
-    if os.path.exists(secrets_path):
-        # Removed non-critical logging
-        return secrets_path
-
-    raise FileNotFoundError(
-        "credentials.json file not found. Check if FIRESTORE_CREDENTIALS_PATH is set or if the file exists in the main directory or in 'secrets/credentials.json'."
-    )
+# firebase_admin / google.cloud.firestore are imported on first use (see clients.py): importing
+# them here would cost every entry point that imports fs about half a second at startup
+if TYPE_CHECKING:
+    from firebase_admin import credentials
+
+import clients
+from clients import get_credentials_path
+from firestore_usage import FirestoreBudgetExceeded
+
+# Firestore accepts at most 500 operations in a single WriteBatch
+MAX_BATCH_WRITES = 500
+DEFAULT_PAGE_SIZE = 1000
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
 
 class ArchimedesDB(BaseModel):
     cred_path: str = Field(default=os.path.join(os.getcwd(), "credentials.json"), description="Firebase credentials")
-    db: Optional[firestore.Client] = Field(default=None, description="Firestore client")
-    cred: Optional[credentials.Certificate] = Field(default=None, description="Firebase credentials")
+    db: Optional[Any] = Field(default=None, description="Firestore client (google.cloud.firestore.Client)")
+    cred: Optional[Any] = Field(default=None, description="Firebase credentials (firebase_admin.credentials.Certificate)")
+    sink: Optional[Any] = Field(default=None, description="Output sink (sinks.Sink), Firestore by default")
 
     class Config:
         arbitrary_types_allowed = True
     
-    def set_credentials(self) -> credentials.Certificate:
+    def set_credentials(self) -> "credentials.Certificate":
+        from firebase_admin import credentials
+
         self.cred = credentials.Certificate(self.cred_path)
         return self.cred
 
     def connect_to_firestore(self):
         """Connects to Firestore using the provided credentials."""
         try:
-            if not firebase_admin._apps:
-                firebase_admin.initialize_app(self.cred)
-            self.db = firestore.client()
+            self.db = clients.get_firestore_client(cred_path=self.cred_path)
+            if self.sink is None:
+                import sinks
+
+                self.sink = sinks.FirestoreSink(self.db)
         except Exception as e:
             logging.error(f"Error connecting to Firestore: {e}")
             raise Exception("Fatal Error: Error connecting to Firestore.")
@@ -64,38 +52,168 @@ class ArchimedesDB(BaseModel):
         pass
 
     def upload_to_firestore(self, collection_name: str, doc_id: str, document: Dict[str, Any]):
-        """Uploads JSON-like data to the specified Firestore collection."""
-        if self.db is None:
+        """Uploads JSON-like data to the specified Firestore collection (or to the configured sink)."""
+        if self.sink is None:
             logging.error("Firestore connection not established. Cannot upload data.")
             raise Exception("Fatal Error: Firestore connection not established.")
         
         try:
-            doc_ref = self.db.collection(collection_name).document(doc_id)
-            doc_ref.set(document)
+            self.sink.set(collection_name, doc_id, document)
+        except FirestoreBudgetExceeded:
+            raise
         except Exception as e:
             logging.error(f"Error uploading data to Firestore: {e}")
             raise Exception("Fatal Error: Error uploading data to Firestore.")
     
     def _delete_firestore_documents(self, collection_name: str, document_id: str):
-        """Deletes a document from Firestore."""
-        if self.db is None:
+        """Deletes a document from Firestore (or from the configured sink)."""
+        if self.sink is None:
             logging.error("Firestore connection not established. Cannot delete data.")
             return
         try:
-            self.db.collection(collection_name).document(document_id).delete()
+            self.sink.delete(collection_name, document_id)
+        except FirestoreBudgetExceeded:
+            raise
         except Exception as e:
             logging.error(f"Error deleting data from Firestore: {e}")
 
+def _chunked(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    iterator = iter(items)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+def commit_in_batches(
+    db,
+    items: Iterable[Any],
+    apply_to_batch: Callable[[Any, Any], None],
+    batch_size: int = MAX_BATCH_WRITES,
+    max_workers: int = 8,
+    on_committed: Optional[Callable[[List[Any]], None]] = None,
+) -> int:
+    """
+    Groups items into WriteBatch chunks and commits them concurrently on a thread pool.
+
+    apply_to_batch(batch, item) stages the write for a single item (set/update/delete).
+    on_committed(chunk) is invoked from the calling thread after each successful commit,
+    so callers can checkpoint progress without extra locking.
+    At most 2 * max_workers batches are in flight, which bounds memory on large inputs.
+    Returns the number of items committed; failed batches are logged and skipped, except when the
+    Firestore budget of the run is exceeded (FirestoreBudgetExceeded is raised).
+    """
+    batch_size = max(1, min(batch_size, MAX_BATCH_WRITES))
+
+    def commit(chunk: List[Any]) -> List[Any]:
+        batch = db.batch()
+        for item in chunk:
+            apply_to_batch(batch, item)
+        batch.commit()
+        return chunk
+
+    committed = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        chunks = _chunked(items, batch_size)
+        while True:
+            while len(pending) < 2 * max_workers:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                pending.add(executor.submit(commit, chunk))
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    chunk = future.result()
+                except FirestoreBudgetExceeded:
+                    raise
+                except Exception as e:
+                    logging.error(f"Error committing Firestore batch: {e}")
+                    continue
+                committed += len(chunk)
+                if on_committed is not None:
+                    on_committed(chunk)
+    return committed
+
+def iter_collection_pages(
+    db,
+    collection_name: str,
+    fields: Optional[List[str]] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    date_column: Optional[str] = "date",
+    date_format: str = DATE_FORMAT,
+) -> Iterator[pd.DataFrame]:
+    """
+    Streams a Firestore collection one page at a time as DataFrames.
+
+    Only `fields` are requested (server-side projection via select()); None reads whole documents.
+    Pages are ordered by document id and chained with start_after cursors, so at most one page of
+    snapshots is held in memory. Each page is built column by column and gets a "doc_id" column;
+    if `date_column` is present it is parsed vectorially into "date_dt" and rows with unparsable
+    dates are dropped.
+    """
+    base_query = db.collection(collection_name)
+    if fields:
+        base_query = base_query.select(fields)
+    base_query = base_query.order_by("__name__").limit(page_size)
+
+    last_snapshot = None
+    while True:
+        query = base_query if last_snapshot is None else base_query.start_after(last_snapshot)
+        snapshots = list(query.stream())
+        if not snapshots:
+            break
+        last_snapshot = snapshots[-1]
+        fetched = len(snapshots)
+
+        records = [snap.to_dict() or {} for snap in snapshots]
+        columns = fields or list(dict.fromkeys(key for record in records for key in record))
+        page = pd.DataFrame({col: [record.get(col) for record in records] for col in columns})
+        page["doc_id"] = [snap.id for snap in snapshots]
+        del snapshots, records
+
+        if date_column and date_column in page.columns:
+            page["date_dt"] = pd.to_datetime(page[date_column], format=date_format, errors="coerce")
+            invalid = page["date_dt"].isna()
+            if invalid.any():
+                logging.error(
+                    f"Skipped {int(invalid.sum())} documents with invalid '{date_column}' in '{collection_name}'"
+                )
+                page = page[~invalid]
+        yield page
+
+        if fetched < page_size:
+            break
+
+def load_collection(
+    db,
+    collection_name: str,
+    fields: Optional[List[str]] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    date_column: Optional[str] = "date",
+) -> pd.DataFrame:
+    """Loads a projected Firestore collection into a single DataFrame (see iter_collection_pages)."""
+    pages = list(iter_collection_pages(db, collection_name, fields, page_size, date_column))
+    if not pages:
+        return pd.DataFrame(columns=[*(fields or []), "doc_id"])
+    return pd.concat(pages, ignore_index=True)
+
 def convert_to_document(data, idx: int) -> dict:
     """Converts a DataFrame row to a Firestore document."""
     if isinstance(data, pd.DataFrame):
         return data.iloc[idx].to_dict()
         
-def run_archimedesDB(main_dir: str, credential_path: str = None):
+def run_archimedesDB(main_dir: str, credential_path: str = None, sink=None):
     """
     Uploads data to Firestore using a centrally determined credentials path.
     If a 'credential_path' is provided, it is verified; otherwise the get_credentials_path() function is used.
+    With a `sink` (sinks.Sink, e.g. the one of Main.run) the documents are written to it and no
+    Firestore connection is opened.
     """
+    if sink is not None:
+        _upload_capacity_docs(main_dir, ArchimedesDB(sink=sink))
+        return
+
     if credential_path:
         candidate_path = os.path.join(main_dir, credential_path)
         if os.path.exists(candidate_path):
@@ -110,7 +228,9 @@ def run_archimedesDB(main_dir: str, credential_path: str = None):
     archimedes_db = ArchimedesDB(cred_path=cred_full_path) 
     archimedes_db.set_credentials()
     archimedes_db.connect_to_firestore()
+    _upload_capacity_docs(main_dir, archimedes_db)
 
+def _upload_capacity_docs(main_dir: str, archimedes_db: ArchimedesDB):
     # Upload data to Firestore
     try:
         results_dir = os.path.join(main_dir, "results")
@@ -126,6 +246,8 @@ def run_archimedesDB(main_dir: str, credential_path: str = None):
                 archimedes_db.upload_to_firestore("capacity_trends", docid, doc)
             else:
                 logging.error(f"Error uploading data to Firestore: Missing required fields {hostid}-{pool}")
+    except FirestoreBudgetExceeded:
+        raise
     except Exception as e:
         logging.error(f"Error uploading data to Firestore: {e}")
         raise Exception("Fatal Error: Error uploading data to Firestore.")
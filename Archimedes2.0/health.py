@@ -0,0 +1,99 @@
+"""
+Health score of the system_data rows (rules of HEALTHSCORE.txt), computed for all rows at once.
+
+Component scores (0-100):
+    capacity     100 up to 55% perc_used, then linear down to 0 at 100%
+    performance  100 - 10 * |avg_time - 5|, floored at 0
+    telemetry    100 if sending_telemetry else 0
+    snapshots    100 - perc_snap clipped to 0-100, 0 without snapshots (used_snap == 0)
+    mup          as capacity, on MUP
+    utilization  (capacity + snapshots) / 2, informative only (weight 0)
+health_score is the weighted sum rounded half up, each impact is weight * (score - 50), and the
+classes follow the dashboard thresholds. Missing values behave as in the dashboard: no MUP counts
+as 0 (score 100), a missing avg_time gives a performance score of 0.
+"""
+import numpy as np
+import pandas as pd
+
+HEALTH_WEIGHTS = {
+    "capacity": 0.40,
+    "performance": 0.20,
+    "telemetry": 0.15,
+    "snapshots": 0.10,
+    "mup": 0.15,
+}
+# score below which a component is "critical" / "warning" (SystemDetail cards)
+STATUS_THRESHOLDS = {
+    "capacity": (50, 70),
+    "performance": (50, 60),
+    "telemetry": (100, 100),
+    "snapshots": (50, 70),
+    "mup": (50, 60),
+    "utilization": (50, 70),
+}
+# health_score at least this value -> class (Dashboard, Companies, CompanyDetail)
+HEALTHY_MIN_SCORE = 80
+WARNING_MIN_SCORE = 50
+
+USAGE_FREE_UNTIL = 55.0
+
+
+def _usage_score(perc: np.ndarray) -> np.ndarray:
+    return np.where(perc <= USAGE_FREE_UNTIL, 100.0, np.maximum(0.0, 100.0 - (perc - USAGE_FREE_UNTIL) * (100.0 / 45.0)))
+
+
+def _numeric(df: pd.DataFrame, column: str, default: float) -> np.ndarray:
+    if column not in df.columns:
+        return np.full(len(df), default)
+    return pd.to_numeric(df[column], errors="coerce").fillna(default).to_numpy(dtype="float64")
+
+
+def _status(scores: np.ndarray, critical_below: float, warning_below: float) -> np.ndarray:
+    return np.where(scores < critical_below, "critical", np.where(scores < warning_below, "warning", "good"))
+
+
+def health_table(df_systems: pd.DataFrame) -> pd.DataFrame:
+    """
+    Health columns for every row of df_systems (same index): "<component>_score",
+    "<component>_impact", "<component>_status", "health_score" and "health_status"
+    ("Healthy" / "Warning" / "Critical").
+    """
+    perc_used = _numeric(df_systems, "perc_used", 0.0)
+    avg_time = _numeric(df_systems, "avg_time", np.nan)
+    used_snap = _numeric(df_systems, "used_snap", 0.0)
+    perc_snap = _numeric(df_systems, "perc_snap", 0.0)
+    mup = _numeric(df_systems, "MUP", 0.0)
+    sending = (
+        df_systems["sending_telemetry"].astype(str).str.lower().eq("true").to_numpy()
+        if "sending_telemetry" in df_systems.columns
+        else np.zeros(len(df_systems), dtype=bool)
+    )
+
+    scores = {
+        "capacity": _usage_score(perc_used),
+        "performance": np.nan_to_num(np.maximum(0.0, 100.0 - 10.0 * np.abs(avg_time - 5.0)), nan=0.0),
+        "telemetry": np.where(sending, 100.0, 0.0),
+        "snapshots": np.where(used_snap > 0, np.clip(100.0 - perc_snap, 0.0, 100.0), 0.0),
+        "mup": _usage_score(mup),
+    }
+    scores["utilization"] = (scores["capacity"] + scores["snapshots"]) / 2
+
+    weighted = sum(HEALTH_WEIGHTS[name] * scores[name] for name in HEALTH_WEIGHTS)
+    health_score = np.floor(weighted + 0.5)
+
+    columns = {}
+    for name, values in scores.items():
+        columns[f"{name}_score"] = np.round(values, 1)
+        columns[f"{name}_impact"] = np.round(HEALTH_WEIGHTS.get(name, 0.0) * (values - 50.0), 2) + 0.0
+        columns[f"{name}_status"] = _status(values, *STATUS_THRESHOLDS[name])
+    columns["health_score"] = health_score.astype(int)
+    columns["health_status"] = np.where(
+        health_score >= HEALTHY_MIN_SCORE, "Healthy", np.where(health_score >= WARNING_MIN_SCORE, "Warning", "Critical")
+    )
+    return pd.DataFrame(columns, index=df_systems.index)
+
+
+def add_health(df_systems: pd.DataFrame) -> pd.DataFrame:
+    """df_systems with the columns of health_table (existing ones are replaced)."""
+    health = health_table(df_systems)
+    return pd.concat([df_systems.drop(columns=health.columns, errors="ignore"), health], axis=1)
@@ -4,44 +4,182 @@ import logging
 import os
 import time
 import math
+from datetime import datetime
 from dotenv import load_dotenv, dotenv_values
 
 import pandas as pd
-import firebase_admin
-from firebase_admin import credentials, firestore, initialize_app
 
 import utils
-from db import connect_merlindb
+import clients
+import retention
+from db import MerlinSession, connect_merlindb
 import results
 import fs
+import forecast
+import health
+from state_vector import StateVectorMaintainer
+from candles import CandleStore, candle_documents
+from mup import PeakTracker, parse_windows
+from stages import StageTracker
+import metrics
+import sinks
+from metrics import StageMetrics
+from alerts import AlertDetector, ALERTS_COLLECTION, alert_documents
+from aggregates import AggregateMaintainer, AGGREGATES_COLLECTION
+from dedup import DedupIndex, DEDUP_DAYS, DEDUP_MAX_KEYS
+
+# objects of warm_state that are not stage state (kept after a failed cycle)
+WARM_EXECUTORS = ("pipeline_executor", "shard_executor")
 
 
 class Main:
     directory: str = os.getcwd()
     env_file_path: str = os.path.join(directory, ".env")
     last_id_path: str = os.path.join(directory, "last_id.txt")
+    state_dir: str = os.path.join(directory, "state")
+    capacity_state_path: str = os.path.join(state_dir, "capacity_last_written.json")
+    latest_dates_state_path: str = os.path.join(state_dir, "capacity_latest_dates.json")
+    ttl_state_path: str = os.path.join(state_dir, "ttl_daily_written.json")
+    state_vector_path: str = os.path.join(state_dir, "state_vectors")
+    mup_state_path: str = os.path.join(state_dir, "mup_peaks.json")
+    alerts_state_path: str = os.path.join(state_dir, "alerts.json")
+    aggregates_state_path: str = os.path.join(state_dir, "aggregates.json")
+    stages_state_path: str = os.path.join(state_dir, "stages.json")
+    dedup_state_path: str = os.path.join(state_dir, "dedup_index.npz")
     config: dict = dotenv_values(env_file_path)
+    # "cprofile" / "pyinstrument": profiling of every cycle (--profile, or PROFILE in .env)
+    profile: str = None
+    # file name of this process in the local sinks (SINK=jsonl/parquet); every shard writes its own
+    sink_part: str = "main"
+
+    def __init__(self, session: MerlinSession = None):
+        # daemon mode: connection reused, .env read once and stage state kept in memory
+        self.session = session
+        self.warm_state = {} if session is not None else None
+        self.metrics = StageMetrics(on_stage=clients.firestore_usage.set_stage)
+
+    def with_state_dir(self, state_dir: str) -> "Main":
+        """Moves every state file of this runner under `state_dir` (one folder per shard)."""
+        for name in dir(type(self)):
+            value = getattr(self, name)
+            if name.endswith("_path") and isinstance(value, str) and value.startswith(self.state_dir + os.sep):
+                setattr(self, name, os.path.join(state_dir, os.path.relpath(value, self.state_dir)))
+        self.state_dir = state_dir
+        return self
+
+    def load_state(self, name: str, loader):
+        """State object of a stage, loaded once and then kept warm in daemon mode."""
+        if self.warm_state is None:
+            return loader()
+        if name not in self.warm_state:
+            self.warm_state[name] = loader()
+        return self.warm_state[name]
+
+    def drop_warm_state(self):
+        """
+        Forgets the state objects kept warm, except the worker pools: after a failed cycle they may
+        hold a half-applied batch, so the next cycle reloads them from the state files.
+        """
+        if self.warm_state is None:
+            return
+        for name in list(self.warm_state):
+            if name not in WARM_EXECUTORS:
+                del self.warm_state[name]
 
     def run(self):
         # ------------------------------------------------------------------
         # 1 | Config & DB
         # ------------------------------------------------------------------
-        self.config = dotenv_values(self.env_file_path)
-        raw_data_companies, raw_data_telemetry = connect_merlindb(
-            self.config, self.last_id_path
-        )
-        logging.info("Database connection succeeded")
+        if self.session is None:
+            self.config = dotenv_values(self.env_file_path)
+        self.metrics = StageMetrics(on_stage=clients.firestore_usage.set_stage)
+        # letture / scritture / cancellazioni Firestore del ciclo, con i budget FIRESTORE_MAX_*
+        clients.firestore_usage.reset()
+        clients.firestore_usage.configure(self.config)
+        metrics_dir = self.config.get("METRICS_DIR")
+        profile_dir = os.path.join(self.directory, metrics_dir or "metrics")
+        try:
+            with metrics.profile(self.profile or self.config.get("PROFILE"), profile_dir):
+                if utils.string_to_bool(self.config.get("PIPELINE", "False")):
+                    # estrazione a blocchi, trasformazione e upload sovrapposti (pipeline.py)
+                    import pipeline
+
+                    pipeline.run_pipeline(self)
+                else:
+                    with self.metrics.measure("1 connect_merlindb"):
+                        raw_data_companies, raw_data_telemetry, new_last_id = connect_merlindb(
+                            self.config, self.last_id_path, self.session
+                        )
+                        self.metrics.add(rows_out=0 if raw_data_telemetry is None else len(raw_data_telemetry))
+                    logging.info("Database connection succeeded")
+                    self.process_batch(raw_data_companies, raw_data_telemetry)
+                    # LAST_ID avanza solo dopo l'elaborazione del batch (come in pipeline.py): se uno
+                    # stage o uno shard fallisce, il ciclo successivo rilegge le stesse righe
+                    if raw_data_telemetry is not None and new_last_id is not None:
+                        utils.update_last_id(new_last_id, self.last_id_path)
+                # inattività delle pool ad ogni ciclo, anche senza nuova telemetria (stage 1.1 saltato)
+                with self.metrics.measure("11 inactivity"):
+                    self.check_inactivity()
+        finally:
+            # misure per stage: log dei più lenti ed export Prometheus / JSON lines (METRICS_DIR)
+            self.metrics.stop()
+            self.metrics.log_summary()
+            clients.firestore_usage.log_summary()
+            if metrics_dir:
+                self.metrics.export(os.path.join(self.directory, metrics_dir))
+
+    def process_batch(self, raw_data_companies, raw_data_telemetry, tables: dict = None):
+        """Main.process on this process, or on SHARDS worker processes split by hostid (sharding.py)."""
+        shards = int(self.config.get("SHARDS", 1))
+        if shards > 1:
+            import sharding
+
+            sharding.run_sharded(self, raw_data_companies, raw_data_telemetry, shards, tables)
+        else:
+            self.process(raw_data_companies, raw_data_telemetry, tables)
+
+    def process(self, raw_data_companies, raw_data_telemetry, tables: dict = None, shard: bool = False):
+        """
+        Stages 1.1-10 on a batch read from Merlin. `tables` are the DataFrames of stage 2
+        (results.build_tables) when they were already built, e.g. by the pipeline transform process.
+        With `shard` (a sharding.py worker) only the per-pool stages run, and the inputs of the
+        fleet stages are returned instead.
+
+        A failed cycle does not advance LAST_ID, so its batch is processed again by the next one,
+        after the stages that completed saved their state. Every stateful stage therefore merges
+        a sample only once. The dedup index and the aggregates are keyed, and MUP keeps maxima and
+        skips the samples older than its newest one. The state vectors, the candles and the alert
+        EWMA skip the samples not newer than the last one of their pool (the candles merge late
+        samples into the gaps between their stored ones). The uploads overwrite documents with
+        deterministic ids.
+        """
+        # ------------------------------------------------------------------
+        # 1.1 | Stage saltati se i loro input non sono cambiati (ciclo a vuoto)
+        # ------------------------------------------------------------------
+        self.metrics.start("1.1 stage_check")
+        stages = self.load_state("stages", lambda: StageTracker.load(self.stages_state_path))
+        stages.set_inputs(telemetry=raw_data_telemetry, companies=raw_data_companies, config=self.config)
+        if not stages.should_run("pipeline", required=["telemetry"]):
+            if not shard:
+                self.resume_stages(stages)
+            self.metrics.stop()
+            return
 
         # ------------------------------------------------------------------
         # 2 | DataFrames
         # ------------------------------------------------------------------
-        df_capacity = results.capacity_trends_table(raw_data_telemetry)
-        df_systems = results.systems_data_table(raw_data_companies, raw_data_telemetry)
-        df_capacity_dataset = results.capacity_trends_dataset_table(raw_data_telemetry)
+        self.metrics.start("2 tables", rows_in=len(raw_data_telemetry))
+        tables = tables or results.build_tables(raw_data_companies, raw_data_telemetry)
+        df_capacity = tables["capacity"]
+        df_systems = tables["systems"]
+        df_capacity_dataset = tables["capacity_dataset"]
+        df_samples = tables["samples"]
+        self.metrics.add(rows_out=sum(len(df) for df in tables.values()))
 
         # ------------------------------------------------------------------
         # 2.1 | unit_id mapping per df_capacity_dataset
         # ------------------------------------------------------------------
+        self.metrics.start("2.1 unit_id")
         base_unit_map = (
             df_systems[
                 df_systems["pool"].notna() & ~df_systems["pool"].str.contains("/", na=False)
@@ -57,6 +195,7 @@ class Main:
         # ------------------------------------------------------------------
         # 2.2 | Aggregazione perc_snap e used_snap dai dataset
         # ------------------------------------------------------------------
+        self.metrics.start("2.2 snapshots")
         df_datasets = df_systems[df_systems["pool"].str.contains("/", na=False)].copy()
         df_datasets["base_pool"] = df_datasets["pool"].str.split("/", n=1).str[0]
         agg = (
@@ -66,49 +205,110 @@ class Main:
         )
         # agg indexed by (hostid, base_pool)
 
+        # ------------------------------------------------------------------
+        # 2.3 | Deduplica dei campioni già scritti nei cicli precedenti (opzionale)
+        # ------------------------------------------------------------------
+        self.metrics.start("2.3 dedup", rows_in=len(df_capacity))
+        dedup_enabled = utils.string_to_bool(self.config.get("CAPACITY_DEDUP", "False"))
+        if dedup_enabled:
+            dedup_index = self.load_state("dedup", lambda: DedupIndex.load(
+                self.dedup_state_path,
+                int(self.config.get("DEDUP_DAYS", DEDUP_DAYS)),
+                int(self.config.get("DEDUP_MAX_KEYS", DEDUP_MAX_KEYS)),
+            ))
+            df_capacity = dedup_index.filter(df_capacity)
+        self.metrics.add(rows_out=len(df_capacity))
+
+        # ------------------------------------------------------------------
+        # 2.4 | Compattazione capacity_trends (solo variazioni significative)
+        # ------------------------------------------------------------------
+        self.metrics.start("2.4 compaction", rows_in=len(df_capacity))
+        compaction = utils.string_to_bool(self.config.get("CAPACITY_COMPACTION", "True"))
+        if compaction:
+            df_capacity_trends, capacity_state = results.compact_capacity_trends(
+                df_capacity, utils.read_state(self.capacity_state_path)
+            )
+        else:
+            df_capacity_trends = df_capacity
+        self.metrics.add(rows_out=len(df_capacity_trends))
+
+        # ------------------------------------------------------------------
+        # 2.5 | expireAt per la TTL di Firestore (opzionale)
+        # ------------------------------------------------------------------
+        self.metrics.start("2.5 ttl")
+        ttl_enabled = utils.string_to_bool(self.config.get("FIRESTORE_TTL", "False"))
+        if ttl_enabled:
+            policy = retention.load_policy(self.config)
+            trends_resolution, ttl_state = retention.mark_resolution(
+                df_capacity_trends, utils.read_state(self.ttl_state_path)
+            )
+            expire_trends = retention.expire_at(
+                "capacity_trends", df_capacity_trends["date"], trends_resolution, policy
+            )
+            dataset_resolution, ttl_state = retention.mark_resolution(df_capacity_dataset, ttl_state)
+            expire_dataset = retention.expire_at(
+                "capacity_trends_dataset", df_capacity_dataset["date"], dataset_resolution, policy
+            )
+            expire_history = retention.expire_at("capacity_history", df_capacity["date"], policy=policy)
+
+        # ------------------------------------------------------------------
+        # 2.6 | MUP: picco di perc_used sulle finestre configurate (incrementale)
+        # ------------------------------------------------------------------
+        self.metrics.start("2.6 mup")
+        mup_enabled = utils.string_to_bool(self.config.get("MUP_TRACKING", "True"))
+        if mup_enabled:
+            mup_window = float(self.config.get("MUP_WINDOW_DAYS", 7))
+            peaks = self.load_state("mup", lambda: PeakTracker.load(
+                self.mup_state_path,
+                sorted(set(parse_windows(self.config.get("MUP_WINDOWS_DAYS"))) | {mup_window}),
+            ))
+            peaks.update(df_samples)
+            df_systems = peaks.apply(df_systems, mup_window)
+
+        # ------------------------------------------------------------------
+        # 2.7 | Health score (regole di HEALTHSCORE.txt) salvato in system_data
+        # ------------------------------------------------------------------
+        self.metrics.start("2.7 health")
+        if utils.string_to_bool(self.config.get("HEALTH_SCORE", "True")):
+            df_systems = health.add_health(df_systems)
+
         # ------------------------------------------------------------------
         # 3 | Salvataggio CSV (opzionale)
         # ------------------------------------------------------------------
-        if self.config.get("SAVE_TABLES") == "True":
-            res_folder = self.config["RESULTS_FOLDER"]
-            utils.create_dir(os.path.join(self.directory, res_folder))
-            utils.write_results(df_capacity, os.path.join(res_folder, "capacity_data.csv"))
-            utils.write_results(df_capacity_dataset, os.path.join(res_folder, "capacity_dataset.csv"))
-            utils.write_results(df_systems, os.path.join(res_folder, "systems_data.csv"))
+        self.metrics.start("3 csv")
+        if not shard:
+            self.save_tables(df_capacity_trends, df_capacity_dataset, df_systems)
 
         # ------------------------------------------------------------------
-        # 4 | Firestore Init
+        # 4 | Firestore Init  (o il sink locale / emulatore scelto con SINK, vedi sinks.py)
         # ------------------------------------------------------------------
-        cred_path = os.environ.get("FIRESTORE_CREDENTIALS_PATH")
-        if not (cred_path and os.path.exists(cred_path)):
-            cred_path = os.path.join(self.directory, "credentials.json")
-            if not os.path.exists(cred_path):
-                cred_path = os.path.join(self.directory, "secrets", "credentials.json")
-        if not os.path.exists(cred_path):
-            raise FileNotFoundError("credentials.json non trovato")
-        cred = credentials.Certificate(cred_path)
-        if not firebase_admin._apps:
-            initialize_app(cred)
-        db = firestore.client()
+        self.metrics.start("4 firestore_init")
+        sink = sinks.from_config(self.config, self.directory, self.sink_part)
 
         # ------------------------------------------------------------------
         # 5 | capacity_history  (solo pool senza “/”)
         # ------------------------------------------------------------------
-        for _, r in df_capacity.iterrows():
+        self.metrics.start("5 capacity_history")
+        for idx, r in df_capacity.iterrows():
             if pd.isna(r["pool"]) or "/" not in r["pool"]:
                 formatted_date = r["date"].replace(" ", "_").replace(":", "-")
                 doc_id = f"{r['hostid']}_{r['pool']}_{formatted_date}"
-                db.collection("capacity_history").document(doc_id).set({
+                data = {
                     "hostid": r["hostid"],
                     "pool": r["pool"],
                     "date": r["date"]
-                })
+                }
+                if ttl_enabled and expire_history[idx] is not None:
+                    data[retention.TTL_FIELD] = expire_history[idx]
+                sink.set("capacity_history", doc_id, data)
+                self.metrics.add(docs_written=1)
         logging.info("Firestore capacity_history update completed")
 
         # ------------------------------------------------------------------
         # 6 | capacity_trends  (solo pool senza “/”, con agg. dai dataset)
         # ------------------------------------------------------------------
-        for _, r in df_capacity.iterrows():
+        self.metrics.start("6 capacity_trends")
+        for idx, r in df_capacity_trends.iterrows():
             if pd.isna(r["pool"]) or "/" not in r["pool"]:
                 host = r["hostid"]
                 pool = r["pool"]
@@ -123,29 +323,69 @@ class Main:
                 data = r.to_dict()
                 data["perc_snap"] = perc_snap
                 data["used_snap"] = used_snap
+                if ttl_enabled and expire_trends[idx] is not None:
+                    data[retention.TTL_FIELD] = expire_trends[idx]
                 formatted_date = r["date"].replace(" ", "_").replace(":", "-")
                 doc_id = f"{host}_{pool}_{formatted_date}"
-                db.collection("capacity_trends").document(doc_id).set(data)
+                sink.set("capacity_trends", doc_id, data)
+                self.metrics.add(docs_written=1)
+        # indice per pool dell'ultima data scritta, letto da check.py al posto della scansione completa.
+        # La data non torna mai indietro: un batch più vecchio riletto (rollback di LAST_ID) viene
+        # confrontato con le date già scritte, salvate in capacity_latest_dates.json
+        latest_dates = utils.read_state(self.latest_dates_state_path)
+        df_latest_trends = (
+            df_capacity_trends[df_capacity_trends["pool"].notna()]
+            .groupby(["hostid", "pool"], as_index=False)["date"]
+            .max()
+        )
+        for host, pool, last_date in zip(df_latest_trends["hostid"], df_latest_trends["pool"], df_latest_trends["date"]):
+            key = utils.pool_key(host, pool)
+            if latest_dates.get(key, "") >= last_date:
+                continue
+            sink.set(
+                "capacity_trends_latest", f"{host}_{pool}",
+                {"hostid": host, "pool": pool, "last_date": last_date}, merge=True,
+            )
+            latest_dates[key] = last_date
+            self.metrics.add(docs_written=1)
+        utils.write_state(latest_dates, self.latest_dates_state_path)
+        if compaction:
+            # ultimo perc_used scritto per (hostid, pool): salvato solo dopo l'upload
+            utils.write_state(capacity_state, self.capacity_state_path)
+        if dedup_enabled:
+            # chiavi dei campioni scritti in capacity_history / capacity_trends, anche queste dopo l'upload
+            dedup_index.add(df_capacity)
+            dedup_index.save(self.dedup_state_path)
         logging.info("Firestore capacity_trends update completed")
 
         # ------------------------------------------------------------------
         # 7 | capacity_trends_dataset  (solo pool con “/”)
         # ------------------------------------------------------------------
-        for _, r in df_capacity_dataset.iterrows():
+        self.metrics.start("7 capacity_trends_dataset")
+        for idx, r in df_capacity_dataset.iterrows():
             pool_sanitized = str(r["pool"]).replace("/", "-")
             formatted_date = r["date"].replace(" ", "_").replace(":", "-")
             doc_id = f"{r['hostid']}_{pool_sanitized}_{formatted_date}"
-            db.collection("capacity_trends_dataset").document(doc_id).set(r.to_dict())
+            data = r.to_dict()
+            if ttl_enabled and expire_dataset[idx] is not None:
+                data[retention.TTL_FIELD] = expire_dataset[idx]
+            sink.set("capacity_trends_dataset", doc_id, data)
+            self.metrics.add(docs_written=1)
+        if ttl_enabled:
+            utils.write_state(ttl_state, self.ttl_state_path)
         logging.info("Firestore capacity_trends_dataset update completed")
 
         # ------------------------------------------------------------------
         # 8 | system_data – salva tutte le colonne (unit_id immutabile)
         # ------------------------------------------------------------------
+        self.metrics.start("8 system_data")
+        nan_pool_docs = []
         for _, r in df_systems.iterrows():
             host = r["hostid"]
             pool = r["pool"]
             if pd.isna(pool):
                 doc_id = f"{host}"
+                nan_pool_docs.append(doc_id)
             else:
                 doc_id = f"{host}_{str(pool).replace('/', '-')}"
             data = r.to_dict()
@@ -158,35 +398,244 @@ class Main:
                     data["perc_snap"] = 0.0
                     data["used_snap"] = 0.0
             data.pop("unit_id", None)
-            db.collection("system_data").document(doc_id).set(data, merge=True)
+            sink.set("system_data", doc_id, data, merge=True)
+            self.metrics.add(docs_written=1)
+        if mup_enabled:
+            peaks.save(self.mup_state_path)
         logging.info("Firestore system_data update completed")
 
         # ------------------------------------------------------------------
-        # 9 | ArchimedesDB
+        # 8.1 | state_vectors  (incrementale, solo pool aggiornate nel ciclo)
+        # ------------------------------------------------------------------
+        self.metrics.start("8.1 state_vectors")
+        if utils.string_to_bool(self.config.get("STATE_VECTOR_STREAM", "False")):
+            maintainer = self.load_state(
+                "state_vectors", lambda: StateVectorMaintainer.load(self.state_vector_path)
+            )
+            changed_pools = maintainer.update(df_samples)
+            df_sv = maintainer.results(changed_pools)
+            for (host, pool), group in df_sv.groupby(["Host ID", "Pool"]):
+                data = {"hostid": host, "pool": pool}
+                for sv_row in group.to_dict("records"):
+                    timeframe = sv_row.pop("Timeframe Days")
+                    for key in ("Start Timestamp", "Last Timestamp"):
+                        sv_row[key] = sv_row[key].strftime("%Y-%m-%d %H:%M:%S")
+                    sv_row.pop("Host ID")
+                    sv_row.pop("Pool")
+                    data[f"{timeframe * 24}h"] = utils.numpy_to_python(sv_row)
+                sink.set("state_vectors", f"{host}_{pool}", data)
+            maintainer.save(self.state_vector_path)
+            logging.info(f"Firestore state_vectors update completed ({len(changed_pools)} pools)")
+            self.metrics.add(rows_in=len(df_samples), docs_written=len(changed_pools))
+
+        # ------------------------------------------------------------------
+        # 8.2 | capacity_candles  (OHLC 1h/1d/1w aggiornati dal batch corrente)
+        # ------------------------------------------------------------------
+        self.metrics.start("8.2 capacity_candles")
+        candles_enabled = utils.string_to_bool(self.config.get("CAPACITY_CANDLES", "False"))
+        if candles_enabled:
+            store = self.load_state("candles", lambda: CandleStore.load(self.state_dir))
+            changed_candles = store.update(df_samples)
+            written = sink.set_many("capacity_candles", candle_documents(changed_candles))
+            store.save(self.state_dir)
+            logging.info(f"Firestore capacity_candles update completed ({written} candles)")
+            self.metrics.add(docs_written=written)
+
+        # ------------------------------------------------------------------
+        # 8.3 | forecast perc_used in system_data (trend dalle candele orarie)
+        # ------------------------------------------------------------------
+        self.metrics.start("8.3 forecast")
+        df_forecast = None
+        if utils.string_to_bool(self.config.get("CAPACITY_FORECAST", "False")):
+            if not candles_enabled:
+                # senza CAPACITY_CANDLES lo stage 8.2 non aggiorna lo store: lo aggiorna qui col batch
+                # corrente (senza upload), altrimenti il forecast userebbe candele ferme
+                store = self.load_state("candles", lambda: CandleStore.load(self.state_dir))
+                store.update(df_samples)
+                store.save(self.state_dir)
+            df_hourly = store.frame("1h").reset_index()
+            df_forecast = forecast.forecast_pools(forecast.samples_from_candles(df_hourly))
+            written = sink.set_many("system_data", forecast.system_data_updates(df_forecast), merge=True)
+            logging.info(f"Firestore system_data forecast update completed ({written} pools)")
+            self.metrics.add(docs_written=written)
+
+        # ------------------------------------------------------------------
+        # 8.4 | alerts  (rilevati sul batch corrente, stato per pool persistito)
         # ------------------------------------------------------------------
-        env_value = self.config.get("ENVIRONMENT", "")
-        if env_value in ("DEV", "PROD"):
-            fs.run_archimedesDB(self.directory, "requirements.json")
+        self.metrics.start("8.4 alerts")
+        if utils.string_to_bool(self.config.get("ALERTS", "False")):
+            detector = self.load_state("alerts", lambda: AlertDetector.load(self.alerts_state_path))
+            new_alerts = detector.evaluate(df_samples, df_systems, df_forecast)
+            written = sink.set_many(ALERTS_COLLECTION, alert_documents(new_alerts))
+            detector.save(self.alerts_state_path)
+            logging.info(f"Firestore alerts update completed ({written} alerts)")
+            self.metrics.add(docs_written=written)
+
+        if shard:
+            # stages 3, 8.5, 9 e 10 sono di tutta la fleet: li esegue il processo padre (sharding.py)
+            stages.done("pipeline")
+            stages.save(self.stages_state_path)
+            sink.close()
+            self.metrics.stop()
+            return {
+                "metrics": self.metrics.records,
+                "firestore_usage": clients.firestore_usage.records(),
+                "systems": df_systems,
+                "snapshots": agg,
+                "nan_pool_docs": nan_pool_docs,
+                "capacity_trends": df_capacity_trends,
+                "capacity_dataset": df_capacity_dataset,
+            }
+        self.finish(sink, stages, df_systems, agg, nan_pool_docs)
+
+    def check_inactivity(self, now: datetime = None):
+        """
+        Inactivity alerts of every known pool (ALERTS=True), also on the cycles without new
+        telemetry, when stage 8.4 does not run. With SHARDS > 1 the alert state of every shard is
+        checked. The alerts are uploaded before the state is saved, and set_many raises when some of
+        them were not written (sinks.SinkWriteError): the state is then not saved, so the alerts are
+        emitted again on the next cycle.
+        """
+        if not utils.string_to_bool(self.config.get("ALERTS", "False")):
+            return
+        shards = int(self.config.get("SHARDS", 1))
+        if shards > 1:
+            import sharding
+
+            relative_path = os.path.relpath(self.alerts_state_path, self.state_dir)
+            paths = [os.path.join(sharding.shard_state_dir(self.state_dir, shards, shard), relative_path)
+                     for shard in range(shards)]
+            detectors = [(path, AlertDetector.load(path)) for path in paths if os.path.exists(path)]
         else:
-            fs.run_archimedesDB(self.directory)
+            detectors = [(self.alerts_state_path,
+                          self.load_state("alerts", lambda: AlertDetector.load(self.alerts_state_path)))]
+        new_alerts, changed = [], []
+        for path, detector in detectors:
+            alerts = detector.evaluate_inactivity(now)
+            if alerts:
+                new_alerts.extend(alerts)
+                changed.append((path, detector))
+        if not new_alerts:
+            return
+        sink = sinks.from_config(self.config, self.directory, self.sink_part)
+        written = sink.set_many(ALERTS_COLLECTION, alert_documents(new_alerts))
+        sink.close()
+        for path, detector in changed:
+            detector.save(path)
+        logging.info(f"Firestore alerts update completed ({written} inactivity alerts)")
+        self.metrics.add(docs_written=written)
+
+    def save_tables(self, df_capacity_trends, df_capacity_dataset, df_systems):
+        """Stage 3: CSV of the tables of the cycle (SAVE_TABLES=True)."""
+        if self.config.get("SAVE_TABLES") == "True":
+            res_folder = self.config["RESULTS_FOLDER"]
+            utils.create_dir(os.path.join(self.directory, res_folder))
+            utils.write_results(df_capacity_trends, os.path.join(res_folder, "capacity_data.csv"))
+            utils.write_results(df_capacity_dataset, os.path.join(res_folder, "capacity_dataset.csv"))
+            utils.write_results(df_systems, os.path.join(res_folder, "systems_data.csv"))
+
+    def finish(self, sink: sinks.Sink, stages: StageTracker, df_systems, agg, nan_pool_docs: list, complete: bool = True):
+        """
+        Stages 8.5-10, on the whole fleet: `df_systems` / `agg` / `nan_pool_docs` of all the shards.
+        Without `complete` (a shard failed) the batch is not recorded as processed: run_sharded then
+        raises, so Main.run (or the pipeline) does not advance LAST_ID and the next cycle reads the
+        batch again.
+        """
+        # ------------------------------------------------------------------
+        # 8.5 | aggregates per company e fleet (delta dalle righe system_data del ciclo)
+        # ------------------------------------------------------------------
+        self.metrics.start("8.5 aggregates")
+        if utils.string_to_bool(self.config.get("AGGREGATES", "False")):
+            self.update_aggregates(sink, lambda maintainer: maintainer.update(df_systems, agg))
+
+        if complete:
+            stages.done("pipeline")
+        stages.save(self.stages_state_path)
+        self.fleet_stages(sink, stages, nan_pool_docs)
+
+    def update_aggregates(self, sink: sinks.Sink, apply):
+        """Applies `apply(maintainer)` to the aggregates, then uploads the companies it changed."""
+        maintainer = self.load_state(
+            "aggregates", lambda: AggregateMaintainer.load(self.aggregates_state_path)
+        )
+        changed_companies = apply(maintainer)
+        if changed_companies:
+            written = sink.set_many(AGGREGATES_COLLECTION, maintainer.documents(changed_companies))
+            logging.info(f"Firestore aggregates update completed ({written} documents)")
+            self.metrics.add(docs_written=written)
+        maintainer.save(self.aggregates_state_path)
+
+    def resume_stages(self, stages: StageTracker):
+        """
+        Stages 9-10 left pending by an earlier cycle, run on a cycle whose batch is skipped by
+        stage 1.1. The batch is recorded as processed before them, so after one of them failed the
+        batch read again is skipped and they would otherwise wait for new telemetry.
+        """
+        if not stages.is_pending("archimedes_db", "cleanup"):
+            return
+        logging.info("Resuming the stages 9-10 of a previous cycle")
+        self.fleet_stages(sinks.from_config(self.config, self.directory, self.sink_part), stages, [])
+
+    def fleet_stages(self, sink: sinks.Sink, stages: StageTracker, nan_pool_docs: list):
+        """Stages 9-10: ArchimedesDB upload and cleanup of the NaN pool documents."""
+        stages.set_inputs(
+            capacity_csv=os.path.join(self.directory, "results", "capacity_data.csv"),
+            nan_pool_docs=nan_pool_docs,
+        )
+        run_archimedes_db = stages.should_run("archimedes_db", required=["capacity_csv"])
+        # una pulizia interrotta in un ciclo precedente viene ripresa anche senza nuovi documenti NaN
+        run_cleanup = stages.should_run("cleanup", required=["nan_pool_docs"]) or stages.resume("cleanup")
+        # stage 9 e 10 salvati come pending prima di eseguirli: se falliscono li riprende resume_stages
+        stages.save(self.stages_state_path)
 
         # ------------------------------------------------------------------
-        # 10 | Cleanup pool NaN in system_data
+        # 9 | ArchimedesDB  (solo se results/capacity_data.csv è cambiato)
         # ------------------------------------------------------------------
-        docs = list(db.collection("system_data").stream())
-        for doc in docs:
-            data = doc.to_dict()
-            pool_val = data.get("pool")
-            if isinstance(pool_val, float) and math.isnan(pool_val):
-                doc.reference.delete()
-                logging.info(f"Deleted system_data doc '{doc.id}' because pool is NaN")
-        logging.info("Cleanup of system_data documents with NaN pool completed")
+        self.metrics.start("9 archimedes_db")
+        if run_archimedes_db:
+            env_value = self.config.get("ENVIRONMENT", "")
+            if env_value in ("DEV", "PROD"):
+                fs.run_archimedesDB(self.directory, "requirements.json", sink=sink)
+            else:
+                fs.run_archimedesDB(self.directory, sink=sink)
+            stages.done("archimedes_db")
+
+        # ------------------------------------------------------------------
+        # 10 | Cleanup pool NaN in system_data  (solo se lo stage 8 ne ha scritti)
+        # ------------------------------------------------------------------
+        self.metrics.start("10 cleanup")
+        if run_cleanup:
+            docs = list(sink.stream("system_data"))
+            self.metrics.add(docs_read=len(docs))
+            kept = set()
+            for doc_id, data in docs:
+                pool_val = data.get("pool")
+                if isinstance(pool_val, float) and math.isnan(pool_val):
+                    sink.delete("system_data", doc_id)
+                    self.metrics.add(docs_deleted=1)
+                    logging.info(f"Deleted system_data doc '{doc_id}' because pool is NaN")
+                else:
+                    kept.add(doc_id)
+            logging.info("Cleanup of system_data documents with NaN pool completed")
+            # le pool non più in system_data (cancellate qui o altrove) escono dagli aggregati
+            if utils.string_to_bool(self.config.get("AGGREGATES", "False")):
+                self.update_aggregates(sink, lambda maintainer: maintainer.remove(
+                    [doc_id for doc_id in maintainer.contributions if doc_id not in kept]
+                ))
+            stages.done("cleanup")
+        stages.save(self.stages_state_path)
+        sink.close()
+        self.metrics.stop()
 
 
 # ----------------------------------------------------------------------
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run main cycles")
     parser.add_argument("--cycles", type=int, default=1)
+    parser.add_argument("--daemon", action="store_true",
+                        help="run until SIGTERM, polling MAX(id) with an adaptive interval")
+    parser.add_argument("--profile", choices=metrics.PROFILERS, default=None,
+                        help="profile every cycle (output in METRICS_DIR, default 'metrics')")
     args = parser.parse_args()
 
     if not load_dotenv(os.path.join(os.getcwd(), ".env")):
@@ -195,13 +644,24 @@ if __name__ == "__main__":
     utils.activate_logger(dotenv_values(".env"), os.getcwd())
     logging.info("=== Start of main.py ===")
 
-    runner = Main()
-    for n in range(args.cycles):
-        try:
-            runner.run()
-        except Exception as e:
-            logging.error(f"Error during iteration {n + 1}: {e}")
-        if n < args.cycles - 1:
-            time.sleep(20)
+    if args.daemon:
+        import daemon
+
+        config = dotenv_values(Main.env_file_path)
+        session = MerlinSession(config)
+        runner = Main(session)
+        runner.config = config
+        runner.profile = args.profile
+        daemon.run_daemon(runner, session, daemon.AdaptivePoller.from_config(config))
+    else:
+        runner = Main()
+        runner.profile = args.profile
+        for n in range(args.cycles):
+            try:
+                runner.run()
+            except Exception as e:
+                logging.error(f"Error during iteration {n + 1}: {e}")
+            if n < args.cycles - 1:
+                time.sleep(20)
 
     logging.info("=== End of program main.py ===")
@@ -0,0 +1,202 @@
+"""
+Per-stage instrumentation of Main.run.
+
+StageMetrics works like a lap timer: start("5 capacity_history") closes the running stage and
+opens the next one, so every numbered stage of main.py is measured without changing its code
+layout. For each stage it records:
+    wall_seconds / cpu_seconds   perf_counter and process_time (all the threads of the process)
+    rows_in / rows_out           rows read and produced, as reported by the stage with add()
+    docs_written / docs_read / docs_deleted
+    peak_rss_bytes               high-water mark of the process RSS at the end of the stage
+A stage that runs several times in a cycle (pipeline chunks, shard workers) is summed on export.
+
+export() writes the cycle as a Prometheus textfile (for the node_exporter textfile collector,
+replaced atomically) and appends it to a JSON lines file. profile() wraps a cycle with cProfile or
+pyinstrument when requested (PROFILE / --profile).
+"""
+import contextlib
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Callable, List, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+PROMETHEUS_FILE = "archimedes.prom"
+JSONL_FILE = "metrics.jsonl"
+METRIC_PREFIX = "archimedes_stage"
+COUNTERS = ["rows_in", "rows_out", "docs_written", "docs_read", "docs_deleted"]
+PROFILERS = ("cprofile", "pyinstrument")
+
+
+def peak_rss_bytes() -> Optional[int]:
+    if resource is None:
+        return None
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageMetrics:
+    """Measurements of the stages of one cycle."""
+
+    def __init__(self, on_stage: Optional[Callable[[Optional[str]], None]] = None):
+        self.records: List[dict] = []
+        self.current: Optional[dict] = None
+        self.started = time.time()
+        # notified of the running stage (None between stages), e.g. FirestoreUsage.set_stage
+        self.on_stage = on_stage
+
+    def start(self, stage: str, rows_in: Optional[int] = None):
+        """Closes the running stage (if any) and starts measuring `stage`."""
+        self.stop()
+        if self.on_stage is not None:
+            self.on_stage(stage)
+        self.current = {
+            "stage": stage,
+            "rows_in": rows_in or 0,
+            **dict.fromkeys(COUNTERS[1:], 0),
+            "_wall": time.perf_counter(),
+            "_cpu": time.process_time(),
+        }
+
+    def add(self, **counts: int):
+        """Adds to the counters of the running stage (rows_in, rows_out, docs_written, ...)."""
+        if self.current is None:
+            return
+        for name, value in counts.items():
+            self.current[name] += int(value or 0)
+
+    def stop(self):
+        if self.current is None:
+            return
+        record = self.current
+        self.current = None
+        if self.on_stage is not None:
+            self.on_stage(None)
+        record["wall_seconds"] = round(time.perf_counter() - record.pop("_wall"), 6)
+        record["cpu_seconds"] = round(time.process_time() - record.pop("_cpu"), 6)
+        record["peak_rss_bytes"] = peak_rss_bytes()
+        self.records.append(record)
+
+    @contextlib.contextmanager
+    def measure(self, stage: str, rows_in: Optional[int] = None):
+        """Measures a block as one stage: `with metrics.measure("1 connect_merlindb"): ...`."""
+        self.start(stage, rows_in)
+        try:
+            yield self
+        finally:
+            self.stop()
+
+    def record(self, stage: str, wall_seconds: float, cpu_seconds: float, **counts: int):
+        """Adds a stage measured by another thread (pipeline extract), with its own timings."""
+        self.records.append({
+            "stage": stage,
+            **dict.fromkeys(COUNTERS, 0),
+            **counts,
+            "wall_seconds": round(wall_seconds, 6),
+            "cpu_seconds": round(cpu_seconds, 6),
+            "peak_rss_bytes": peak_rss_bytes(),
+        })
+
+    def merge(self, records: List[dict]):
+        """Adds the records measured in another process (shard workers)."""
+        self.records.extend(records)
+
+    def summary(self) -> List[dict]:
+        """One record per stage in order of first appearance, with the repeated runs summed."""
+        stages = {}
+        for record in self.records:
+            total = stages.setdefault(record["stage"], {"stage": record["stage"], "runs": 0})
+            total["runs"] += 1
+            for name in COUNTERS + ["wall_seconds", "cpu_seconds"]:
+                total[name] = round(total.get(name, 0) + record[name], 6)
+            rss = record.get("peak_rss_bytes")
+            if rss is not None:
+                total["peak_rss_bytes"] = max(total.get("peak_rss_bytes") or 0, rss)
+        return list(stages.values())
+
+    def export(self, metrics_dir: str, labels: Optional[dict] = None) -> List[dict]:
+        """Writes the Prometheus textfile and appends the JSON lines of the cycle to `metrics_dir`."""
+        self.stop()
+        summary = self.summary()
+        os.makedirs(metrics_dir, exist_ok=True)
+        cycle = datetime.fromtimestamp(self.started).strftime("%Y-%m-%d %H:%M:%S")
+        with open(os.path.join(metrics_dir, JSONL_FILE), "a") as f:
+            for record in summary:
+                f.write(json.dumps({"cycle": cycle, **(labels or {}), **record}) + "\n")
+
+        lines = []
+        for name in ["wall_seconds", "cpu_seconds", "peak_rss_bytes"] + COUNTERS + ["runs"]:
+            metric = f"{METRIC_PREFIX}_{name}"
+            lines.append(f"# HELP {metric} {name.replace('_', ' ')} of the stage in the last cycle")
+            lines.append(f"# TYPE {metric} gauge")
+            for record in summary:
+                if record.get(name) is not None:
+                    lines.append(f"{metric}{{{_labels({**(labels or {}), 'stage': record['stage']})}}} {record[name]}")
+        lines.append("# HELP archimedes_cycle_timestamp_seconds start of the last measured cycle")
+        lines.append("# TYPE archimedes_cycle_timestamp_seconds gauge")
+        lines.append(f"archimedes_cycle_timestamp_seconds {self.started:.0f}")
+        path = os.path.join(metrics_dir, PROMETHEUS_FILE)
+        with open(path + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
+        return summary
+
+    def log_summary(self, top: int = 5):
+        slowest = sorted(self.summary(), key=lambda r: r["wall_seconds"], reverse=True)[:top]
+        if slowest:
+            logging.info("Slowest stages: " + ", ".join(f"{r['stage']} {r['wall_seconds']:.2f}s" for r in slowest))
+
+
+def _labels(labels: dict) -> str:
+    def escape(value) -> str:
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return ",".join(f'{key}="{escape(value)}"' for key, value in labels.items())
+
+
+@contextlib.contextmanager
+def profile(kind: Optional[str], output_dir: str):
+    """
+    Profiles the block with "cprofile" (pstats file, open with snakeviz / pstats) or "pyinstrument"
+    (HTML, optional dependency); any other value disables profiling.
+    """
+    kind = (kind or "").lower()
+    if kind not in PROFILERS:
+        yield
+        return
+    os.makedirs(output_dir, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    if kind == "cprofile":
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            path = os.path.join(output_dir, f"profile_{stamp}.prof")
+            profiler.dump_stats(path)
+            logging.info(f"cProfile written to {path}")
+        return
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        logging.warning("pyinstrument is not installed: profiling disabled")
+        yield
+        return
+    profiler = Profiler()
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        path = os.path.join(output_dir, f"profile_{stamp}.html")
+        with open(path, "w") as f:
+            f.write(profiler.output_html())
+        logging.info(f"pyinstrument profile written to {path}")
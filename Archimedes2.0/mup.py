@@ -0,0 +1,118 @@
+"""
+Streaming MUP (Maximum Usage Peak): rolling peak of perc_used per (hostid, pool).
+
+Each pool keeps one monotonic deque of (timestamp, perc_used) samples with strictly decreasing
+values: a sample is dropped as soon as a later one is at least as high, since it can no longer be
+the peak of any window ending now. The deque only spans the largest window, and the peak of every
+shorter window is the first entry inside it (found with a bisect), so all windows share the same
+deque. Each batch is first reduced to its own suffix maxima with a vectorized reverse cummax, then
+merged; the deques are persisted between cycles, so the peaks are exact without rescanning history.
+"""
+import logging
+from bisect import bisect_left
+from collections import deque
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+import utils
+
+MUP_WINDOWS_DAYS = [1, 7, 30]
+# window reported as "MUP" in system_data (the others as "MUP_<n>d")
+MUP_DEFAULT_WINDOW_DAYS = 7
+
+SECONDS_PER_DAY = 86400
+
+
+def parse_windows(value: Optional[str]) -> List[float]:
+    """"1,7,30" -> [1.0, 7.0, 30.0]; MUP_WINDOWS_DAYS when empty."""
+    if not value:
+        return list(MUP_WINDOWS_DAYS)
+    return sorted({float(v) for v in value.split(",") if v.strip()})
+
+
+def window_column(window_days: float) -> str:
+    return f"MUP_{window_days:g}d"
+
+
+class PeakTracker:
+    """Rolling perc_used peaks of every pool, persisted as a JSON state file."""
+
+    def __init__(self, windows_days: Optional[List[float]] = None):
+        self.windows_days = sorted(windows_days or MUP_WINDOWS_DAYS)
+        self.max_window_seconds = int(max(self.windows_days) * SECONDS_PER_DAY)
+        # utils.pool_key -> deque of (timestamp seconds, perc_used), values strictly decreasing
+        self.pools: dict = {}
+
+    def update(self, samples: pd.DataFrame) -> set:
+        """Adds a batch ("hostid", "pool", "timestamp", "perc_used"). Returns the updated pool keys."""
+        df = samples[["hostid", "pool", "timestamp", "perc_used"]].dropna()
+        if df.empty:
+            return set()
+        df = df.assign(seconds=df["timestamp"].to_numpy(dtype="datetime64[s]").astype(np.int64))
+        df = df.sort_values(["hostid", "pool", "seconds"], kind="stable").reset_index(drop=True)
+        # a sample can be a future peak only if it is higher than every later sample of the batch
+        reverse = df.iloc[::-1]
+        reverse_max = reverse.groupby(["hostid", "pool"], sort=False)["perc_used"].cummax()
+        later_max = reverse_max.groupby([reverse["hostid"], reverse["pool"]], sort=False).shift(1)
+        last_seconds = df.groupby(["hostid", "pool"], sort=False)["seconds"].transform("max")
+        candidates = df[~(df["perc_used"] <= later_max.sort_index())]
+
+        updated, skipped = set(), 0
+        latest = dict(zip(zip(df["hostid"], df["pool"]), last_seconds))
+        for (hostid, pool), group in candidates.groupby(["hostid", "pool"], sort=False):
+            key = utils.pool_key(hostid, pool)
+            peaks = self.pools.setdefault(key, deque())
+            for seconds, value in zip(group["seconds"].tolist(), group["perc_used"].tolist()):
+                if peaks and seconds < peaks[-1][0]:
+                    skipped += 1
+                    continue
+                while peaks and peaks[-1][1] <= value:
+                    peaks.pop()
+                peaks.append((seconds, value))
+            horizon = latest[(hostid, pool)] - self.max_window_seconds
+            while len(peaks) > 1 and peaks[0][0] < horizon:
+                peaks.popleft()
+            updated.add(key)
+        if skipped:
+            logging.warning(f"MUP: skipped {skipped} out-of-order samples")
+        return updated
+
+    def peak(self, key: str, window_days: float) -> Optional[float]:
+        """Highest perc_used in the `window_days` before the last sample of the pool."""
+        peaks = self.pools.get(key)
+        if not peaks:
+            return None
+        # the newest entry is the last sample seen, so it anchors every window
+        start = peaks[-1][0] - window_days * SECONDS_PER_DAY
+        index = bisect_left([seconds for seconds, _ in peaks], start)
+        return peaks[index][1]
+
+    def apply(self, df_systems: pd.DataFrame, default_window_days: float = MUP_DEFAULT_WINDOW_DAYS) -> pd.DataFrame:
+        """Sets "MUP" and "MUP_<n>d" on the rows of df_systems with a tracked pool."""
+        df = df_systems.copy()
+        keys = [utils.pool_key(h, p) for h, p in zip(df["hostid"], df["pool"])]
+        df["MUP"] = pd.Series([self.peak(key, default_window_days) for key in keys], index=df.index, dtype=object)
+        for window in self.windows_days:
+            df[window_column(window)] = pd.Series([self.peak(key, window) for key in keys], index=df.index, dtype=object)
+        return df
+
+    def save(self, file_path: str):
+        utils.write_state(
+            {"windows_days": self.windows_days,
+             "pools": {key: list(peaks) for key, peaks in self.pools.items()}},
+            file_path,
+        )
+
+    @classmethod
+    def load(cls, file_path: str, windows_days: Optional[List[float]] = None) -> "PeakTracker":
+        state = utils.read_state(file_path)
+        tracker = cls(windows_days)
+        if max(state.get("windows_days") or [0]) < max(tracker.windows_days):
+            logging.info("MUP: longest window increased, peaks are exact once the new window is filled")
+        tracker.pools = {
+            key: deque((int(seconds), float(value)) for seconds, value in peaks)
+            for key, peaks in state.get("pools", {}).items()
+        }
+        return tracker
@@ -0,0 +1,173 @@
+"""
+Staged pipeline for Main.run (PIPELINE=True), overlapping fetch, transform and upload.
+
+The new telemetry ids (LAST_ID, MAX(id)] are split into ranges of PIPELINE_CHUNK_ROWS ids and flow
+through three stages connected by bounded queues:
+    extract   (thread)  Merlin range scan of each chunk, the only user of the DB connection
+    transform (process) results.build_tables, the pandas work, outside the GIL of the uploads
+    load      (caller)  Main.process_batch: the stateful stages and the Firestore uploads
+While chunk k is loaded, chunk k+1 is transformed and chunk k+2 fetched, so a cycle takes about
+as long as its slowest stage. A stage that runs ahead blocks on a full queue (back-pressure), so
+at most 2 * PIPELINE_QUEUE_SIZE + 3 chunks are in memory whatever the backlog.
+
+Chunks are loaded in id order and LAST_ID is advanced to the end of a chunk only after its load
+completed, so after a failure the next cycle restarts from the first chunk not loaded.
+
+In daemon mode the transform process is kept warm between cycles (Main.load_state), like the shard
+workers of sharding.py; it is replaced after a failed cycle. With SHARDS > 1 the tables of a chunk
+are split by hostid and every shard worker receives its rows.
+"""
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import results
+import utils
+from db import MerlinSession
+
+CHUNK_ROWS = 50_000
+QUEUE_SIZE = 2
+# seconds between checks of the stop flag while blocked on a queue
+POLL_SECONDS = 0.5
+
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=POLL_SECONDS)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q: queue.Queue, stop: threading.Event):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=POLL_SECONDS)
+        except queue.Empty:
+            continue
+    return _DONE
+
+
+def _extract(session: MerlinSession, start_id: int, end_id: int, chunk_rows: int,
+             out: queue.Queue, stop: threading.Event, metrics):
+    try:
+        merlin_db, db_conn = session.connection()
+        for first in range(start_id, end_id, chunk_rows):
+            last = min(first + chunk_rows, end_id)
+            wall, cpu = time.perf_counter(), time.thread_time()
+            telemetry = merlin_db.get_telemetry_range(db_conn, first, last)
+            metrics.record("1 extract", time.perf_counter() - wall, time.thread_time() - cpu,
+                           rows_out=len(telemetry))
+            logging.info(f"Pipeline: extracted ids ({first}, {last}] -> {len(telemetry)} rows")
+            if not _put(out, (last, telemetry), stop):
+                return
+        _put(out, _DONE, stop)
+    except Exception as e:
+        _put(out, _Failure(e), stop)
+
+
+def _transform(executor: ProcessPoolExecutor, companies, inp: queue.Queue, out: queue.Queue,
+               stop: threading.Event):
+    while True:
+        item = _get(inp, stop)
+        if item is _DONE or isinstance(item, _Failure):
+            _put(out, item, stop)
+            return
+        end_id, telemetry = item
+        try:
+            tables = None
+            if not telemetry.empty:
+                tables = executor.submit(results.build_tables, companies, telemetry).result()
+        except Exception as e:
+            _put(out, _Failure(e), stop)
+            return
+        if not _put(out, (end_id, telemetry, tables), stop):
+            return
+
+
+def run_pipeline(runner, chunk_rows: int = None, queue_size: int = None) -> int:
+    """
+    Processes every telemetry row after LAST_ID with the staged pipeline.
+
+    Args:
+        runner (main.Main): Its `session` is reused when set (daemon mode), otherwise a connection
+            is opened for this call.
+        chunk_rows (int, optional): Ids per chunk. Defaults to PIPELINE_CHUNK_ROWS or CHUNK_ROWS.
+        queue_size (int, optional): Chunks buffered between two stages. Defaults to
+            PIPELINE_QUEUE_SIZE or QUEUE_SIZE.
+
+    Returns:
+        int: number of chunks loaded.
+    """
+    chunk_rows = chunk_rows or int(runner.config.get("PIPELINE_CHUNK_ROWS", CHUNK_ROWS))
+    queue_size = queue_size or int(runner.config.get("PIPELINE_QUEUE_SIZE", QUEUE_SIZE))
+    session = runner.session or MerlinSession(runner.config)
+    stop = threading.Event()
+    threads = []
+    executor = None
+    loaded, failed = 0, False
+    try:
+        merlin_db, db_conn = session.connection()
+        last_id = int(utils.read_last_id(runner.last_id_path) or 0)
+        max_id = merlin_db.get_max_id(db_conn)
+        if max_id is None or max_id <= last_id:
+            logging.info("Pipeline: no new telemetry")
+            return 0
+        companies = merlin_db.get_companies_data(db_conn)
+        logging.info(f"Pipeline: ids ({last_id}, {max_id}] in chunks of {chunk_rows}")
+
+        extracted, transformed = queue.Queue(queue_size), queue.Queue(queue_size)
+        # spawn: the worker must not inherit the threads and the Firestore client of this process
+        executor = runner.load_state(
+            "pipeline_executor",
+            lambda: ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")),
+        )
+        threads = [
+            threading.Thread(target=_extract, args=(session, last_id, max_id, chunk_rows, extracted, stop, runner.metrics),
+                             name="pipeline-extract", daemon=True),
+            threading.Thread(target=_transform, args=(executor, companies, extracted, transformed, stop),
+                             name="pipeline-transform", daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+
+        while True:
+            item = _get(transformed, stop)
+            if item is _DONE:
+                break
+            if isinstance(item, _Failure):
+                raise item.error
+            end_id, telemetry, tables = item
+            if tables is not None:
+                runner.process_batch(companies, telemetry, tables)
+            utils.update_last_id(end_id, runner.last_id_path)
+            loaded += 1
+        logging.info(f"Pipeline: {loaded} chunks loaded, LAST_ID={max_id}")
+        return loaded
+    except Exception:
+        failed = True
+        raise
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        # a warm executor is kept for the next cycle, unless the cycle failed (it may be broken)
+        if executor is not None and (runner.warm_state is None or failed):
+            executor.shutdown(cancel_futures=True)
+            if runner.warm_state is not None:
+                runner.warm_state.pop("pipeline_executor", None)
+        # after a failure the connection may be broken: the next cycle reopens it
+        if failed or runner.session is None:
+            session.reset()
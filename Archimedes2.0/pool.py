@@ -1,26 +1,56 @@
 import os
+import numpy as np
 import pandas as pd
 #import fireducks.pandas as pd
 from pydantic import BaseModel, Field
 from pprint import pprint
 from typing import List, Union
 
-from . import db, utils
+import utils
+import forecast
+from columnar import TelemetryTable, base_pool
 
 
 class Pool(BaseModel):
     host_id: str = Field(..., description="Assigned host ID")
     pool_id: str = Field(..., description="Unique id for the Pool")
     pool_name: str = Field(..., description="Name assigned to the Pool")
-    pool_dataframe: pd.DataFrame = Field(..., description="Raw data from the telemetry")
+    table: TelemetryTable = Field(..., description="Shared telemetry of the fleet", repr=False)
+    start: int = Field(..., description="First row of the Pool in the table")
+    stop: int = Field(..., description="Row after the last one of the Pool in the table")
+
+    class Config:
+        arbitrary_types_allowed = True
 
     def __str__(self):
-        return f"Pool ID: {self.poolid}, Pool Name: {self.poolname}"    
-    
-    # Needs to be tested
+        return f"Pool ID: {self.pool_id}, Pool Name: {self.pool_name}"
+
+    @classmethod
+    def from_table(cls, table: TelemetryTable, host_id: str, pool_name: str) -> "Pool":
+        """Pool backed by its row range of the shared table (no data is copied)."""
+        start, stop = table.rows(host_id, pool_name)
+        return cls(host_id=host_id, pool_id=utils.pool_key(host_id, pool_name), pool_name=pool_name,
+                   table=table, start=start, stop=stop)
+
+    @property
+    def pool_dataframe(self) -> pd.DataFrame:
+        """Raw data from the telemetry, as a view over the shared table."""
+        return self.table.view(self.start, self.stop)
+
+    def column(self, name: str) -> np.ndarray:
+        return self.table.column(name, self.start, self.stop)
+
+    @property
+    def datasets(self) -> List["Dataset"]:
+        return [
+            Dataset.from_table(self.table, self.host_id, name)
+            for name in self.table.datasets(self.host_id, self.pool_name)
+        ]
+
+    @staticmethod
     def _filter_dataframe(
-        dataframe: pd.DataFrame, 
-        columns_list: List[str], 
+        dataframe: pd.DataFrame,
+        columns_list: List[str],
         values_list: Union[int, float, str, List[Union[int, float, str]]]
         ) -> pd.DataFrame:
         """
@@ -32,20 +62,21 @@ class Pool(BaseModel):
             values_list (Union[int, float, str, List[Union[int, float, str]]]): The value(s) to filter by.
 
         Returns:
-            pd.DataFrame: The filtered DataFrame.
+            pd.DataFrame: The rows whose value is in values_list for every column.
         """
         if not isinstance(values_list, list):
             values_list = [values_list]  # Convert single value to a list
-        
-        # Apply the filter for each column and value combination
+
+        # One combined mask, the frame is indexed once
+        mask = np.ones(len(dataframe), dtype=bool)
         for column_name in columns_list:
-            filtered_df = dataframe[dataframe[column_name].isin(values_list)]
-        
-        return filtered_df
-    
+            mask &= dataframe[column_name].isin(values_list).to_numpy()
+
+        return dataframe[mask]
+
     # Needs to be tested and moved to another file
     def get_pools(self) -> pd.DataFrame:
-        return self.raw_dataframe[["hostid", "pool"]].drop_duplicates()
+        return self.table.pool_keys()
 
     def space_analysis(self):
         pass
@@ -53,8 +84,20 @@ class Pool(BaseModel):
     def state_vector_analysis(self):
         pass
 
-    def capacity_prediction(self):
-        pass
+    def capacity_prediction(self) -> dict:
+        """Forecast of perc_used (forecast.forecast_pools) from the telemetry of the Pool."""
+        used = self.column("used").astype("float64")
+        total = used + self.column("avail").astype("float64")
+        with np.errstate(divide="ignore", invalid="ignore"):
+            perc_used = np.where(total > 0, used / total * 100, np.nan)
+        samples = pd.DataFrame({
+            "hostid": self.host_id,
+            "pool": self.pool_name,
+            "timestamp": self.column(self.table.time_column),
+            "perc_used": perc_used,
+        })
+        forecasts = forecast.forecast_pools(samples)
+        return forecasts.iloc[0].to_dict() if not forecasts.empty else {}
 
 
 class Dataset(Pool):
@@ -62,16 +105,20 @@ class Dataset(Pool):
 
     def __str__(self):
         return f"Dataset Name: {self.dataset_name} from Pool ID: {self.pool_id}"
-    
-    def _filter_dataframe(dataframe, columns_list, values_list):
-        return super()._filter_dataframe(columns_list, values_list)
-    
+
+    @classmethod
+    def from_table(cls, table: TelemetryTable, host_id: str, dataset_name: str) -> "Dataset":
+        start, stop = table.rows(host_id, dataset_name)
+        pool_name = base_pool(dataset_name)
+        return cls(host_id=host_id, pool_id=utils.pool_key(host_id, pool_name), pool_name=pool_name,
+                   dataset_name=dataset_name, table=table, start=start, stop=stop)
+
+    @property
+    def datasets(self) -> List["Dataset"]:
+        return []
+
     def space_analysis(self):
         return super().space_analysis()
-    
+
     def state_vector_analysis(self):
         return super().state_vector_analysis()
-    
-
-    
-
@@ -5,6 +5,8 @@ from datetime import timedelta
 import utils
 
 MAX_TIMEFRAME_HOURS = 24
+# variazione minima di perc_used perché un campione di capacity_trends venga scritto
+PERC_USED_MIN_CHANGE = 0.01
 
 
 # --------------------------------------------------------------------------
@@ -62,6 +64,49 @@ def capacity_trends_table(raw_data_telemetry: pd.DataFrame) -> pd.DataFrame:
     return df_filtered
 
 
+# --------------------------------------------------------------------------
+# COMPATTAZIONE CAPACITY TRENDS (variazioni significative)
+# --------------------------------------------------------------------------
+def compact_capacity_trends(
+    df_capacity: pd.DataFrame,
+    last_written: dict,
+    min_change: float = PERC_USED_MIN_CHANGE,
+) -> tuple[pd.DataFrame, dict]:
+    """
+    Applica in fase di scrittura la regola di firestore_deletion.py: per ogni (hostid, pool),
+    in ordine di data, un campione viene mantenuto solo se perc_used differisce di almeno
+    `min_change` dall'ultimo valore scritto.
+
+    `last_written` mappa utils.pool_key(hostid, pool) -> ultimo perc_used scritto nei cicli
+    precedenti. Ritorna il dataframe compattato e lo stato aggiornato (nuovo dict).
+    """
+    state = dict(last_written)
+    if df_capacity.empty:
+        return df_capacity, state
+
+    df = df_capacity.sort_values("date", kind="stable")
+    keep = pd.Series(False, index=df.index)
+    for (host, pool), group in df.groupby(["hostid", "pool"], dropna=False, sort=False):
+        key = utils.pool_key(host, pool)
+        last_value = state.get(key)
+        kept_idx = []
+        for idx, value in zip(group.index, group["perc_used"].to_numpy()):
+            if pd.isna(value):
+                continue
+            if last_value is None or abs(value - last_value) >= min_change:
+                kept_idx.append(idx)
+                last_value = float(value)
+        keep.loc[kept_idx] = True
+        if last_value is not None:
+            state[key] = last_value
+
+    df_compacted = df[keep].sort_index()
+    logging.info(
+        f"Compacting capacity_trends: skipped {len(df) - len(df_compacted)} insignificant samples"
+    )
+    return df_compacted, state
+
+
 # --------------------------------------------------------------------------
 # CAPACITY TRENDS DATASET – SOLO POOL CON “/”
 # --------------------------------------------------------------------------
@@ -113,6 +158,27 @@ def capacity_trends_dataset_table(raw_data_telemetry: pd.DataFrame) -> pd.DataFr
     return df_filtered
 
 
+# --------------------------------------------------------------------------
+# TELEMETRY SAMPLES – SOLO POOL SENZA “/” (input degli stadi incrementali)
+# --------------------------------------------------------------------------
+def telemetry_samples_table(raw_data_telemetry: pd.DataFrame) -> pd.DataFrame:
+    """
+    Ritorna tutti i campioni grezzi del batch (senza deduplica) per le pool senza “/”,
+    ordinati per data: hostid, pool, timestamp (datetime), used e total (GB), perc_used.
+    """
+    df = raw_data_telemetry[~raw_data_telemetry["pool"].str.contains("/", na=False)]
+    total = df["avail"] + df["used"]
+    samples = pd.DataFrame({
+        "hostid": df["hostid"],
+        "pool": df["pool"],
+        "timestamp": pd.to_datetime(df["editdate"], errors="coerce"),
+        "used": df["used"] / utils.giga,
+        "total": total / utils.giga,
+        "perc_used": (df["used"] / total * 100).where(total > 0),
+    })
+    return samples.dropna(subset=["timestamp"]).sort_values("timestamp", kind="stable")
+
+
 # --------------------------------------------------------------------------
 # SYSTEMS DATA
 # --------------------------------------------------------------------------
@@ -233,3 +299,19 @@ def systems_data_table(
         ]
     ]
     return df_final
+
+
+# --------------------------------------------------------------------------
+# TUTTE LE TABELLE DI UN BATCH
+# --------------------------------------------------------------------------
+def build_tables(raw_data_companies: pd.DataFrame, raw_data_telemetry: pd.DataFrame) -> dict:
+    """
+    Costruisce le tabelle dello stage 2 di main.py a partire dai dati grezzi di un batch.
+    Funzione pura (nessuno stato): pipeline.py la esegue in un processo separato.
+    """
+    return {
+        "capacity": capacity_trends_table(raw_data_telemetry),
+        "systems": systems_data_table(raw_data_companies, raw_data_telemetry),
+        "capacity_dataset": capacity_trends_dataset_table(raw_data_telemetry),
+        "samples": telemetry_samples_table(raw_data_telemetry),
+    }
@@ -0,0 +1,105 @@
+# retention.py – scadenza dei documenti tramite TTL di Firestore
+"""
+Calcola il campo `expireAt` usato dalle TTL policy di Firestore, così la retention per età
+viene applicata lato server invece che con scan e delete di firestore_deletion.py.
+
+La policy è definita per collezione e risoluzione:
+    - "raw"   : ogni campione scritto dalla pipeline
+    - "daily" : il primo campione scritto per (hostid, pool, day), che resta come rappresentante
+                giornaliero (firestore_deletion sceglieva quello più vicino alla media del giorno,
+                che in fase di scrittura non è ancora noto)
+Un valore None indica nessuna scadenza (il campo expireAt non viene scritto).
+
+La TTL policy va abilitata una volta per collection group, ad esempio:
+    gcloud firestore fields ttls update expireAt --collection-group=capacity_trends --enable-ttl
+"""
+import logging
+from datetime import timezone
+from typing import Optional
+
+import pandas as pd
+
+import utils
+
+TTL_FIELD = "expireAt"
+
+# giorni di retention per collezione e risoluzione
+RETENTION_POLICY = {
+    "capacity_trends": {"raw": 7, "daily": None},
+    "capacity_trends_dataset": {"raw": 7, "daily": None},
+    "capacity_history": {"raw": None},
+}
+
+
+def load_policy(config: dict) -> dict:
+    """
+    Restituisce RETENTION_POLICY con gli override del file .env, nel formato
+    RETENTION_<COLLECTION>_<RESOLUTION>_DAYS (es. RETENTION_CAPACITY_TRENDS_RAW_DAYS=14).
+    Il valore "none" disabilita la scadenza.
+    """
+    policy = {collection: dict(levels) for collection, levels in RETENTION_POLICY.items()}
+    for collection, levels in policy.items():
+        for resolution in levels:
+            key = f"RETENTION_{collection.upper()}_{resolution.upper()}_DAYS"
+            value = config.get(key)
+            if value is None or value == "":
+                continue
+            if value.strip().lower() == "none":
+                levels[resolution] = None
+                continue
+            try:
+                levels[resolution] = float(value)
+            except ValueError:
+                logging.warning(f"Invalid retention value {key}={value}: keeping {levels[resolution]}")
+    return policy
+
+
+def mark_resolution(df: pd.DataFrame, daily_written: dict) -> tuple[pd.Series, dict]:
+    """
+    Assegna "daily" al primo campione (in ordine di data) di ogni (hostid, pool, day) non ancora
+    coperto nei cicli precedenti, "raw" a tutti gli altri.
+
+    `daily_written` mappa utils.pool_key(hostid, pool) -> ultimo day con un rappresentante scritto.
+    Ritorna la serie delle risoluzioni (stesso indice di df) e lo stato aggiornato.
+    """
+    state = dict(daily_written)
+    resolution = pd.Series("raw", index=df.index, dtype=object)
+    if df.empty:
+        return resolution, state
+
+    keys = [utils.pool_key(h, p) for h, p in zip(df["hostid"], df["pool"])]
+    first_of_day = (
+        df.assign(_key=keys)
+        .sort_values("date", kind="stable")
+        .drop_duplicates(subset=["_key", "day"], keep="first")
+    )
+    for idx, key, day in zip(first_of_day.index, first_of_day["_key"], first_of_day["day"]):
+        last_day = state.get(key)
+        if last_day is None or day > last_day:
+            resolution.at[idx] = "daily"
+            state[key] = day
+    return resolution, state
+
+
+def expire_at(
+    collection: str,
+    dates: pd.Series,
+    resolution: Optional[pd.Series] = None,
+    policy: Optional[dict] = None,
+) -> pd.Series:
+    """
+    Calcola expireAt = date + retention(collection, resolution) per ogni riga.
+    Le righe senza scadenza valgono None; gli altri valori sono datetime UTC,
+    salvati da Firestore come Timestamp (tipo richiesto dalle TTL policy).
+    """
+    levels = (policy or RETENTION_POLICY).get(collection, {})
+    if resolution is None:
+        resolution = pd.Series("raw", index=dates.index, dtype=object)
+    days = resolution.map(levels).astype("float64")
+    sample_dt = pd.to_datetime(dates, format="%Y-%m-%d %H:%M:%S", errors="coerce")
+    expires = sample_dt + pd.to_timedelta(days, unit="D")
+    return pd.Series(
+        [None if pd.isna(ts) else ts.to_pydatetime().replace(tzinfo=timezone.utc) for ts in expires],
+        index=dates.index,
+        dtype=object,
+    )
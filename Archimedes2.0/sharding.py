@@ -0,0 +1,139 @@
+"""
+Sharded execution of Main.process for large fleets (SHARDS=N > 1).
+
+Telemetry and companies are hash-partitioned by hostid (crc32 % N: stable across runs and
+processes, unlike hash()) and every shard is processed by its own spawned worker process:
+results.py tables, compaction, MUP, health, state vectors, candles, forecast, alerts and all the
+per-pool Firestore uploads, with a Firestore client of its own (clients.get_firestore_client is per
+process). The pandas work and the uploads therefore run on N cores instead of one.
+
+A pool always lands in the same shard, so every shard keeps its own state files under
+state/shards_<N>/<i>; changing SHARDS starts from new state folders. The parent merges what the
+workers return (system_data rows, dataset snapshot sums, NaN pool documents and the CSV tables) and
+runs the fleet stages once: CSV, company/fleet aggregates, ArchimedesDB and the NaN pool cleanup.
+When a shard fails, run_sharded raises after the fleet stages, so LAST_ID is not advanced and the
+whole batch is read again by the next cycle. The shards that succeeded process their slice again:
+the uploads overwrite the same documents, and the per-pool state skips the samples it already
+merged (see Main.process).
+"""
+import logging
+import multiprocessing
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import clients
+import sinks
+from stages import StageTracker
+
+
+def shard_of(hostids: pd.Series, shards: int) -> np.ndarray:
+    """Shard (0..shards-1) of every hostid; crc32 is computed once per distinct hostid."""
+    codes, uniques = pd.factorize(hostids.astype(str))
+    shard_of_unique = np.array([zlib.crc32(h.encode()) % shards for h in uniques], dtype=np.int64)
+    return shard_of_unique[codes]
+
+
+def shard_state_dir(state_dir: str, shards: int, shard: int) -> str:
+    return os.path.join(state_dir, f"shards_{shards}", str(shard))
+
+
+def _process_shard(shard: int, attributes: dict, config: dict, companies: pd.DataFrame,
+                   telemetry: pd.DataFrame, tables: dict = None):
+    """Worker entry point: Main.process(shard=True) on one shard, with the state files of the shard."""
+    import main
+
+    level = getattr(logging, config.get("LOGGING_LEVEL", "INFO").upper(), logging.INFO)
+    logging.basicConfig(level=level, format=f"%(asctime)s - %(levelname)s - [shard {shard}] %(message)s")
+    runner = main.Main()
+    for name, value in attributes.items():
+        setattr(runner, name, value)
+    runner.config = config
+    # the run budget is split evenly between the shards
+    clients.firestore_usage.reset()
+    clients.firestore_usage.configure(config, share=1 / int(config["SHARDS"]))
+    runner.with_state_dir(shard_state_dir(runner.state_dir, int(config["SHARDS"]), shard))
+    runner.sink_part = f"shard{shard}"
+    return runner.process(companies, telemetry, tables, shard=True)
+
+
+def run_sharded(runner, companies: pd.DataFrame, telemetry: pd.DataFrame, shards: int, tables: dict = None):
+    """
+    Processes a batch on `shards` worker processes, then runs the fleet stages on the merged results.
+
+    Args:
+        runner (main.Main): Parent runner; its paths and config are passed to the workers. In daemon
+            mode the worker pool is kept warm between cycles.
+        companies (pd.DataFrame): Companies read from Merlin.
+        telemetry (pd.DataFrame): Telemetry batch.
+        shards (int): Number of shards (and worker processes).
+        tables (dict, optional): Stage 2 tables already built (pipeline.py transform); every shard
+            receives its rows instead of building them again.
+    """
+    stages = runner.load_state("stages", lambda: StageTracker.load(runner.stages_state_path))
+    stages.set_inputs(telemetry=telemetry, companies=companies, config=runner.config)
+    if not stages.should_run("pipeline", required=["telemetry"]):
+        runner.resume_stages(stages)
+        return
+
+    telemetry_shards = shard_of(telemetry["hostid"], shards)
+    company_shards = shard_of(companies["hostid"], shards)
+    table_shards = {name: shard_of(df["hostid"], shards) for name, df in (tables or {}).items()}
+    attributes = {
+        name: getattr(runner, name) for name in dir(type(runner))
+        if name in ("directory", "state_dir") or name.endswith("_path")
+    }
+    config = {**runner.config, "SHARDS": str(shards)}
+
+    # spawn: the workers must not inherit the threads and the Firestore client of this process
+    executor = runner.load_state(
+        "shard_executor",
+        lambda: ProcessPoolExecutor(max_workers=shards, mp_context=multiprocessing.get_context("spawn")),
+    )
+    outputs, failed, broken = [], [], True
+    try:
+        futures = {
+            shard: executor.submit(
+                _process_shard, shard, attributes, config,
+                companies[company_shards == shard], telemetry[telemetry_shards == shard],
+                {name: df[table_shards[name] == shard].copy() for name, df in tables.items()} if tables else None,
+            )
+            for shard in range(shards) if (telemetry_shards == shard).any()
+        }
+        logging.info(f"Sharding: {len(telemetry)} rows on {len(futures)}/{shards} shards")
+        for shard, future in futures.items():
+            try:
+                output = future.result()
+            except Exception as e:
+                logging.error(f"Sharding: shard {shard} failed: {e}")
+                failed.append(shard)
+                continue
+            if output is not None:
+                runner.metrics.merge(output.pop("metrics", []))
+                clients.firestore_usage.merge(output.pop("firestore_usage", []))
+                outputs.append(output)
+        broken = bool(failed)
+    finally:
+        # a warm pool is kept for the next cycle, unless a shard failed (a dead worker breaks the pool)
+        if runner.warm_state is None or broken:
+            executor.shutdown(cancel_futures=True)
+            if runner.warm_state is not None:
+                runner.warm_state.pop("shard_executor", None)
+
+    # fleet stages on what the shards processed (the rows of a failed shard are not counted)
+    if outputs:
+        df_systems = pd.concat([o["systems"] for o in outputs], ignore_index=True)
+        agg = pd.concat([o["snapshots"] for o in outputs])
+        nan_pool_docs = [doc_id for o in outputs for doc_id in o["nan_pool_docs"]]
+        runner.save_tables(
+            pd.concat([o["capacity_trends"] for o in outputs], ignore_index=True),
+            pd.concat([o["capacity_dataset"] for o in outputs], ignore_index=True),
+            df_systems,
+        )
+        sink = sinks.from_config(runner.config, runner.directory, runner.sink_part)
+        runner.finish(sink, stages, df_systems, agg, nan_pool_docs, complete=not failed)
+    if failed:
+        raise RuntimeError(f"Sharding: shards {failed} failed")
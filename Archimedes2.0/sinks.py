@@ -0,0 +1,260 @@
+"""
+Output sinks for the documents written by main.py and fs.ArchimedesDB.
+
+Every upload goes through a Sink, selected with SINK in .env:
+    firestore  (default) the production Firestore client of clients.get_firestore_client
+    emulator   a Firestore emulator at FIRESTORE_EMULATOR_HOST (project FIRESTORE_PROJECT)
+    jsonl      one JSON line per operation in SINK_DIR/<collection>/<part>.jsonl
+    parquet    one Parquet file per flushed batch in SINK_DIR/<collection>/
+The local sinks record the operations (set / delete, with the merge flag) in the order they were
+made, so production batches can be replayed, the pipeline benchmarked without network cost and
+the outputs of two versions diffed. They buffer SINK_BATCH_ROWS operations per collection before
+writing, and SINK_FSYNC decides when the files are synced to disk: "batch" (every write), "close"
+(once at the end of the cycle) or "none" (left to the OS).
+stream() returns the current documents of a collection: the local sinks rebuild them from the
+recorded operations. set_many() raises SinkWriteError when some documents were not written, so a
+stage saves its state only after a complete upload (the cycle fails and reads the batch again).
+"""
+import json
+import logging
+import os
+from abc import ABC, abstractmethod
+from datetime import date, datetime
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+import clients
+import fs
+
+FIRESTORE, EMULATOR, JSONL, PARQUET = "firestore", "emulator", "jsonl", "parquet"
+SINK_DIR = "sink"
+BATCH_ROWS = fs.MAX_BATCH_WRITES
+FSYNC_BATCH, FSYNC_CLOSE, FSYNC_NONE = "batch", "close", "none"
+EMULATOR_PROJECT = "archimedes-local"
+
+
+class SinkWriteError(RuntimeError):
+    pass
+
+
+class Sink(ABC):
+    """Destination of the documents of a cycle."""
+
+    @abstractmethod
+    def set(self, collection: str, doc_id: str, data: dict, merge: bool = False):
+        ...
+
+    def set_many(self, collection: str, items: Iterable[Tuple[str, dict]], merge: bool = False) -> int:
+        """Writes (doc_id, data) items; returns the number of documents written."""
+        written = 0
+        for doc_id, data in items:
+            self.set(collection, doc_id, data, merge=merge)
+            written += 1
+        return written
+
+    @abstractmethod
+    def delete(self, collection: str, doc_id: str):
+        ...
+
+    @abstractmethod
+    def stream(self, collection: str) -> Iterator[Tuple[str, dict]]:
+        """(doc_id, data) of every document of the collection."""
+
+    def close(self):
+        pass
+
+
+class FirestoreSink(Sink):
+    """Firestore (or emulator) client: documents one by one, set_many with concurrent WriteBatches."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def set(self, collection: str, doc_id: str, data: dict, merge: bool = False):
+        self.db.collection(collection).document(doc_id).set(data, merge=merge)
+
+    def set_many(self, collection: str, items: Iterable[Tuple[str, dict]], merge: bool = False) -> int:
+        items = list(items)
+        collection_ref = self.db.collection(collection)
+        written = fs.commit_in_batches(
+            self.db,
+            items,
+            lambda batch, item: batch.set(collection_ref.document(item[0]), item[1], merge=merge),
+        )
+        # commit_in_batches logs and skips the failed batches
+        if written < len(items):
+            raise SinkWriteError(f"{len(items) - written} of {len(items)} documents of '{collection}' not written")
+        return written
+
+    def delete(self, collection: str, doc_id: str):
+        self.db.collection(collection).document(doc_id).delete()
+
+    def stream(self, collection: str) -> Iterator[Tuple[str, dict]]:
+        for snapshot in self.db.collection(collection).stream():
+            yield snapshot.id, snapshot.to_dict() or {}
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+def _apply(documents: Dict[str, dict], record: dict):
+    """Applies a recorded operation to the rebuilt documents of a collection."""
+    if record["op"] == "delete":
+        documents.pop(record["id"], None)
+    elif record.get("merge") and record["id"] in documents:
+        documents[record["id"]].update(record["data"])
+    else:
+        documents[record["id"]] = dict(record["data"])
+
+
+class _LocalSink(Sink):
+    """Buffered operation log, one directory per collection."""
+
+    def __init__(self, directory: str, part: str = "main", batch_rows: int = BATCH_ROWS,
+                 fsync: str = FSYNC_CLOSE):
+        self.directory = directory
+        self.part = part
+        self.batch_rows = max(1, batch_rows)
+        self.fsync = fsync
+        self.buffers: Dict[str, List[dict]] = {}
+        self.unsynced: List[str] = []
+
+    def _record(self, collection: str, record: dict):
+        buffer = self.buffers.setdefault(collection, [])
+        buffer.append(record)
+        if len(buffer) >= self.batch_rows:
+            self._flush(collection)
+
+    def set(self, collection: str, doc_id: str, data: dict, merge: bool = False):
+        self._record(collection, {"op": "set", "id": doc_id, "merge": merge, "data": data})
+
+    def delete(self, collection: str, doc_id: str):
+        self._record(collection, {"op": "delete", "id": doc_id, "merge": False, "data": None})
+
+    def _collection_dir(self, collection: str) -> str:
+        path = os.path.join(self.directory, collection.replace("/", "-"))
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def _flush(self, collection: str):
+        records = self.buffers.pop(collection, None)
+        if not records:
+            return
+        path = self._write(self._collection_dir(collection), records)
+        if self.fsync == FSYNC_BATCH:
+            _fsync(path)
+        elif self.fsync == FSYNC_CLOSE and path not in self.unsynced:
+            self.unsynced.append(path)
+
+    @abstractmethod
+    def _write(self, collection_dir: str, records: List[dict]) -> str:
+        """Writes a batch of records; returns the path of the file written."""
+
+    @abstractmethod
+    def _read(self, collection_dir: str) -> Iterator[dict]:
+        """The records of a collection, in write order."""
+
+    def flush(self):
+        for collection in list(self.buffers):
+            self._flush(collection)
+
+    def stream(self, collection: str) -> Iterator[Tuple[str, dict]]:
+        self._flush(collection)
+        documents: Dict[str, dict] = {}
+        for record in self._read(self._collection_dir(collection)):
+            _apply(documents, record)
+        yield from documents.items()
+
+    def close(self):
+        self.flush()
+        for path in self.unsynced:
+            _fsync(path)
+        self.unsynced = []
+
+
+def _fsync(path: str):
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+
+
+class JsonlSink(_LocalSink):
+    """Appends the operations to <collection>/<part>.jsonl (NaN is kept as the NaN literal)."""
+
+    def _write(self, collection_dir: str, records: List[dict]) -> str:
+        path = os.path.join(collection_dir, f"{self.part}.jsonl")
+        with open(path, "a") as f:
+            f.write("".join(json.dumps(record, default=_json_default) + "\n" for record in records))
+        return path
+
+    def _read(self, collection_dir: str) -> Iterator[dict]:
+        for name in sorted(os.listdir(collection_dir)):
+            if name.endswith(".jsonl"):
+                with open(os.path.join(collection_dir, name)) as f:
+                    for line in f:
+                        yield json.loads(line)
+
+
+class ParquetSink(_LocalSink):
+    """
+    One file per flushed batch, named <timestamp>-<part>-<n>.parquet so that the names sort in
+    write order. Columns: op, doc_id, merge and data (the document as JSON, like JsonlSink).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.files = 0
+
+    def _write(self, collection_dir: str, records: List[dict]) -> str:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.table({
+            "op": [r["op"] for r in records],
+            "doc_id": [r["id"] for r in records],
+            "merge": [r["merge"] for r in records],
+            "data": [None if r["data"] is None else json.dumps(r["data"], default=_json_default) for r in records],
+        })
+        self.files += 1
+        stamp = datetime.now().strftime("%Y%m%d%H%M%S%f")
+        path = os.path.join(collection_dir, f"{stamp}-{self.part}-{self.files:05d}.parquet")
+        pq.write_table(table, path)
+        return path
+
+    def _read(self, collection_dir: str) -> Iterator[dict]:
+        import pyarrow.parquet as pq
+
+        for name in sorted(os.listdir(collection_dir)):
+            if name.endswith(".parquet"):
+                for row in pq.read_table(os.path.join(collection_dir, name)).to_pylist():
+                    data = None if row["data"] is None else json.loads(row["data"])
+                    yield {"op": row["op"], "id": row["doc_id"], "merge": row["merge"], "data": data}
+
+
+def from_config(config: dict, main_dir: str, part: str = "main") -> Sink:
+    """
+    The sink selected by SINK (see the module docstring). `part` names the files of this process
+    in the local sinks (shard workers write their own).
+    """
+    kind = str(config.get("SINK", FIRESTORE)).lower()
+    if kind == FIRESTORE:
+        return FirestoreSink(clients.get_firestore_client(main_dir))
+    if kind == EMULATOR:
+        host = config.get("FIRESTORE_EMULATOR_HOST") or os.environ.get("FIRESTORE_EMULATOR_HOST")
+        if not host:
+            raise ValueError("SINK=emulator requires FIRESTORE_EMULATOR_HOST")
+        return FirestoreSink(clients.get_firestore_emulator_client(host, config.get("FIRESTORE_PROJECT", EMULATOR_PROJECT)))
+    if kind in (JSONL, PARQUET):
+        fsync = str(config.get("SINK_FSYNC", FSYNC_CLOSE)).lower()
+        if fsync not in (FSYNC_BATCH, FSYNC_CLOSE, FSYNC_NONE):
+            logging.warning(f"Unknown SINK_FSYNC '{fsync}', using '{FSYNC_CLOSE}'")
+            fsync = FSYNC_CLOSE
+        directory = os.path.join(main_dir, config.get("SINK_DIR", SINK_DIR))
+        cls = JsonlSink if kind == JSONL else ParquetSink
+        return cls(directory, part, int(config.get("SINK_BATCH_ROWS", BATCH_ROWS)), fsync)
+    raise ValueError(f"Sink '{kind}' not supported")
@@ -0,0 +1,122 @@
+"""
+Stage dependency tracking for Main.run.
+
+Every stage declares the inputs it reads (STAGE_INPUTS). The fingerprints of those inputs at the
+stage's last successful run are kept in a JSON state file. A stage whose inputs have the same
+fingerprints again is skipped:
+    - "telemetry" / "companies": the DataFrames read from Merlin (an empty batch has no fingerprint,
+      so nothing downstream of it runs)
+    - "config": the .env values
+    - "capacity_csv": results/capacity_data.csv uploaded by fs.run_archimedesDB
+    - "nan_pool_docs": system_data documents with a NaN pool written in the cycle (removed by stage 10)
+A stage is recorded with done() only after it completes. Until then it stays pending, with the
+fingerprints of the inputs it started from: stages 2-8.5 rerun when Main.run reads the batch again
+(LAST_ID is advanced only after the batch is processed), while stages 9-10, which run after the
+batch is recorded as processed, are resumed by Main.resume_stages on the next cycle that skips it.
+A batch read again usually comes with new rows, so its fingerprint differs and stages 2-8.5 run on
+it again: see Main.process for how their state skips the samples already merged.
+"""
+import hashlib
+import json
+import logging
+import os
+from typing import Any, Dict, Iterable, Optional
+
+import pandas as pd
+
+import utils
+
+STAGE_INPUTS = {
+    # stages 2-8.5 all derive from the DataFrames built from the Merlin batch
+    "pipeline": ["telemetry", "companies", "config"],
+    "archimedes_db": ["capacity_csv"],
+    # stage 8 rewrites the NaN pool documents of every batch, so every new batch needs a cleanup
+    "cleanup": ["telemetry", "nan_pool_docs"],
+}
+
+
+def fingerprint(value: Any) -> Optional[str]:
+    """Stable digest of a DataFrame, a file path (size + mtime), a dict or an iterable; None when empty."""
+    if value is None:
+        return None
+    if isinstance(value, pd.DataFrame):
+        if value.empty:
+            return None
+        hashes = pd.util.hash_pandas_object(value, index=False).to_numpy()
+        digest = hashlib.sha1(hashes.tobytes())
+        digest.update(",".join(map(str, value.columns)).encode())
+        return digest.hexdigest()
+    if isinstance(value, str):
+        if not os.path.exists(value):
+            return None
+        stat = os.stat(value)
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+    if isinstance(value, dict):
+        payload = json.dumps(value, sort_keys=True, default=str)
+    else:
+        items = sorted(map(str, value))
+        if not items:
+            return None
+        payload = "\n".join(items)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+class StageTracker:
+    """Input fingerprints of every stage at its last successful run."""
+
+    def __init__(self, completed: Optional[Dict[str, dict]] = None, pending: Optional[Dict[str, dict]] = None):
+        # stage -> {input: fingerprint}
+        self.completed = completed or {}
+        # stages started but not completed -> {input: fingerprint} they started from
+        self.pending = pending or {}
+        self.inputs: Dict[str, Optional[str]] = {}
+
+    def set_inputs(self, **values):
+        """Fingerprints the inputs of the current cycle (see fingerprint())."""
+        for name, value in values.items():
+            self.inputs[name] = fingerprint(value)
+
+    def _current(self, stage: str) -> dict:
+        return {name: self.inputs.get(name) for name in STAGE_INPUTS[stage]}
+
+    def should_run(self, stage: str, required: Iterable[str] = ()) -> bool:
+        """
+        False when the inputs are unchanged since the last successful run, or when one of the
+        `required` inputs is empty (nothing to process).
+        """
+        current = self._current(stage)
+        if any(current.get(name) is None for name in required):
+            logging.info(f"Stage {stage} skipped: no {', '.join(required)}")
+            return False
+        if self.completed.get(stage) == current:
+            logging.info(f"Stage {stage} skipped: inputs unchanged since the last run")
+            return False
+        self.pending[stage] = current
+        return True
+
+    def is_pending(self, *stages: str) -> bool:
+        return any(stage in self.pending for stage in stages)
+
+    def resume(self, stage: str) -> bool:
+        """
+        True when `stage` started in an earlier cycle and never completed. The inputs it started
+        from are restored, so that done() records them.
+        """
+        pending = self.pending.get(stage)
+        if pending is None:
+            return False
+        logging.info(f"Stage {stage} resumed: it did not complete in a previous cycle")
+        self.inputs.update(pending)
+        return True
+
+    def done(self, stage: str):
+        self.completed[stage] = self._current(stage)
+        self.pending.pop(stage, None)
+
+    def save(self, file_path: str):
+        utils.write_state({"completed": self.completed, "pending": self.pending}, file_path)
+
+    @classmethod
+    def load(cls, file_path: str) -> "StageTracker":
+        state = utils.read_state(file_path)
+        return cls(state.get("completed"), state.get("pending"))
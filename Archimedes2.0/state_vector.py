@@ -1,16 +1,33 @@
 import os
+import logging
+import numpy as np
 import pandas as pd
 #import fireducks.pandas as pd
 #import polars as pl
-import matplotlib.pyplot as plt
-import seaborn as sns
 from bisect import bisect_left
-import mplfinance as mpf
 from datetime import datetime, timedelta
-import logfire as lf
 from pydantic import BaseModel, Field, validator
 from typing import List, Optional
 
+import archive
+import charts
+import utils
+
+# matplotlib and mplfinance are imported by the plotting methods on first use
+logger = logging.getLogger(__name__)
+
+TIMEFRAMES_DAYS = [0.5, 1, 3, 7]
+# StateVectorMaintainer state folder: metadata file; a checkpoint is written once the segments hold
+# more rows than the checkpoint (and at least SEGMENT_MIN_ROWS), or there are SEGMENT_MAX_FILES of them
+SV_META_FILE = "meta.json"
+SEGMENT_MIN_ROWS = 100_000
+SEGMENT_MAX_FILES = 64
+SV_BATCH_COLUMNS = [
+    "Host ID", "Pool", "Timeframe Days", "Start Timestamp", "Last Timestamp",
+    "Start Used Space", "Last Used Space", "Latest Max Space", "Global State",
+    "Total Space", "Percentage Written", "Percentage Deleted", "Percentage Read",
+]
+
 
 class StateVector(BaseModel):
     """Initialize the StateVector class.
@@ -22,10 +39,14 @@ class StateVector(BaseModel):
 
     hostid: str = Field(..., description="The host ID to filter the data.")
     pool: str = Field(..., description="Pool to filter the data.")
-    timeframes_days: List[float] = Field([0.5, 1, 3, 7], description="Timeframes to analyze.") # Add more timeframes for more results
+    timeframes_days: List[float] = Field(TIMEFRAMES_DAYS, description="Timeframes to analyze.") # Add more timeframes for more results
     
     results: dict = Field(default_factory=dict, description="Results of the analysis.")
+    raw_dataframe: Optional[pd.DataFrame] = Field(default=None, description="Telemetry of the pool (timestamp, used_tb, total).")
     sv_data: Optional[pd.DataFrame] = Field(default=None, description="State Vector data.")
+
+    class Config:
+        arbitrary_types_allowed = True
     #self.lazyframe = (lf.filter(
     #    (pl.col("hostid") == self.hostid) & (pl.col("pool") == self.pool))
     #    .sort("timestamp")
@@ -54,6 +75,16 @@ class StateVector(BaseModel):
         super().__init__(hostid=hostid, pool=pool, raw_dataframe=filtered_df, **kwargs)
         self.results.update({"Host ID": self.hostid, "Pool": self.pool})
 
+    @classmethod
+    def from_archive(cls, hostid: str, pool: str, root: str = archive.ARCHIVE_DIR, start: Optional[str] = None, **kwargs):
+        """Build the StateVector from the local Parquet archive instead of reading Firestore."""
+        archived = archive.read_archive(root, hostid=hostid, pool=pool, start=start)
+        return cls(archive.to_state_vector_frame(archived), hostid, pool, **kwargs)
+
+    @property
+    def dataframe(self) -> pd.DataFrame:
+        return self.raw_dataframe
+
     def _add_timeframes(self):
         for timeframe in self.timeframes_days:
             self.results[f"{timeframe*24}h"] = None
@@ -71,174 +102,118 @@ class StateVector(BaseModel):
         return colors
 
 
+    @classmethod
+    def from_fleet(cls, df: pd.DataFrame, timeframes_days: Optional[List[float]] = None) -> dict:
+        """
+        StateVector of every (hostid, pool) of `df`, with the results of the analysis already set:
+        the frame is split once and every result comes from a single batch_state_vectors call,
+        instead of masking the frame and analyzing it pool by pool.
+
+        Returns:
+            dict: (hostid, pool) -> StateVector.
+        """
+        timeframes_days = timeframes_days or TIMEFRAMES_DAYS
+        rows = batch_state_vectors(df, [timeframes_days[3]]).set_index(["Host ID", "Pool"])
+        vectors = {}
+        for (hostid, pool), group in df.groupby(["hostid", "pool"], sort=False):
+            vector = cls(group, hostid, pool, timeframes_days=timeframes_days)
+            if (hostid, pool) in rows.index:
+                vector._set_results(rows.loc[(hostid, pool)].to_dict())
+            vectors[(hostid, pool)] = vector
+        return vectors
+
+    def _window(self) -> dict:
+        """State vector of the longest timeframe (timeframes_days[3]), from batch_state_vectors."""
+        rows = batch_state_vectors(self.dataframe.assign(hostid=self.hostid, pool=self.pool), [self.timeframes_days[3]])
+        if rows.empty:
+            raise ValueError("no telemetry for the pool")
+        return rows.iloc[0].to_dict()
+
+    def _set_results(self, window: dict, keys: Optional[List[str]] = None):
+        for key in keys or SV_BATCH_COLUMNS[3:]:
+            value = window[key]
+            self.results[key] = pd.Timestamp(value) if key.endswith("Timestamp") else value
+
     def find_timestamps(self):
         """Find the last and start timestamps based on the timeframe."""
         try:
-            #max_timestamp = self.lazyframe.select(pl.col("timestamp").max().alias("max_timestamp")).collect()[0, "max_timestamp"]
-            max_timestamp = self.dataframe["timestamp"].max()
-            limit_timestamp = max_timestamp - timedelta(days=self.timeframes_days[3])
-
-            #left_closest_timestamp = (
-            #    self.lazyframe
-            #    .filter(pl.col("timestamp") < limit_timestamp)
-            #    .select(pl.col("timestamp").max().alias("left_closest"))
-            #    .collect()
-            #)[0, "left_closest"]
-
-            timestamps_series = self.dataframe["timestamp"].tolist()
-            index = bisect_left(timestamps_series, limit_timestamp)
-
-            left_closest_timestamp = timestamps_series[index]
-            # this part is implemented to make sure the timestamp is not greater than the max timestamp
-            if left_closest_timestamp > max_timestamp:
-                index -= 1
-                left_closest_timestamp = timestamps_series[index]
-
-            self.results["Last Timestamp"] = max_timestamp
-            self.results["Start Timestamp"] = left_closest_timestamp
-
+            self._set_results(self._window(), ["Last Timestamp", "Start Timestamp"])
         except Exception as e:
-            lf.log.error(f"Error finding timestamps: {e}")
+            logger.error(f"Error finding timestamps: {e}")
 
 
     def get_sv_values(self):
         """Retrieve state vector values."""
         try:
-            #used_start = self.lazyframe.filter(pl.col("timestamp") == self.results["Last Timestamp"]).collect()[0, "used_tb"]
-            #used_end = self.lazyframe.filter(pl.col("timestamp") == self.results["Start Timestamp"]).collect()[0, "used_tb"]
-            #latest_max_space = self.lazyframe.filter(pl.col("timestamp") == self.results["Last Timestamp"]).collect()[0, "total"]
-
-            used_start = self.dataframe[self.dataframe["timestamp"] == self.results["Start Timestamp"]]["used_tb"].values[0]
-            used_end = self.dataframe[self.dataframe["timestamp"] == self.results["Last Timestamp"]]["used_tb"].values[0]
-            latest_max_space = self.dataframe[self.dataframe["timestamp"] == self.results["Last Timestamp"]]["total"].values[0]
-
-            global_state = (used_end - used_start) / latest_max_space
-
-            self.results["Start Used Space"] = used_start
-            self.results["Last Used Space"] = used_end
-            self.results["Latest Max Space"] = latest_max_space
-            self.results["Global State"] = global_state
-
+            self._set_results(self._window(), ["Start Used Space", "Last Used Space", "Latest Max Space", "Global State"])
         except Exception as e:
-            lf.log.error(f"Error retrieving state vector values: {e}")
+            logger.error(f"Error retrieving state vector values: {e}")
 
 
     def get_sv_data(self):
-        """Retrieve state vector data."""
+        """Retrieve state vector data: the samples of the window with their increments."""
         try:
-            #lf = self.lazyframe.filter(
-            #    pl.col("timestamp").is_between(self.results["Start Timestamp"], self.results["Last Timestamp"])
-            #    ).select("timestamp", "used_tb", "total") \
-            #    .with_columns(
-            #        (pl.col("used_tb") - pl.col("used_tb").shift(1)).alias("used_tb_diff")) \
-            #    .with_columns(
-            #        (pl.col("used_tb_diff") / pl.col("total")).alias("increment"))
-            #self.sv_data = lf.collect().to_pandas()
-            self.sv_data = self.dataframe[(self.dataframe["timestamp"] >= self.results["Start Timestamp"]) &
-                                        (self.dataframe["timestamp"] <= self.results["Last Timestamp"])]
+            sv_data = self.dataframe[(self.dataframe["timestamp"] >= self.results["Start Timestamp"]) &
+                                     (self.dataframe["timestamp"] <= self.results["Last Timestamp"])]
+            used_tb_diff = sv_data["used_tb"].diff()
+            self.sv_data = sv_data.assign(used_tb_diff=used_tb_diff, increment=used_tb_diff / sv_data["total"])
 
         except Exception as e:
-            lf.log.error(f"Error in retrieving state vector data: {e}")
+            logger.error(f"Error in retrieving state vector data: {e}")
 
 
     def state_vector_analysis(self):
-        """Perform state vector analysis."""
+        """Perform state vector analysis (written / deleted / read samples of the window)."""
         try:
-            state_vector_stats = {
-                "writed": 0,
-                "deleted": 0,
-                "readed": 0
-            }
-
-            for value in self.sv_data["increment"]:
-                if value > 0:
-                    state_vector_stats["writed"] += 1
-                elif value < 0:
-                    state_vector_stats["deleted"] += 1
-                else:
-                    state_vector_stats["readed"] += 1
-
-            self.results["Total Space"] = state_vector_stats["writed"] + state_vector_stats["deleted"] + state_vector_stats["readed"]
-
-            self.results["Percentage Written"] = round(state_vector_stats["writed"] / self.results["Total Space"] * 100, 2)
-            self.results["Percentage Deleted"] = round(state_vector_stats["deleted"] / self.results["Total Space"] * 100, 2)
-            self.results["Percentage Read"] = round(state_vector_stats["readed"] / self.results["Total Space"] * 100, 2)
-
+            self._set_results(self._window(), ["Total Space", "Percentage Written", "Percentage Deleted", "Percentage Read"])
         except Exception as e:
             logger.error(f"Error in state vector analysis: {e}")
 
 
-    def plot_usage_analysis(self, colors=None, labels=None, title=None):
-        """Creates a donut graph with the results of the state vector analysis.
+    def plot_usage_analysis(self, colors=None, labels=None, title=None, fmt: charts.ChartFormat = "png") -> bytes:
+        """Donut graph of the results of the state vector analysis, as PNG/SVG bytes (see render()).
 
         Args:
             colors (list, optional): List of colors for the pie chart. Defaults to ["green", "red", "yellow"].
             labels (list, optional): List of labels for the pie chart. Defaults to ['Writed', 'Deleted', 'Readed'].
-            title (str, optional): Title of the plot. Defaults to None.
+            title (str, optional): Title of the plot. Defaults to the usage of the longest timeframe.
+            fmt (str): "png" or "svg".
         """
-        if colors is None:
-            colors = ["green", "red", "yellow"]
-        if labels is None:
-            labels = ['Writed', 'Deleted', 'Readed']
         if title is None:
             title = f"Usage Distribution of the last {int(self.timeframes_days[3]*24)} hours"
+        return charts.render_usage_donut(self.results, fmt, title=title, colors=colors, labels=labels)
 
-        writed_perc = self.results.get('Percentage Written', 0)
-        deleted_perc = self.results.get('Percentage Deleted', 0)
-        readed_perc = self.results.get('Percentage Read', 0)
-
-        sizes = [writed_perc, deleted_perc, readed_perc]
-
-        fig, ax = plt.subplots()
-        ax.pie(sizes, labels=labels, colors=colors, wedgeprops=dict(width=0.3))
-
-        ax.set_aspect('equal')
-
-        plt.title(title)
-        plt.legend(loc="upper right")
-        plt.tight_layout()
-
-        plt.show()
-        
-
-    def state_vector_lineplot(self):
-        """Plot the state vector data over time with colored areas for increments, decrements, and stability."""
-        if self.sv_data is not None:
-            plt.figure(figsize=(12, 6))
-
-            # Extract data
-            timestamps = self.sv_data["timestamp"]
-            increments = self.sv_data["increment"]
-
-            # Plot the line
-            plt.plot(timestamps, increments, label="Increment", color="black", linewidth=1)
+    def state_vector_lineplot(self, fmt: charts.ChartFormat = "png") -> Optional[bytes]:
+        """State vector increments over time with colored areas for increments, decrements and
+        stability, as PNG/SVG bytes (see render()); None without state vector data."""
+        if self.sv_data is None:
+            logger.warning("No state vector data available to plot.")
+            return None
+        return self.render("lineplot", fmt)
 
-            # Fill areas based on increment values
-            for i in range(len(timestamps) - 1):
-                x = [timestamps.iloc[i], timestamps.iloc[i + 1]]
-                y = [increments.iloc[i], increments.iloc[i + 1]]
+    def render(self, kind: str = "lineplot", fmt: charts.ChartFormat = "png") -> bytes:
+        """Headless version of the plot methods: returns the chart as PNG/SVG bytes.
 
-                if y[1] > y[0]:  # Growing (green)
-                    plt.fill_between(x, y, color="green", alpha=0.3, label="Growth" if i == 0 else "")
-                elif y[1] < y[0]:  # Decreasing (red)
-                    plt.fill_between(x, y, color="red", alpha=0.3, label="Decrease" if i == 0 else "")
-                else:  # Stable (blue)
-                    plt.fill_between(x, y, color="blue", alpha=0.3, label="Stable" if i == 0 else "")
+        Args:
+            kind (str): "lineplot", "donut" or "candlestick".
+            fmt (str): "png" or "svg".
+        """
+        match kind:
+            case "donut":
+                title = f"Usage Distribution of the last {int(self.timeframes_days[3]*24)} hours"
+                return charts.render_usage_donut(self.results, fmt, title=title)
+            case "lineplot":
+                return charts.render_lineplot(self.sv_data["timestamp"], self.sv_data["increment"], fmt)
+            case "candlestick":
+                return charts.render_candlestick(self._prepare_ohlc_data(), fmt)
+            case _:
+                raise ValueError(f"Unsupported chart kind: {kind}")
 
-            # Add labels, title, and legend
-            plt.xlabel("Timestamp")
-            plt.ylabel("Increment (Normalized Change)")
-            plt.title("State Vector Increments Over Time")
-            plt.legend(loc="upper left")
-            plt.grid(True, linestyle="--", alpha=0.7)
-            plt.tight_layout()
-            plt.show()
-        else:
-            logger.warning("No state vector data available to plot.")
-            
     # NEED TO FIX
     def _state_vector_variationplot(self):
         """Plot the variation of the state vector data over time as a vertical bar plot."""
+        import matplotlib.pyplot as plt
+
         if self.sv_data is not None:
             plt.figure(figsize=(12, 6))
 
@@ -261,9 +236,17 @@ class StateVector(BaseModel):
             logger.warning("No state vector data available to plot.")
     
 
-    def state_vector_candlestick(self):
-        """Plot a candlestick chart for state vector data."""
-        if self.sv_data is not None:
+    def state_vector_candlestick(self, ohlc_data: Optional[pd.DataFrame] = None):
+        """Plot a candlestick chart for state vector data.
+
+        `ohlc_data` can be precomputed candles (e.g. candles.CandleStore.get), otherwise they are
+        resampled from the raw series.
+        """
+        import mplfinance as mpf
+
+        if ohlc_data is not None:
+            mpf.plot(ohlc_data, type='candle', style='charles', title='State Vector Candlestick Chart', ylabel='Space (TB)')
+        elif self.sv_data is not None:
             # Prepare OHLC data
             ohlc_data = self._prepare_ohlc_data()
 
@@ -287,3 +270,352 @@ class StateVector(BaseModel):
         ohlc_data.dropna(inplace=True)
 
         return ohlc_data
+
+
+def batch_state_vectors(df: pd.DataFrame, timeframes_days: Optional[List[float]] = None) -> pd.DataFrame:
+    """Compute the state vector of every (hostid, pool) and every timeframe in one vectorized pass.
+
+    Fleet-wide equivalent of StateVector.find_timestamps + get_sv_values + state_vector_analysis:
+    the telemetry is sorted once by (hostid, pool, timestamp) and each window start is found with
+    a single np.searchsorted over group-contiguous keys, instead of masking the frame per pool.
+    For each window the first sample has no previous value inside the window and is counted as
+    read, as in StateVector.
+
+    Args:
+        df (pd.DataFrame): Telemetry with "hostid", "pool", "timestamp" (datetime), "used_tb" and "total".
+        timeframes_days (list, optional): Window lengths in days. Defaults to TIMEFRAMES_DAYS.
+
+    Returns:
+        pd.DataFrame: One row per pool and timeframe, with the StateVector result keys as columns.
+    """
+    timeframes_days = timeframes_days or TIMEFRAMES_DAYS
+    data = df[["hostid", "pool", "timestamp", "used_tb", "total"]].dropna(subset=["timestamp"])
+    if data.empty:
+        return pd.DataFrame(columns=SV_BATCH_COLUMNS)
+
+    host_codes, hosts = pd.factorize(data["hostid"])
+    pool_codes, pools = pd.factorize(data["pool"])
+    group_codes, _ = pd.factorize(host_codes.astype(np.int64) * (len(pools) + 1) + pool_codes)
+
+    # group-contiguous layout, timestamps resolved to the second inside each group
+    timestamps = data["timestamp"].to_numpy(dtype="datetime64[ns]")
+    seconds = timestamps.astype("datetime64[s]").astype(np.int64)
+    order = np.lexsort((seconds, group_codes))
+    group_codes = group_codes[order]
+    timestamps = timestamps[order]
+    seconds = seconds[order]
+    used = data["used_tb"].to_numpy(dtype="float64")[order]
+    total = data["total"].to_numpy(dtype="float64")[order]
+    host_codes = host_codes[order]
+    pool_codes = pool_codes[order]
+
+    n_rows = len(group_codes)
+    starts = np.flatnonzero(np.r_[True, group_codes[1:] != group_codes[:-1]])
+    lasts = np.r_[starts[1:], n_rows] - 1
+    sizes = lasts - starts + 1
+
+    # sorted composite key: group number * span + seconds since the group's first sample
+    relative = seconds - np.repeat(seconds[starts], sizes)
+    span = int(relative.max()) + 1
+    keys = np.repeat(np.arange(len(starts), dtype=np.int64), sizes) * span + relative
+
+    # increment of each sample against the previous one of the same pool (0 for the first one)
+    increment = np.zeros(n_rows)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        increment[1:] = (used[1:] - used[:-1]) / total[1:]
+    increment[starts] = 0.0
+    written = np.cumsum(increment > 0)
+    deleted = np.cumsum(increment < 0)
+
+    frames = []
+    for timeframe in timeframes_days:
+        limit = np.clip(np.ceil(relative[lasts] - timeframe * 86400), 0, None).astype(np.int64)
+        window_starts = np.searchsorted(keys, keys[lasts] - relative[lasts] + limit, side="left")
+
+        samples = lasts - window_starts + 1
+        n_written = written[lasts] - written[window_starts]
+        n_deleted = deleted[lasts] - deleted[window_starts]
+        n_read = samples - n_written - n_deleted
+        with np.errstate(divide="ignore", invalid="ignore"):
+            global_state = (used[lasts] - used[window_starts]) / total[lasts]
+
+        frames.append(pd.DataFrame({
+            "Host ID": hosts[host_codes[lasts]],
+            "Pool": pools[pool_codes[lasts]],
+            "Timeframe Days": timeframe,
+            "Start Timestamp": timestamps[window_starts],
+            "Last Timestamp": timestamps[lasts],
+            "Start Used Space": used[window_starts],
+            "Last Used Space": used[lasts],
+            "Latest Max Space": total[lasts],
+            "Global State": global_state,
+            "Total Space": samples,
+            "Percentage Written": np.round(n_written / samples * 100, 2),
+            "Percentage Deleted": np.round(n_deleted / samples * 100, 2),
+            "Percentage Read": np.round(n_read / samples * 100, 2),
+        }))
+    return pd.concat(frames, ignore_index=True)[SV_BATCH_COLUMNS]
+
+
+class RollingStateVector:
+    """Incrementally maintained state vector of one pool for every timeframe.
+
+    The samples of the largest window are kept in numpy arrays (timestamp seconds, used, total and
+    the sign of the increment against the previous sample), filled from the front of a buffer that
+    is compacted, dropping the samples before the window, only when it is full. A batch of samples
+    is appended with a few vector operations; the head of each window (the first sample newer than
+    last timestamp - timeframe) is found with np.searchsorted, and the samples after it counted as
+    written, deleted or read when the results are built. Results match batch_state_vectors.
+    """
+
+    def __init__(self, hostid: str, pool: str, timeframes_days: Optional[List[float]] = None):
+        self.hostid = hostid
+        self.pool = pool
+        self.timeframes_days = sorted(timeframes_days or TIMEFRAMES_DAYS)
+        self.ts = np.empty(0, dtype=np.int64)
+        self.used = np.empty(0, dtype=np.float64)
+        self.total = np.empty(0, dtype=np.float64)
+        self.sign = np.empty(0, dtype=np.int8)
+        # live samples are [start, end) of the buffers
+        self.start = 0
+        self.end = 0
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+    def _reserve(self, n: int):
+        if self.end + n <= len(self.ts):
+            return
+        live = self.end - self.start
+        capacity = max(2 * (live + n), 16)
+        for name in ("ts", "used", "total", "sign"):
+            buffer = getattr(self, name)
+            resized = np.empty(capacity, dtype=buffer.dtype)
+            resized[:live] = buffer[self.start:self.end]
+            setattr(self, name, resized)
+        self.start, self.end = 0, live
+
+    def _head(self, timeframe: float) -> int:
+        """Index of the first sample of the window of `timeframe` days."""
+        limit = self.ts[self.end - 1] - timeframe * 86400
+        return self.start + int(np.searchsorted(self.ts[self.start:self.end], limit, side="left"))
+
+    def extend(self, ts: np.ndarray, used: np.ndarray, total: np.ndarray, signs: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Add samples sorted by timestamp (epoch seconds). Samples not newer than the last one are
+        ignored, so a batch read again adds nothing; returns the mask of the accepted ones. `signs`
+        restores stored increment signs.
+        """
+        accepted = np.ones(len(ts), dtype=bool)
+        if len(self):
+            accepted = ts > self.ts[self.end - 1]
+        ts, used, total = ts[accepted], used[accepted], total[accepted]
+        n = len(ts)
+        if not n:
+            return accepted
+        if signs is None:
+            previous = np.r_[self.used[self.end - 1] if len(self) else np.nan, used[:-1]]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                increment = np.where(total != 0, (used - previous) / total, np.nan)
+            signs = np.nan_to_num(np.sign(increment), nan=0.0).astype(np.int8)
+        else:
+            signs = signs[accepted]
+        self._reserve(n)
+        self.ts[self.end:self.end + n] = ts
+        self.used[self.end:self.end + n] = used
+        self.total[self.end:self.end + n] = total
+        self.sign[self.end:self.end + n] = signs
+        self.end += n
+        self.start = self._head(self.timeframes_days[-1])
+        return accepted
+
+    def append(self, timestamp: int, used: float, total: float) -> bool:
+        """Add a sample (timestamp in epoch seconds). Samples not newer than the last one are ignored."""
+        return bool(self.extend(np.array([timestamp], dtype=np.int64), np.array([used], dtype=np.float64),
+                                np.array([total], dtype=np.float64))[0])
+
+    def results(self) -> List[dict]:
+        """Current state vector for every timeframe (same keys as batch_state_vectors)."""
+        if not len(self):
+            return []
+        last = self.end - 1
+        last_ts, last_used, last_total = int(self.ts[last]), float(self.used[last]), float(self.total[last])
+        rows = []
+        for tf in self.timeframes_days:
+            head = self._head(tf)
+            # the head has no previous sample inside the window: it counts as read
+            signs = self.sign[head + 1:self.end]
+            written, deleted = int((signs > 0).sum()), int((signs < 0).sum())
+            samples = self.end - head
+            n_read = samples - written - deleted
+            head_used = float(self.used[head])
+            rows.append({
+                "Host ID": self.hostid,
+                "Pool": self.pool,
+                "Timeframe Days": tf,
+                "Start Timestamp": pd.Timestamp(int(self.ts[head]), unit="s"),
+                "Last Timestamp": pd.Timestamp(last_ts, unit="s"),
+                "Start Used Space": head_used,
+                "Last Used Space": last_used,
+                "Latest Max Space": last_total,
+                "Global State": (last_used - head_used) / last_total if last_total else float("nan"),
+                "Total Space": samples,
+                "Percentage Written": round(written / samples * 100, 2),
+                "Percentage Deleted": round(deleted / samples * 100, 2),
+                "Percentage Read": round(n_read / samples * 100, 2),
+            })
+        return rows
+
+
+class StateVectorMaintainer:
+    """
+    Fleet of RollingStateVector, persisted between cycles as an append log in a state folder:
+        meta.json              timeframes and the files below
+        checkpoint-<n>.parquet the window samples of every pool (with the increment signs)
+        segment-<n>.parquet    the samples accepted by one save() after the checkpoint
+    save() writes only the samples accepted since the previous save. Once the segments hold as many
+    samples as the checkpoint (see SEGMENT_MIN_ROWS / SEGMENT_MAX_FILES), the windows are written to
+    a new checkpoint and the segments are removed, so writing costs O(new samples) amortized.
+    load() replays the segments on the checkpoint. The JSON file of the previous versions,
+    <folder>.json, is read when the folder does not exist yet and removed by the first save.
+    """
+
+    def __init__(self, timeframes_days: Optional[List[float]] = None):
+        self.timeframes_days = sorted(timeframes_days or TIMEFRAMES_DAYS)
+        self.pools: dict = {}
+        # samples accepted since the last save
+        self.unsaved: List[pd.DataFrame] = []
+        self.meta = {"sequence": 0, "checkpoint": None, "checkpoint_rows": 0, "segments": [], "segment_rows": 0}
+        self.legacy_path = None
+
+    def _rolling(self, hostid, pool) -> RollingStateVector:
+        key = utils.pool_key(hostid, pool)
+        rolling = self.pools.get(key)
+        if rolling is None or rolling.timeframes_days != self.timeframes_days:
+            rolling = self.pools[key] = RollingStateVector(hostid, pool, self.timeframes_days)
+        return rolling
+
+    def update(self, samples: pd.DataFrame, log: bool = True) -> set:
+        """Append new samples ("hostid", "pool", "timestamp", "used", "total").
+
+        Returns the (hostid, pool) pairs whose state vector changed.
+        """
+        changed = set()
+        if samples.empty:
+            return changed
+        ordered = samples.sort_values("timestamp", kind="stable")
+        seconds = ordered["timestamp"].to_numpy(dtype="datetime64[s]").astype(np.int64)
+        used = ordered["used"].to_numpy(dtype=np.float64)
+        total = ordered["total"].to_numpy(dtype=np.float64)
+        accepted = np.zeros(len(ordered), dtype=bool)
+        for (hostid, pool), rows in ordered.groupby(["hostid", "pool"], sort=False, dropna=False).indices.items():
+            mask = self._rolling(hostid, pool).extend(seconds[rows], used[rows], total[rows])
+            accepted[rows] = mask
+            if mask.any():
+                changed.add((hostid, pool))
+        skipped = len(ordered) - int(accepted.sum())
+        if skipped:
+            logger.warning(f"State vector: skipped {skipped} samples not newer than the stored ones")
+        if log and accepted.any():
+            self.unsaved.append(pd.DataFrame({
+                "hostid": ordered["hostid"].to_numpy()[accepted],
+                "pool": ordered["pool"].to_numpy()[accepted],
+                "ts": seconds[accepted],
+                "used": used[accepted],
+                "total": total[accepted],
+            }))
+        return changed
+
+    def results(self, pools: Optional[set] = None) -> pd.DataFrame:
+        """State vectors of all pools (or only of `pools`) as a DataFrame."""
+        rows = [
+            row
+            for rolling in self.pools.values()
+            if pools is None or (rolling.hostid, rolling.pool) in pools
+            for row in rolling.results()
+        ]
+        return pd.DataFrame(rows, columns=SV_BATCH_COLUMNS)
+
+    def _windows(self) -> pd.DataFrame:
+        rollings = [rolling for rolling in self.pools.values() if len(rolling)]
+        sizes = [len(rolling) for rolling in rollings]
+        def live(name):
+            return np.concatenate([getattr(r, name)[r.start:r.end] for r in rollings]) if rollings else []
+        return pd.DataFrame({
+            "hostid": np.repeat([r.hostid for r in rollings], sizes),
+            "pool": np.repeat([r.pool for r in rollings], sizes),
+            "ts": live("ts"),
+            "used": live("used"),
+            "total": live("total"),
+            "sign": live("sign"),
+        })
+
+    def save(self, directory: str):
+        """Appends the samples accepted since the last save, or writes a new checkpoint."""
+        utils.create_dir(directory)
+        meta = self.meta
+        new_rows = sum(len(df) for df in self.unsaved)
+        obsolete = []
+        if (meta["checkpoint"] is None or len(meta["segments"]) >= SEGMENT_MAX_FILES
+                or meta["segment_rows"] + new_rows > max(meta["checkpoint_rows"], SEGMENT_MIN_ROWS)):
+            windows = self._windows()
+            meta["sequence"] += 1
+            name = f"checkpoint-{meta['sequence']:08d}.parquet"
+            _write_parquet(windows, os.path.join(directory, name))
+            obsolete = [meta["checkpoint"], *meta["segments"]]
+            meta.update(checkpoint=name, checkpoint_rows=len(windows), segments=[], segment_rows=0)
+        elif new_rows:
+            meta["sequence"] += 1
+            name = f"segment-{meta['sequence']:08d}.parquet"
+            _write_parquet(pd.concat(self.unsaved, ignore_index=True), os.path.join(directory, name))
+            meta["segments"].append(name)
+            meta["segment_rows"] += new_rows
+        self.unsaved = []
+        utils.write_state({**meta, "timeframes_days": self.timeframes_days}, os.path.join(directory, SV_META_FILE))
+        for name in obsolete:
+            if name and os.path.exists(os.path.join(directory, name)):
+                os.remove(os.path.join(directory, name))
+        if self.legacy_path is not None and os.path.exists(self.legacy_path):
+            os.remove(self.legacy_path)
+            self.legacy_path = None
+
+    @classmethod
+    def load(cls, directory: str, timeframes_days: Optional[List[float]] = None) -> "StateVectorMaintainer":
+        maintainer = cls(timeframes_days)
+        meta = utils.read_state(os.path.join(directory, SV_META_FILE))
+        if not meta:
+            legacy_path = f"{directory}.json"
+            if os.path.exists(legacy_path):
+                maintainer._load_legacy(legacy_path)
+            return maintainer
+        maintainer.meta = {key: meta[key] for key in maintainer.meta}
+        try:
+            windows = pd.read_parquet(os.path.join(directory, meta["checkpoint"]))
+            for (hostid, pool), rows in windows.groupby(["hostid", "pool"], sort=False, dropna=False).indices.items():
+                maintainer._rolling(hostid, pool).extend(
+                    windows["ts"].to_numpy()[rows], windows["used"].to_numpy()[rows],
+                    windows["total"].to_numpy()[rows], windows["sign"].to_numpy()[rows],
+                )
+            for name in meta["segments"]:
+                segment = pd.read_parquet(os.path.join(directory, name))
+                maintainer.update(segment.assign(timestamp=pd.to_datetime(segment["ts"], unit="s")), log=False)
+        except Exception as e:
+            logger.error(f"Error reading the state vectors from {directory}: {e}")
+            maintainer = cls(timeframes_days)
+        return maintainer
+
+    def _load_legacy(self, file_path: str):
+        """State of the previous versions (one JSON file with the samples of every pool)."""
+        for data in utils.read_state(file_path).get("pools", []):
+            samples = np.array(data["samples"], dtype=np.float64).reshape(-1, 4)
+            self._rolling(data["hostid"], data["pool"]).extend(
+                samples[:, 0].astype(np.int64), samples[:, 1], samples[:, 2], samples[:, 3].astype(np.int8),
+            )
+        self.legacy_path = file_path
+        logger.info(f"State vector: {file_path} loaded, saved as an append log from the next save")
+
+
+def _write_parquet(df: pd.DataFrame, path: str):
+    tmp_path = f"{path}.tmp"
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
@@ -1,19 +1,21 @@
 import os
+import json
 import shutil
 import pandas as pd
-from pydantic import BaseModel, Field
-from pprint import pprint
-from icecream import ic
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
-from scipy.constants import giga, gibi, tera
 from typing import Union, Literal, List, Callable
 from datetime import datetime, timedelta
-import xlsxwriter as xw
 from dotenv import load_dotenv, set_key
 import logging
 
+# matplotlib/seaborn are imported inside the plotting helpers: the analyzer entry points
+# never plot, so they do not pay for those imports at startup
+
+# SI / IEC unit prefixes (same values as scipy.constants giga, gibi, tera)
+giga = 1e9
+gibi = 2 ** 30
+tera = 1e12
+
 DECIMAL_PRECISION = 2
 TIMEFRAME_HOURS = 4
 
@@ -153,6 +155,35 @@ def update_last_id(new_last_id, file_path: str) -> str:
         logging.error(f"Error updating LAST_ID in {file_path}: {e}")
         return str(new_last_id)
 
+### Stato locale persistente tra i cicli (file JSON)
+def pool_key(hostid, pool) -> str:
+    """Chiave stabile per identificare una coppia (hostid, pool) nei file di stato."""
+    return f"{hostid}|{pool}"
+
+def read_state(file_path: str, default=None):
+    """
+    Legge uno stato JSON salvato con write_state.
+    Se il file non esiste o non è leggibile, restituisce default (dict vuoto se None).
+    """
+    if default is None:
+        default = {}
+    if not os.path.exists(file_path):
+        return default
+    try:
+        with open(file_path, "r") as f:
+            return json.load(f)
+    except Exception as e:
+        logging.error(f"Error reading state from {file_path}: {e}")
+        return default
+
+def write_state(state, file_path: str):
+    """Scrive lo stato JSON in modo atomico (file temporaneo + rename)."""
+    create_dir(os.path.dirname(file_path) or ".")
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, file_path)
+
 #### Logging functions
 def activate_logger(config_values: dict, directory_path: str):
     """
@@ -207,6 +238,9 @@ def create_logs(config: dict, directory: str) -> str:
 
 #### Analysis results functions (for local analysis)
 def graph_canvas(x_label: str, y_label: str, title: str, show_legend: bool, show_grid: bool):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     std_style = "whitegrid"
     sns.set_style(std_style)
     
@@ -237,6 +271,8 @@ def graph_canvas(x_label: str, y_label: str, title: str, show_legend: bool, show
     plt.tight_layout()
 
 def save_graph(dir_path: str, format: Literal["png", "jpg", "svg", "pdf"] = "png"):
+    import matplotlib.pyplot as plt
+
     file_path = os.path.join(dir_path, f"graph.{format}")
     plt.savefig(file_path, format=format)
 